@@ -25,8 +25,9 @@ from PIL import Image
 import torch.backends.cudnn as cudnn
 from torchvision import transforms
 
-from utils import get_config
+from utils import get_config, get_test_transform, otsu_iou, prepare_evaluation_pic
 from trainer import Trainer
+from class_bank import ClassCodeBank
 from globalConstants import GlobalConstants
 import customTransforms
 
@@ -37,58 +38,7 @@ import argparse
 from skimage.io import imsave
 
 def load_pic(path):
-    pic = imread(path)
-    class_name = get_class(path)
-    if class_name == "malaria":
-        pic = color.rgb2grey(pic)
-        pic = invert(pic)
-    elif class_name == "Human_HT29_colon-cancer" or class_name == "dna":
-        #pic = color.rgb2grey(pic)
-        pass
-    elif class_name == "dp":
-        pic = color.rgba2rgb(pic)
-        pic = color.rgb2grey(pic)
-        
-    if (pic.dtype == 'uint16'):
-        #print("anything else than double!!")
-        if (pic.max()<32768):
-            pic = pic.astype('int16')
-        else:
-            pic = pic.astype('int32')
-    if (False):
-        pic = pic.astype('float')
-
-
-    #if (len(pic.shape)==2):
-        #pic = pic.reshape((pic.shape[0], pic.shape[1],1))
-        #pic = np.repeat(pic, 3, axis=-1)
-    if (pic.shape[0]==3):
-        #print("**************3 IS BACK: ",pic.shape)
-        pic = pic.transpose() #Not sure this is correct to get from (y,x,3) to (3,y,x)
-    
-    #==========RESHAPING=============
-    shorter_side = min(pic.shape[0], pic.shape[1])
-    if (class_name == "Hela"):
-        shorter_side = shorter_side//8
-    if (class_name == "mSar"):
-        shorter_side = shorter_side//6
-    if (class_name == "malaria"):
-        shorter_side = shorter_side//4
-    if (class_name == "Human_Hepatocyte_Murine_Fibroblast"):
-        shorter_side = int(shorter_side/2)
-    else:
-        #shorter_side = 256
-        pass
-    scale = iaa.Resize({"shorter-side":shorter_side, "longer-side":"keep-aspect-ratio"}).augment_image
-    pic = scale(pic)
-         
-    #===========CROP==================    
-    crop = iaa.CropToFixedSize(width=256, height=256, position = 'center', seed = 0).augment_image
-    pic  = crop(pic)
-    #==========TO [0,1]=============
-    pic = pic/pic.max()
-    
-    return pic
+    return prepare_evaluation_pic(imread(path), get_class(path))
 
 def get_class(path):
     return path.split('/')[-2]
@@ -164,8 +114,7 @@ def findCorrespondingHoechstImg(imgName):
     return ""
 
 
-def initFUNIT(conf, ckpt):
-    os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+def initFUNIT(conf, ckpt, device=""):
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--config',
@@ -183,6 +132,9 @@ def initFUNIT(conf, ckpt):
     parser.add_argument('--output',
                         type=str,
                         default='images/output.jpg')
+    parser.add_argument('--device',
+                        type=str,
+                        default=device)
     opts = parser.parse_args()
     cudnn.benchmark = True
     opts.vis = True
@@ -191,33 +143,26 @@ def initFUNIT(conf, ckpt):
     config['batch_size'] = 1
     config['gpus'] = 1
 
-    DebugNet.safeImgSwitch = True
-
     GlobalConstants.setPrecision(config['precision'])
     GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
     GlobalConstants.setOptimizer(config['optimizer'])
+    GlobalConstants.setDevice(opts.device if opts.device != "" else config.get('device', 'auto'),
+                              config.get('num_threads'), config.get('num_interop_threads'))
+    GlobalConstants.setMemoryFormat(config.get('channels_last', False))
     desired_size = config['desired_size']
 
     trainer = Trainer(config)
-    trainer.cuda()
+    trainer.to(GlobalConstants.getDevice())
     trainer.load_ckpt(ckpt)
     trainer.eval()
+    trainer.model.gen_test.enable_adain_cache()
     #resume_directory = opts.ckpt
     #trainer.resume(resume_directory,hp=config,multigpus=False)
 
-    transform = transforms.Compose([
-            iaa.Sequential([
-                #iaa.Resize({"shorter-side":256, "longer-side":"keep-aspect-ratio"}), #Don't forget to exclude this later
-                iaa.CropToFixedSize(width=desired_size, height=desired_size, position = 'center', seed = 0),
-                #iaa.HorizontalFlip(p=0.5),
-                #iaa.VerticalFlip(p=0.5),
-            ]).augment_image,
-            customTransforms.ToTensor(),
-            customTransforms.RescaleToOneOne()
-        ])
+    transform = get_test_transform(desired_size)
     return (trainer, transform)
 
-def useFUNIT(class_img_folder, content_img_pth, output_path, trainer, transform):
+def useFUNIT(class_img_folder, content_img_pth, output_path, trainer, transform, class_bank=None):
     classPath = class_img_folder
     imgPths = []
     imgNames = next(os.walk(classPath))[2]
@@ -225,7 +170,12 @@ def useFUNIT(class_img_folder, content_img_pth, output_path, trainer, transform)
         imgpath = os.path.join(classPath, imgName)
         imgPths.append(imgpath)
 
-    final_class_code = trainer.model.gen_test.enc_class_model(transform(default_loader_custom(imgPths[0])).unsqueeze(0).cuda())
+    adain_params = None
+    if class_bank is not None:
+        # Mean code of all class images, encoded only the first time the folder is seen with this checkpoint
+        final_class_code, adain_params = class_bank.class_code(trainer.model.gen_test, classPath, transform)
+    else:
+        final_class_code = trainer.model.gen_test.enc_class_model(trainer.model.to_device(transform(default_loader_custom(imgPths[0])).unsqueeze(0)))
     DebugNet.setName("input")
 
     image = default_loader_custom(content_img_pth)
@@ -234,7 +184,7 @@ def useFUNIT(class_img_folder, content_img_pth, output_path, trainer, transform)
     content_img = content_img.unsqueeze(0)
 
     with torch.no_grad():
-        output_image = trainer.model.translate_simple(content_img, final_class_code)
+        output_image = trainer.model.translate_simple(content_img, final_class_code, adain_params)
         image = output_image.detach().cpu().squeeze().numpy()
         image = ((image + 1) * 0.5 * 255.0)
         if (len(image.shape) == 3):
@@ -273,6 +223,9 @@ funit_dir = "FUNIT_GPU1"
 classes = next(os.walk(content_dir_path))[1]
 
 (trainer, transform) = initFUNIT(config_path, checkpoint_path)
+# Folder of class_bank.py to keep the class codes in between runs, empty to encode the first class image every time
+class_bank_dir = ""
+class_bank = ClassCodeBank(class_bank_dir, checkpoint_path, get_config(config_path)['desired_size']) if class_bank_dir != "" else None
 
 while(img_counter<1500):
     print("img_counter: ",img_counter)
@@ -336,7 +289,7 @@ while(img_counter<1500):
             pic_path = pic_paths[i]
             outputName = "images/test_"+content_class+"_"+((str)(i))+"_to_"+style+"_"+((str)(len(class_img_pths)))+".png"
             os.system(goIntoFUNIT_MIX + " rm -rf pics; mkdir pics")
-            useFUNIT(cls_path, pic_path, outputName , trainer, transform)
+            useFUNIT(cls_path, pic_path, outputName , trainer, transform, class_bank)
             #os.system(goIntoFUNIT_MIX + " python test_k_shot.py --config "+config_path+" --ckpt "+checkpoint_path+" --input "+pic_path+" --class_image_folder "+cls_path+" --output "+outputName)
             output_pic_paths.append(fullpath+outputName)
 
@@ -345,18 +298,7 @@ while(img_counter<1500):
 
 
         fake = load_pic(output_pic_paths[0])
-        thresh = threshold_otsu(fake)
-        fake = fake > thresh
-
         real = load_pic(corresponding_hoechst_image_path)
-        thresh = threshold_otsu(real)
-        real = real > thresh
-
-        #print("Shape Fake: ",fake.shape,"Shape Real: ",real.shape)
-        #print("Entries:",(fake.shape[0] * fake.shape[1]))
-        #print("True Fake: ",np.sum(fake),", True Real: ",np.sum(real))
-        intersect = np.logical_and(fake, real)
-        union = np.logical_or(fake, real)
 
 
 
@@ -364,7 +306,7 @@ while(img_counter<1500):
 
         print("====DONE====")
         #print("Class: ", content_class, " to :",moved_class_img_path.split('/')[-2])
-        acc = (np.sum(intersect)/np.sum(union))*100
+        acc = otsu_iou(fake, real)
         accs.append(acc)
         accs_classes.append(content_class)
         print("ACCURRACY: ",acc,"%")
@@ -386,3 +328,6 @@ avg /= len(accs)
 print("average: ",avg)
 print("minimum percentage: ",minimum)
 print("maximum percentage: ",maximum)
+adain_cache = trainer.model.gen_test.adain_cache
+print("AdaIN cache hit rate: %.1f%% (%d hits, %d misses)" % (100 * adain_cache.hit_rate(), adain_cache.hits,
+                                                            adain_cache.misses))
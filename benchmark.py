@@ -0,0 +1,798 @@
+"""
+Micro benchmarks for the building blocks of FUNIT.
+Each benchmark times an optimized path against the path it replaced, the tests in tests/ check that they match.
+
+USE FOLLOWING COMMAND TO EXECUTE:
+python benchmark.py inception --device cpu
+python benchmark.py fuse --config configs/funit_B022.yaml --device cpu
+python benchmark.py export --config configs/funit_B022.yaml --device cpu
+python benchmark.py channels_last --config configs/funit_B022.yaml --device cpu
+python benchmark.py checkpointing --config configs/funit_B022.yaml --device cpu --batch_size 4 --size 128
+python benchmark.py precision --config configs/funit_B022.yaml --device cpu --batch_size 4 --size 128
+python benchmark.py r1 --config configs/funit_B022.yaml --device cpu --batch_size 4 --size 128
+python benchmark.py dis_backward --config configs/funit_B022.yaml --device cpu --batch_size 4 --size 128
+python benchmark.py ema --config configs/funit_B022.yaml --device cpu
+python benchmark.py optimizer --config configs/funit_B022.yaml --device cpu
+python benchmark.py distributed --config configs/funit_B022.yaml --batch_size 2 --size 64 --processes 2
+python benchmark.py compile --config configs/funit_B022.yaml --device cpu --batch_size 4 --size 64
+python benchmark.py adain_cache --config configs/funit_B022.yaml --device cpu --batch_size 4 --size 64
+python benchmark.py matrix --config configs/funit_B022.yaml --device cpu --batch_size 8 --size 64 --classes 4
+python benchmark.py otsu --device cpu --batch_size 64 --size 256
+python benchmark.py server --config configs/funit_B022.yaml --device cpu --batch_size 8 --size 64 --clients 8
+"""
+import argparse
+import copy
+import ctypes
+import math
+import os
+import socket
+import tempfile
+import time
+
+import torch
+
+from globalConstants import GlobalConstants
+from utils import get_config, synchronize, time_it
+
+
+def peak_memory(fn, device):
+    """
+    Returns how many bytes above the memory in use before fn() were used at most while it ran.
+    On the CPU this is the peak resident set size, which is only available on Linux.
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        start = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - start
+    try:
+        start = resident_memory('VmRSS')
+        # Resets the peak resident set size VmHWM
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        fn()
+        return None
+    fn()
+    return resident_memory('VmHWM') - start
+
+
+def release_freed_memory():
+    # Lets glibc give every large tensor its own mapping, so that freed tensors leave the resident set.
+    # Has to be called before the tensors that are measured are allocated
+    try:
+        ctypes.CDLL("libc.so.6").mallopt(-3, 1 << 16)  # M_MMAP_THRESHOLD
+    except OSError:
+        pass
+
+
+def resident_memory(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key):
+                return int(line.split()[1]) * 1024
+
+
+def print_comparison(name_a, time_a, name_b, time_b):
+    print("%-24s %10.3f ms" % (name_a, time_a))
+    print("%-24s %10.3f ms" % (name_b, time_b))
+    print("speedup: %.2fx" % (time_a / time_b))
+
+
+def bench_inception(opts, device):
+    from blocks import InceptionBlock
+    block = InceptionBlock(opts.dim, opts.dim, 3, 1, 1, norm='in', activation='relu',
+                           pad_type='reflect').to(device)
+    fused_block = copy.deepcopy(block)
+    fused_block.fuse()
+    x = torch.randn(opts.batch_size, opts.dim, opts.size, opts.size, device=device)
+
+    print("--- forward ---")
+    with torch.no_grad():
+        t_seq = time_it(lambda: block.inceptionForwardSequential(x), device, opts.iterations)
+        t_branches = time_it(lambda: block.inceptionForward(x), device, opts.iterations)
+        t_fused = time_it(lambda: fused_block.inceptionForward(x), device, opts.iterations)
+    print_comparison("sequential", t_seq, "inceptionForward", t_branches)
+    print_comparison("sequential", t_seq, "after fuse()", t_fused)
+
+    print("--- forward + backward ---")
+    x.requires_grad_()
+    t_seq = time_it(lambda: block.inceptionForwardSequential(x).sum().backward(), device, opts.iterations)
+    t_branches = time_it(lambda: block.inceptionForward(x).sum().backward(), device, opts.iterations)
+    print_comparison("sequential", t_seq, "inceptionForward", t_branches)
+
+
+def bench_fuse(opts, device):
+    from blocks import InceptionBlock, count_convs
+    from networks import FewShotGen
+    config = get_config(opts.config)
+    gen = FewShotGen(config['gen']).to(device).eval()
+    fused = copy.deepcopy(gen).fuse_for_inference()
+    x = torch.randn(opts.batch_size, config['gen']['input_nc'], opts.size, opts.size, device=device)
+    with torch.no_grad():
+        class_code = gen.enc_class_model(x)
+        translate = lambda g: g.decode(g.enc_content(x), class_code)
+        print("--- FewShotGen ---")
+        print_comparison("eager", time_it(lambda: translate(gen), device, opts.iterations),
+                         "fused", time_it(lambda: translate(fused), device, opts.iterations))
+
+    # The configs build the generator without InceptionBlocks, so also fuse one on its own
+    block = InceptionBlock(opts.dim, opts.dim, 3, 1, 1, norm='in', activation='relu',
+                           pad_type='reflect').to(device).eval()
+    x = torch.randn(opts.batch_size, opts.dim, opts.size, opts.size, device=device)
+    for max_flop_ratio in (1.0, 4.0):
+        fused_block = copy.deepcopy(block)
+        fused_block.fuse(max_flop_ratio)
+        with torch.no_grad():
+            print("--- InceptionBlock, max_flop_ratio %.1f: %d instead of %d convolutions ---"
+                  % (max_flop_ratio, count_convs([fused_block]), count_convs([block])))
+            print_comparison("eager", time_it(lambda: block(x), device, opts.iterations),
+                             "fused", time_it(lambda: fused_block(x), device, opts.iterations))
+
+
+def bench_export(opts, device):
+    # The exported artifacts always run on the CPU, so the eager path is timed there as well
+    import tempfile
+    from networks import FewShotGen
+    from export import FORMATS, ExportedGenerator, export_generator
+    config = get_config(opts.config)
+    gen = FewShotGen(config['gen']).eval()
+    x = torch.randn(opts.batch_size, config['gen']['input_nc'], opts.size, opts.size)
+    with torch.no_grad():
+        class_code = gen.enc_class_model(x[:1])
+        eager = lambda: gen.decode(gen.enc_content(x), class_code.expand(x.size(0), *class_code.shape[1:]))
+    for fmt in FORMATS:
+        for adain_input in (False, True):
+            with tempfile.TemporaryDirectory() as export_dir:
+                export_generator(gen, export_dir, fmt, adain_input, size=opts.size)
+                exported = ExportedGenerator(export_dir, opts.num_threads)
+                translate = lambda: exported.translate_simple(x, exported.enc_class_model(x[:1]))
+                print("--- %s, adain_input %s ---" % (fmt, adain_input))
+                with torch.no_grad():
+                    print_comparison("eager", time_it(eager, torch.device('cpu'), opts.iterations),
+                                     "exported", time_it(translate, torch.device('cpu'), opts.iterations))
+
+
+def bench_channels_last(opts, device):
+    # Times the conv stacks in NCHW and in channels_last (NHWC), from single blocks up to whole networks
+    from blocks import Conv2dBlock, ActFirstResBlock
+    from networks import FewShotGen, GPPatchMcResDis, assign_adain_params
+    config = get_config(opts.config)
+    channels_last = torch.channels_last
+    gen = FewShotGen(config['gen']).to(device)
+    dis = GPPatchMcResDis(config['dis']).to(device)
+    images = torch.randn(opts.batch_size, config['gen']['input_nc'], opts.size, opts.size, device=device)
+    labels = torch.randint(config['dis']['num_classes'], (opts.batch_size,), device=device)
+    features = torch.randn(opts.batch_size, opts.dim, opts.size, opts.size, device=device)
+    adain = Conv2dBlock(opts.dim, opts.dim, 3, 1, 1, norm='adain', pad_type='reflect').to(device)
+    adain_params = torch.randn(opts.batch_size, 2 * opts.dim, device=device)
+
+    def translate(x):
+        return gen.decode(gen.enc_content(x), gen.enc_class_model(x))
+
+    def adain_forward(x):
+        assign_adain_params(adain_params, adain)
+        return adain(x)
+
+    def dis_step(x):
+        # Forward and backward of the discriminator as in its update, with the class indexing
+        out, feat = dis(x, labels)
+        out.mean().backward()
+        return feat
+
+    cases = [
+        ("Conv2dBlock in", Conv2dBlock(opts.dim, opts.dim, 3, 1, 1, norm='in', pad_type='reflect').to(device), features),
+        ("Conv2dBlock adain", adain_forward, features),
+        ("ActFirstResBlock", ActFirstResBlock(opts.dim, 2 * opts.dim).to(device), features),
+        ("dis.cnn_f", dis.cnn_f, images),
+        ("dis forward+backward", dis_step, images),
+        ("gen translate", translate, images),
+    ]
+    for name, fn, x in cases:
+        # Modules are converted in place, so time NCHW first
+        with torch.set_grad_enabled(name == "dis forward+backward"):
+            t_nchw = time_it(lambda: fn(x), device, opts.iterations)
+            for model in (fn, gen, dis, adain):
+                if isinstance(model, torch.nn.Module):
+                    model.to(memory_format=channels_last)
+            x_nhwc = x.contiguous(memory_format=channels_last)
+            t_nhwc = time_it(lambda: fn(x_nhwc), device, opts.iterations)
+            for model in (fn, gen, dis, adain):
+                if isinstance(model, torch.nn.Module):
+                    model.to(memory_format=torch.contiguous_format)
+        print("--- %s ---" % name)
+        print_comparison("NCHW", t_nchw, "channels_last", t_nhwc)
+
+
+def bench_checkpointing(opts, device):
+    # Peak memory of a generator and a discriminator update with activation checkpointing in different places
+    from networks import FewShotGen, GPPatchMcResDis
+    release_freed_memory()
+    config = get_config(opts.config)
+    segments = opts.segments
+    configurations = [
+        ("none", 0, 0, 0),
+        ("dis", 0, 0, segments),
+        ("dis + content", segments, 0, segments),
+        ("dis + content + dec", segments, segments, segments),
+    ]
+    input_nc = config['gen']['input_nc']
+    xa = torch.randn(opts.batch_size, input_nc, opts.size, opts.size, device=device)
+    xb = torch.randn(opts.batch_size, input_nc, opts.size, opts.size, device=device)
+    la = torch.randint(config['dis']['num_classes'], (opts.batch_size,), device=device)
+    lb = torch.randint(config['dis']['num_classes'], (opts.batch_size,), device=device)
+
+    def gen_step(gen, dis):
+        # The losses of FUNITModel in 'gen_update' mode
+        c_xa = gen.enc_content(xa)
+        xt = gen.decode(c_xa, gen.enc_class_model(xb))
+        xr = gen.decode(c_xa, gen.enc_class_model(xa))
+        l_adv_t, _, xt_gan_feat = dis.calc_gen_loss(xt, lb)
+        l_adv_r, _, xr_gan_feat = dis.calc_gen_loss(xr, la)
+        _, xb_gan_feat = dis(xb, lb)
+        _, xa_gan_feat = dis(xa, la)
+        l_total = l_adv_t + l_adv_r + (xr - xa).abs().mean() + \
+            (xr_gan_feat.mean(3).mean(2) - xa_gan_feat.mean(3).mean(2)).abs().mean() + \
+            (xt_gan_feat.mean(3).mean(2) - xb_gan_feat.mean(3).mean(2)).abs().mean()
+        l_total.backward()
+
+    def dis_step(gen, dis):
+        # The losses of FUNITModel in 'dis_update' mode, including the R1 penalty
+        x = xb.clone().requires_grad_()
+        l_real, _, resp_r = dis.calc_dis_real_loss(x, lb)
+        l_real.backward(retain_graph=True)
+        (10 * dis.calc_grad2(resp_r, x)).backward()
+        with torch.no_grad():
+            xt = gen.decode(gen.enc_content(xa), gen.enc_class_model(xb))
+        dis.calc_dis_fake_loss(xt, lb)[0].backward()
+
+    peaks = {}
+    for name, content, dec, dis_segments in configurations:
+        hp_gen = dict(config['gen'], checkpoint_content=content, checkpoint_dec=dec)
+        hp_dis = dict(config['dis'], checkpoint_segments=dis_segments)
+        gen = FewShotGen(hp_gen).to(device)
+        dis = GPPatchMcResDis(hp_dis).to(device)
+        # One step first, so that the gradients are allocated before measuring
+        gen_step(gen, dis)
+        dis_step(gen, dis)
+        peaks[name] = (peak_memory(lambda: gen_step(gen, dis), device), peak_memory(lambda: dis_step(gen, dis), device))
+        del gen, dis
+    if peaks["none"][0] is None:
+        print("Peak memory is only measured on CUDA and on Linux")
+        return
+    print("batch size %d, %dx%d pixels, %d segments" % (opts.batch_size, opts.size, opts.size, segments))
+    print("%-22s %12s %12s %14s %14s" % ("checkpointing", "gen step", "dis step", "batch size", "resolution"))
+    budget = max(peaks["none"])
+    for name, peak in peaks.items():
+        # Activation memory grows linearly with the batch size and the number of pixels
+        ratio = budget / max(peak)
+        print("%-22s %9.1f MB %9.1f MB %14d %10dx%d" % (name, peak[0] / 2**20, peak[1] / 2**20,
+                                                         int(opts.batch_size * ratio),
+                                                         int(opts.size * math.sqrt(ratio)), int(opts.size * math.sqrt(ratio))))
+    print("batch size and resolution that fit into the peak memory without checkpointing")
+
+
+def training_setup(opts):
+    # Config and a random (content, class) batch for benchmarks of whole Trainer steps
+    config = get_config(opts.config)
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+    GlobalConstants.setOptimizer(config['optimizer'])
+    input_nc = config['gen']['input_nc']
+    num_classes = config['dis']['num_classes']
+    co_data = (torch.randn(opts.batch_size, input_nc, opts.size, opts.size),
+               torch.randint(num_classes, (opts.batch_size,)))
+    cl_data = (torch.randn(opts.batch_size, input_nc, opts.size, opts.size),
+               torch.randint(num_classes, (opts.batch_size,)))
+    return config, co_data, cl_data
+
+
+def bench_precision(opts, device):
+    # Step time and peak memory of Trainer.gen_update and Trainer.dis_update for every precision
+    from trainer import Trainer
+    release_freed_memory()
+    config, co_data, cl_data = training_setup(opts)
+    precisions = ["float32", "bfloat16"]
+    # float16 autocast runs on the CPU too, but only pays off with tensor cores
+    if device.type == 'cuda':
+        precisions.append("float16")
+
+    def step(trainer):
+        trainer.dis_update(co_data, cl_data, config, 0)
+        trainer.gen_update(co_data, cl_data, config, False, 0)
+
+    results = {}
+    for precision in precisions:
+        GlobalConstants.setPrecision(precision)
+        torch.manual_seed(0)
+        trainer = Trainer(config)
+        # One step first, so that the gradients and optimizer states are allocated before measuring
+        step(trainer)
+        results[precision] = (time_it(lambda: step(trainer), device, opts.iterations, 1),
+                              peak_memory(lambda: step(trainer), device))
+        del trainer
+    print("batch size %d, %dx%d pixels" % (opts.batch_size, opts.size, opts.size))
+    print("%-10s %12s %9s %12s %9s" % ("precision", "step", "speedup", "peak memory", "saving"))
+    base_time, base_memory = results["float32"]
+    for precision, (step_time, memory) in results.items():
+        if memory is None:
+            memory_columns = "%12s %9s" % ("-", "-")
+        else:
+            memory_columns = "%9.1f MB %8.1f%%" % (memory / 2**20, 100 * (1 - memory / base_memory))
+        print("%-10s %9.1f ms %8.2fx %s" % (precision, step_time, base_time / step_time, memory_columns))
+
+
+def bench_r1(opts, device):
+    # Step time and peak memory of Trainer.dis_update with the R1 penalty on every step and lazily
+    from trainer import Trainer
+    release_freed_memory()
+    config, co_data, cl_data = training_setup(opts)
+    GlobalConstants.setPrecision(config['precision'])
+    interval = opts.r1_interval
+    configurations = [
+        ("every step", 1, 1.0),
+        ("every step, half batch", 1, 0.5),
+        ("every %d steps" % interval, interval, 1.0),
+        ("every %d steps, half batch" % interval, interval, 0.5),
+    ]
+    torch.manual_seed(0)
+    trainer = Trainer(config)
+    results = {}
+    for name, r1_interval, r1_batch_fraction in configurations:
+        hp = dict(config, r1_interval=r1_interval, r1_batch_fraction=r1_batch_fraction)
+        steps = iter(range(10**9))
+
+        def step():
+            trainer.dis_update(co_data, cl_data, hp, next(steps))
+
+        # Whole intervals, so that every configuration is timed with its share of penalty steps
+        iterations = max(1, opts.iterations // r1_interval) * r1_interval
+        step_time = time_it(step, device, iterations, r1_interval)
+        # The peak is reached on the steps with the penalty, steps continues at a multiple of r1_interval
+        results[name] = (step_time, peak_memory(step, device))
+    print("batch size %d, %dx%d pixels" % (opts.batch_size, opts.size, opts.size))
+    print("%-28s %12s %9s %12s %9s" % ("R1 penalty", "dis step", "speedup", "peak memory", "saving"))
+    base_time, base_memory = results["every step"]
+    for name, (step_time, memory) in results.items():
+        if memory is None:
+            memory_columns = "%12s %9s" % ("-", "-")
+        else:
+            memory_columns = "%9.1f MB %8.1f%%" % (memory / 2**20, 100 * (1 - memory / base_memory))
+        print("%-28s %9.1f ms %8.2fx %s" % (name, step_time, base_time / step_time, memory_columns))
+
+
+def bench_dis_backward(opts, device):
+    # The single backward pass of FUNITModel in 'dis_update' mode vs. one backward pass per loss
+    from trainer import Trainer
+    release_freed_memory()
+    config, co_data, cl_data = training_setup(opts)
+    GlobalConstants.setPrecision("float32")
+    torch.manual_seed(0)
+    model = Trainer(config).model
+    gen, dis = model.gen, model.dis
+    xa = co_data[0].to(device)
+    lb = cl_data[1].to(device)
+
+    def separate_backward():
+        # The discriminator update before it was merged into one backward pass
+        xb = cl_data[0].to(device).requires_grad_()
+        l_real, _, resp_r = dis.calc_dis_real_loss(xb, lb)
+        (config['gan_w'] * l_real).backward(retain_graph=True)
+        (10 * dis.calc_grad2(resp_r, xb)).backward()
+        with torch.no_grad():
+            xt = gen.decode(gen.enc_content(xa), gen.enc_class_model(xb))
+        (config['gan_w'] * dis.calc_dis_fake_loss(xt, lb)[0]).backward()
+
+    def single_backward():
+        model(co_data, (cl_data[0].clone(), cl_data[1]), config, 'dis_update')
+
+    print("batch size %d, %dx%d pixels" % (opts.batch_size, opts.size, opts.size))
+    print("%-18s %12s %12s" % ("dis update", "step", "peak memory"))
+    for name, fn in (("backward per loss", separate_backward), ("single backward", single_backward)):
+        step_time = time_it(fn, device, opts.iterations, 1)
+        memory = peak_memory(fn, device)
+        print("%-18s %9.1f ms %s" % (name, step_time, "%9.1f MB" % (memory / 2**20) if memory is not None else "-"))
+
+
+def bench_ema(opts, device):
+    # Overhead per generator step of ModelAverage vs. the loop over named_parameters it replaced
+    from networks import FewShotGen
+    from utils import ModelAverage
+    config = get_config(opts.config)
+    torch.manual_seed(0)
+    gen = FewShotGen(config['gen']).to(device)
+
+    def update_average(model_tgt, model_src, beta=0.999):
+        with torch.no_grad():
+            param_dict_src = dict(model_src.named_parameters())
+            for p_name, p_tgt in model_tgt.named_parameters():
+                p_src = param_dict_src[p_name]
+                p_tgt.copy_(beta*p_tgt + (1. - beta)*p_src)
+
+    # The dtype is the one of the generator, e.g. with master_weights, the average is always float32
+    configurations = [("named_parameters loop", 1, None, None),
+                      ("ModelAverage", 1, None, None),
+                      ("ModelAverage, interval 4", 4, None, None),
+                      ("ModelAverage, bfloat16 gen", 1, torch.bfloat16, None)]
+    if device.type == 'cuda':
+        configurations.append(("ModelAverage, on the CPU", 1, None, torch.device('cpu')))
+    print("%-28s %12s %14s" % ("EMA", "per step", "gen_test size"))
+    for name, interval, dtype, average_device in configurations:
+        gen_test = copy.deepcopy(gen)
+        if name == "named_parameters loop":
+            fn = lambda: update_average(gen_test, gen)
+        else:
+            source = gen if dtype is None else copy.deepcopy(gen).to(dtype)
+            model_average = ModelAverage(gen_test, source, interval=interval, device=average_device)
+            steps = iter(range(10**9))
+            fn = lambda: model_average.update(next(steps))
+        size = sum(t.numel() * t.element_size() for t in gen_test.state_dict().values())
+        location = "" if average_device is None else " (%s)" % average_device.type
+        print("%-28s %9.3f ms %11.1f MB%s" % (name, time_it(fn, device, opts.iterations * 5, 4), size / 2**20, location))
+
+
+def bench_optimizer(opts, device):
+    # Step time of MasterWeightOptimizer on the generator parameters vs. torch.optim and a per-parameter loop
+    from networks import FewShotGen
+    from customOptimizers import MasterWeightOptimizer
+    config = get_config(opts.config)
+    torch.manual_seed(0)
+    gen = FewShotGen(config['gen']).to(device)
+
+    def with_gradients(model, dtype):
+        model = copy.deepcopy(model).to(dtype)
+        for p in model.parameters():
+            p.grad = torch.randn_like(p) * 1e-3
+        return list(model.parameters())
+
+    def adam_loop(params, master, state, lr=1e-3, beta1=0.9, beta2=0.999, eps=1e-8):
+        # Adam on float32 copies of half precision parameters, one parameter at a time
+        for p, m, (exp_avg, exp_avg_sq) in zip(params, master, state):
+            grad = p.grad.float()
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            m.addcdiv_(exp_avg, exp_avg_sq.sqrt().add_(eps), value=-lr)
+            p.data = m.to(p.dtype)
+
+    half_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    print("%-36s %12s %24s" % ("Adam step", "per step", "weights + grads + state"))
+    params = with_gradients(gen, half_dtype)
+    master = [p.detach().float() for p in params]
+    state = [(torch.zeros_like(m), torch.zeros_like(m)) for m in master]
+    memory = sum(t.numel() * t.element_size()
+                 for t in params + [p.grad for p in params] + master + [s for pair in state for s in pair])
+    configurations = [("per-parameter loop, %s" % str(half_dtype)[6:],
+                       lambda: adam_loop(params, master, state), memory)]
+    for dtype in (torch.float32, half_dtype):
+        params_opt = with_gradients(gen, dtype)
+        if dtype == torch.float32:
+            opt = torch.optim.Adam(params_opt, lr=1e-3)
+            name = "torch.optim.Adam, float32"
+        else:
+            opt = MasterWeightOptimizer(params_opt, 'Adam', lr=1e-3)
+            name = "MasterWeightOptimizer, %s" % str(dtype)[6:]
+        opt.step()
+        state_tensors = [t for s in opt.state.values() for t in s.values() if torch.is_tensor(t)]
+        state_tensors += [t for flat in getattr(opt, 'flat', []) for t in flat.values() if torch.is_tensor(t)]
+        state_tensors += [t for work in getattr(opt, 'work', {}).values() for t in work]
+        memory = sum(t.numel() * t.element_size() for t in params_opt + [p.grad for p in params_opt] + state_tensors)
+        configurations.append((name, opt.step, memory))
+    for name, fn, memory in configurations:
+        print("%-36s %9.3f ms %21.1f MB" % (name, time_it(fn, device, opts.iterations, 3), memory / 2**20))
+
+
+def distributed_step(trainer, co_data, cl_data, config):
+    trainer.dis_update(co_data, cl_data, config, 0)
+    trainer.gen_update(co_data, cl_data, config, False, 0)
+
+
+def distributed_worker(rank, opts, world_size, port, results_dir):
+    # One process of bench_distributed, trains on its shard of the batch of all processes
+    from trainer import Trainer
+    from distributedUtils import init_distributed, cpu_threads_per_process
+    release_freed_memory()
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), LOCAL_RANK=str(rank),
+                      WORLD_SIZE=str(world_size), LOCAL_WORLD_SIZE=str(world_size))
+    GlobalConstants.setDevice(init_distributed('cpu'), opts.num_threads or cpu_threads_per_process())
+    GlobalConstants.setPrecision("float32")
+    torch.manual_seed(0)
+    config, co_data, cl_data = training_setup(argparse.Namespace(**dict(vars(opts), batch_size=opts.batch_size * world_size)))
+    co_data, cl_data = [tuple(t.chunk(world_size)[rank] for t in data) for data in (co_data, cl_data)]
+    trainer = Trainer(config)
+    step_time = time_it(lambda: distributed_step(trainer, co_data, cl_data, config), GlobalConstants.getDevice(),
+                        opts.iterations, 1)
+    torch.save(step_time, os.path.join(results_dir, '%d.pt' % rank))
+    torch.distributed.destroy_process_group()
+
+
+def bench_distributed(opts, device):
+    # The step time with --processes CPU processes on shards of a batch vs. one process on the whole batch
+    import torch.multiprocessing as mp
+    from trainer import Trainer
+    release_freed_memory()
+    world_size = opts.processes
+    full_opts = argparse.Namespace(**dict(vars(opts), batch_size=opts.batch_size * world_size))
+    GlobalConstants.setPrecision("float32")
+    torch.manual_seed(0)
+    config, co_data, cl_data = training_setup(full_opts)
+    trainer = Trainer(config)
+    single_time = time_it(lambda: distributed_step(trainer, co_data, cl_data, config), device, opts.iterations, 1)
+    del trainer
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    with tempfile.TemporaryDirectory() as results_dir:
+        mp.spawn(distributed_worker, args=(opts, world_size, port, results_dir), nprocs=world_size)
+        distributed_time = torch.load(os.path.join(results_dir, '0.pt'))
+    print("batch size %d per process, %dx%d pixels" % (opts.batch_size, opts.size, opts.size))
+    print_comparison("1 process, batch size %d" % full_opts.batch_size, single_time,
+                     "%d processes" % world_size, distributed_time)
+
+
+def bench_compile(opts, device):
+    # Compile time vs. steady state speedup of torch.compile, for gen_test translating and for training steps
+    import torch._dynamo
+    from networks import FewShotGen
+    from trainer import Trainer
+    config, co_data, cl_data = training_setup(opts)
+    GlobalConstants.setPrecision(config['precision'])
+    mode = config.get('compile', {}).get('mode', 'default')
+    xa, xb = co_data[0].to(device), cl_data[0].to(device)
+
+    def first_and_steady(fn, first_calls):
+        # Wall time of the first calls, which build the graphs, and the steady state time per call
+        synchronize(device)
+        start = time.perf_counter()
+        for i in range(first_calls):
+            fn()
+        synchronize(device)
+        return (time.perf_counter() - start) * 1000, time_it(fn, device, opts.iterations, 0)
+
+    def report(name, eager, compiled, first_calls):
+        (eager_first, eager_time), (compiled_first, compiled_time) = eager, compiled
+        compile_time = compiled_first - first_calls * compiled_time
+        saving = eager_time - compiled_time
+        print("%-10s %12.1f ms %12.1f ms %9.2fx %11.1f s %s" % (
+            name, eager_time, compiled_time, eager_time / compiled_time, compile_time / 1000,
+            "%12d" % math.ceil(compile_time / saving) if saving > 0 else "%12s" % "never"))
+
+    torch.manual_seed(0)
+    gen = FewShotGen(config['gen']).to(device).eval()
+    gen_compiled = copy.deepcopy(gen).compile_submodules(mode)
+
+    def translate(g):
+        with torch.no_grad():
+            return g.decode(g.enc_content(xa), g.enc_class_model(xb))
+
+    torch._dynamo.reset()
+    torch._dynamo.utils.counters.clear()
+    inference = [first_and_steady(lambda: translate(g), 1) for g in (gen, gen_compiled)]
+    del gen, gen_compiled
+
+    # Whole intervals, so that the discriminator graphs with and without the R1 penalty are built
+    hp = dict(config, r1_interval=opts.r1_interval)
+    training = []
+    for enabled in (False, True):
+        torch.manual_seed(0)
+        trainer = Trainer(dict(config, compile=dict(config.get('compile', {}), enabled=enabled)))
+        steps = iter(range(10**9))
+
+        def step():
+            it = next(steps)
+            trainer.dis_update(co_data, cl_data, hp, it)
+            trainer.gen_update(co_data, cl_data, hp, False, it)
+
+        start = time.perf_counter()
+        step()
+        first_step = (time.perf_counter() - start) * 1000
+        first, steady = first_and_steady(step, opts.r1_interval - 1)
+        training.append((first_step + first, steady))
+        del trainer
+    print("graph breaks: %d" % sum(torch._dynamo.utils.counters['graph_break'].values()))
+
+    print("batch size %d, %dx%d pixels, mode %s, R1 every %d steps" % (
+        opts.batch_size, opts.size, opts.size, mode, opts.r1_interval))
+    print("%-10s %15s %15s %10s %13s %12s" % ("", "eager", "compiled", "speedup", "compile time", "break-even"))
+    report("inference", *inference, 1)
+    report("training", *training, opts.r1_interval)
+
+
+def bench_adain_cache(opts, device):
+    # Translates batches of content images to a few fixed classes, like a bulk job, with and without the cache
+    from networks import FewShotGen
+    config = get_config(opts.config)
+    gen = FewShotGen(config['gen']).to(device).eval()
+    x = torch.randn(opts.batch_size, config['gen']['input_nc'], opts.size, opts.size, device=device)
+    classes = 4
+    with torch.no_grad():
+        class_codes = [gen.enc_class_model(torch.randn_like(x[:1])).expand(x.size(0), -1, -1, -1)
+                       for c in range(classes)]
+        content = gen.enc_content(x)
+        gen.enable_adain_cache(classes)
+
+        print("--- mlp of one class code ---")
+        mlp_time = time_it(lambda: gen.mlp(class_codes[0]), device, opts.iterations)
+        lookup_time = time_it(lambda: gen.adain_cache(gen.mlp, class_codes[0]), device, opts.iterations)
+        hash_time = time_it(lambda: gen.adain_cache(gen.mlp, class_codes[0].clone()), device, opts.iterations)
+        print_comparison("mlp", mlp_time, "cache, identity", lookup_time)
+        print("%-24s %10.3f ms" % ("cache, hash", hash_time))
+
+        print("--- decode of a batch, %d classes in turn ---" % classes)
+        step = [0]
+        def decode():
+            step[0] += 1
+            return gen.decode(content, class_codes[step[0] % classes])
+        gen.adain_cache = None
+        t_mlp = time_it(decode, device, opts.iterations)
+        gen.enable_adain_cache(classes)
+        t_cached = time_it(decode, device, opts.iterations)
+        print_comparison("mlp", t_mlp, "cached", t_cached)
+        print(gen.adain_cache)
+
+
+def bench_matrix(opts, device):
+    # Every content image into every class: one enc_content per pair like translate_simple vs. translate_matrix
+    from networks import FewShotGen
+    from inference import translate_matrix
+    config = get_config(opts.config)
+    torch.manual_seed(0)
+    gen = FewShotGen(config['gen']).to(device).eval()
+    contents = torch.randn(opts.batch_size, config['gen']['input_nc'], opts.size, opts.size)
+    with torch.no_grad():
+        class_codes = gen.enc_class_model(torch.randn(opts.classes, *contents.shape[1:], device=device))
+
+    def pairwise():
+        with torch.no_grad():
+            return torch.stack([torch.cat([gen.decode(gen.enc_content(x.unsqueeze(0).to(device)), code.unsqueeze(0))
+                                           for code in class_codes]).cpu() for x in contents])
+
+    print("%d content images x %d classes, %dx%d pixels" % (opts.batch_size, opts.classes, opts.size, opts.size))
+    print_comparison("per pair", time_it(pairwise, device, opts.iterations, 1),
+                     "matrix", time_it(lambda: translate_matrix(gen, contents, class_codes, opts.batch_size),
+                                       device, opts.iterations, 1))
+
+
+def bench_otsu(opts, device):
+    # metrics.py on a batch of translation-like images vs. utils.otsu_iou with skimage one image at a time
+    from utils import otsu_iou
+    from metrics import otsu_iou_batch
+    torch.manual_seed(0)
+    fake = torch.tanh(torch.randn(opts.batch_size, opts.size, opts.size) * 2)
+    real = torch.tanh(torch.randn(opts.batch_size, opts.size, opts.size) * 2 + 0.3)
+    fake_np, real_np = fake.numpy(), real.numpy()
+    print("%d images, %dx%d pixels" % (opts.batch_size, opts.size, opts.size))
+    fake, real = fake.to(device), real.to(device)
+    print_comparison("skimage per image", time_it(lambda: [otsu_iou(f, r) for f, r in zip(fake_np, real_np)],
+                                                  torch.device('cpu'), opts.iterations, 1),
+                     "batched", time_it(lambda: otsu_iou_batch(fake, real), device, opts.iterations, 1))
+
+
+def bench_server(opts, device):
+    # Concurrent clients on localhost against server.py, one image per batch vs. dynamic batches of up to batch_size
+    import io
+    import json
+    import threading
+    import urllib.request
+    import numpy as np
+    from PIL import Image
+    from networks import FewShotGen
+    from utils import get_test_transform
+    from server import TranslationService, create_server
+    config = get_config(opts.config)
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+    torch.manual_seed(0)
+    gen = FewShotGen(config['gen']).to(device).eval().enable_adain_cache()
+    rng = np.random.RandomState(0)
+    mode = 'L' if config['gen']['input_nc'] == 1 else 'RGB'
+    # data.preprocess_custom scales images below 256 pixels up, the server crops them to size
+    side = max(256, opts.size)
+    shape = (side, side) if mode == 'L' else (side, side, 3)
+    images = []
+    for i in range(opts.clients + 2):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.randint(0, 256, shape).astype(np.uint8), mode).save(buffer, format='PNG')
+        images.append(buffer.getvalue())
+    content_images, class_images = images[:-2], images[-2:]
+
+    def post(address, path, data):
+        url = 'http://%s:%d%s' % (address[0], address[1], path)
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, method='POST')) as response:
+            return response.read()
+
+    for max_batch_size, max_latency in ((1, 0), (opts.batch_size, 0.02)):
+        service = TranslationService(gen, get_test_transform(opts.size), max_batch_size, max_latency)
+        server = create_server(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        address = server.server_address
+        for c, class_image in enumerate(class_images):
+            post(address, '/classes?class_id=%d' % c, class_image)
+        outputs = {}
+
+        def client(i):
+            for it in range(opts.iterations):
+                outputs[i, it] = post(address, '/translate?class_id=%d' % ((i + it) % 2), content_images[i])
+
+        start = time.perf_counter()
+        clients = [threading.Thread(target=client, args=(i,)) for i in range(opts.clients)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        elapsed = time.perf_counter() - start
+        metrics = json.loads(urllib.request.urlopen('http://%s:%d/metrics' % address).read())
+        server.shutdown()
+        server.server_close()
+        service.batcher.close()
+
+        print("--- max batch size %d, latency window %d ms ---" % (max_batch_size, max_latency * 1000))
+        print("%d clients, %d requests: %.2f requests/sec, mean batch size %.2f" % (
+            opts.clients, metrics['requests'], metrics['requests'] / elapsed, metrics['mean_batch_size']))
+        print("latency mean %.1f ms, p50 %.1f ms, p95 %.1f ms, queue mean %.1f ms" % (
+            metrics['latency_ms']['mean'], metrics['latency_ms']['p50'], metrics['latency_ms']['p95'],
+            metrics['queue_ms']['mean']))
+
+
+BENCHMARKS = {
+    'inception': bench_inception,
+    'fuse': bench_fuse,
+    'export': bench_export,
+    'channels_last': bench_channels_last,
+    'checkpointing': bench_checkpointing,
+    'precision': bench_precision,
+    'r1': bench_r1,
+    'dis_backward': bench_dis_backward,
+    'ema': bench_ema,
+    'optimizer': bench_optimizer,
+    'distributed': bench_distributed,
+    'compile': bench_compile,
+    'adain_cache': bench_adain_cache,
+    'matrix': bench_matrix,
+    'otsu': bench_otsu,
+    'server': bench_server,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark',
+                        choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--config',
+                        type=str,
+                        default='configs/funit_B022.yaml')
+    parser.add_argument('--device',
+                        type=str,
+                        default='auto')
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=0)
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=8)
+    parser.add_argument('--dim',
+                        type=int,
+                        default=64)
+    parser.add_argument('--size',
+                        type=int,
+                        default=64)
+    parser.add_argument('--segments',
+                        type=int,
+                        default=4)
+    parser.add_argument('--r1_interval',
+                        type=int,
+                        default=4)
+    parser.add_argument('--iterations',
+                        type=int,
+                        default=20)
+    parser.add_argument('--processes',
+                        type=int,
+                        default=2)
+    parser.add_argument('--clients',
+                        type=int,
+                        default=8)
+    parser.add_argument('--classes',
+                        type=int,
+                        default=4)
+    opts = parser.parse_args()
+    GlobalConstants.setDevice(opts.device, opts.num_threads)
+    BENCHMARKS[opts.benchmark](opts, GlobalConstants.getDevice())
@@ -96,9 +96,6 @@ class ActFirstResBlock(nn.Module):
         dx = self.conv_0(x)
         dx = self.conv_1(dx)
         out = x_s + dx
-        generaldebug.checkForNaNandInf(x_s)
-        generaldebug.checkForNaNandInf(dx)
-        generaldebug.checkForNaNandInf(out)
         #print("FORWARD ACTFIRST DONE")
         return out
 
@@ -186,7 +183,7 @@ class Conv2dBlock(nn.Module):
         if norm == 'bn':
             self.norm = nn.BatchNorm2d(norm_dim)
         elif norm == 'in':
-            self.norm = nn.InstanceNorm2d(norm_dim)
+            self.norm = InstanceNorm2d(norm_dim)
         elif norm == 'adain':
             self.norm = AdaptiveInstanceNorm2d(norm_dim)
         elif norm == 'none':
@@ -234,8 +231,26 @@ class Conv2dBlock(nn.Module):
             if self.activation:
                 x = self.activation(x)
                 #debug.checkForNaNandInf(x,msg="5F")
-        DebugNet.safeImage(x)
         return x
+
+    def fuse(self, max_flop_ratio=1.0):
+        """
+        Rewrites the block in place into an equivalent but cheaper one, only meant for inference.
+        Zero padding moves into the convolution, and the convolution bias is dropped in front of
+        instance normalization since that removes the per-channel mean anyway.
+        """
+        conv = self.conv
+        padding = conv.padding
+        if isinstance(self.pad, nn.ZeroPad2d):
+            left, right, top, bottom = self.pad.padding
+            if (left == right and top == bottom):
+                padding = (conv.padding[0] + top, conv.padding[1] + left)
+                self.pad = nn.Identity()
+        bias = conv.bias
+        if isinstance(self.norm, AdaptiveInstanceNorm2d) or \
+                (isinstance(self.norm, nn.InstanceNorm2d) and not self.norm.track_running_stats):
+            bias = None
+        self.conv = conv_from_weights(conv.weight, bias, conv.stride, padding, conv.padding_mode)
     
     def printgradnorm(self, cls, grad_input, grad_output):
         print('Inside ' + cls.__class__.__name__ + ' backward')
@@ -272,26 +287,22 @@ class AdaptiveInstanceNorm2d(nn.Module):
         assert self.weight is not None and \
                self.bias is not None, "Please assign AdaIN weight first"
         b, c = x.size(0), x.size(1)
-        running_mean = self.running_mean.repeat(b)
-        running_var = self.running_var.repeat(b)
-        x_reshaped = x.contiguous().view(1, b * c, *x.size()[2:])
-
-        isNotFloat = (x_reshaped.dtype != torch.float32)
-        isNotFloatWeight = (self.weight.dtype != torch.float32)
-        if (isNotFloat):
-            x_reshaped = x_reshaped.float()
-            if (isNotFloatWeight): #Should never be called since initialized as float()
-                self.weight = self.weight.float()
-                self.bias = self.bias.float()
+        if is_channels_last(x):
+            # The reshape below would copy x to NCHW, the running statistics are never updated anyway
+            out = instance_norm_channels_last(x.float(), self.weight.view(b, c, 1, 1),
+                                              self.bias.view(b, c, 1, 1), self.eps)
+            return out.to(x.dtype)
+        running_mean = self.running_mean.float().repeat(b)
+        running_var = self.running_var.float().repeat(b)
+        # The statistics are computed in float32, under autocast x may come in as float16 or bfloat16
+        x_reshaped = x.contiguous().view(1, b * c, *x.size()[2:]).float()
         out = F.batch_norm(
-            x_reshaped, running_mean, running_var, self.weight, self.bias,
+            x_reshaped, running_mean, running_var, self.weight.float(), self.bias.float(),
             True, self.momentum, self.eps)
         #debug.checkForNaNandInf(out)
         out = out.view(b, c, *x.size()[2:])
         #debug.checkForNaNandInf(out)
-        if (isNotFloat):
-            out = GlobalConstants.setTensorToPrecision(out)
-        return out
+        return out.to(x.dtype)
 
     def __repr__(self):
         return self.__class__.__name__ + '(' + str(self.num_features) + ')'
@@ -311,6 +322,34 @@ class AdaptiveInstanceNorm2d(nn.Module):
         print('grad_output_max:', grad_output[0].max(), 'grad_output_min:', grad_output[0].min())
         #print(grad_output)
 
+class InstanceNorm2d(nn.InstanceNorm2d):
+    # nn.InstanceNorm2d that keeps channels_last inputs in their memory format
+    def forward(self, x):
+        if not is_channels_last(x) or self.track_running_stats:
+            return super(InstanceNorm2d, self).forward(x)
+        c = x.size(1)
+        return instance_norm_channels_last(x, self.weight.view(1, c, 1, 1) if self.affine else None,
+                                           self.bias.view(1, c, 1, 1) if self.affine else None, self.eps)
+
+
+def is_channels_last(x):
+    # Tensors with one channel or one pixel are contiguous in both formats, for them the default kernels are fine
+    return x.dim() == 4 and x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous()
+
+
+def instance_norm_channels_last(x, weight=None, bias=None, eps=1e-5):
+    """
+    Instance normalization from elementwise ops, which keep the channels_last layout of x.
+    The instance norm kernels go through batch_norm on a reshaped NCHW tensor and would convert x.
+    weight and bias have to broadcast against x.
+    """
+    var, mean = torch.var_mean(x, dim=(2, 3), correction=0, keepdim=True)
+    out = (x - mean) * torch.rsqrt(var + eps)
+    if weight is not None:
+        out = out * weight + bias
+    return out
+
+
 class InceptionBlock(Conv2dBlock):
     """
     Is a copy of a copy of Conv2dBlock, but with Inception layers
@@ -335,7 +374,11 @@ class InceptionBlock(Conv2dBlock):
         """
         self.pad_type = pad_type
         self.use_bias = use_bias
+        self.kernels = kernels
         self.inceptionThreads = nn.ModuleList()
+        self.branch_dims = []
+        # Set by fuse(), afterwards inceptionThreads only hold what follows the shared convolution
+        self.fused_lead = None
         layers_3Conv=int(out_dim*0.5)
         remaining_out_dim = out_dim - layers_3Conv
         layers_5Conv=int(out_dim*0.25)
@@ -347,6 +390,7 @@ class InceptionBlock(Conv2dBlock):
         for size in kernels:
             if (size == 1):
                 self.inceptionThreads.append(nn.Conv2d(in_dim, layers_1Conv, 1, 1, bias=self.use_bias))
+                self.branch_dims.append(layers_1Conv)
             elif (size == 3):
                 intermediate_dim = int(out_dim*0.75)
                 conv = [
@@ -355,6 +399,7 @@ class InceptionBlock(Conv2dBlock):
                     #nn.Conv2d(intermediate_dim, layers_3Conv, 3, 1, bias=self.use_bias, padding=1)
                 ]
                 self.inceptionThreads.append(nn.Sequential(*conv))
+                self.branch_dims.append(layers_3Conv)
             elif (size == 5):
                 intermediate_dim = int(out_dim*0.5)
                 conv = [
@@ -364,12 +409,14 @@ class InceptionBlock(Conv2dBlock):
                     #nn.Conv2d(intermediate_dim, layers_5Conv, 5, 1, bias=self.use_bias, padding=2)
                 ]
                 self.inceptionThreads.append(nn.Sequential(*conv))
+                self.branch_dims.append(layers_5Conv)
             elif (size == "max_pooling"):
                 conv = [
                     nn.MaxPool2d(3, 1, padding=1),
                     nn.Conv2d(in_dim, remaining_out_dim, 1, 1, bias=self.use_bias)
                 ]
                 self.inceptionThreads.append(nn.Sequential(*conv))
+                self.branch_dims.append(remaining_out_dim)
 
     def forward(self, x, log=False):
         #print("BLOCKS, INCEPTIONBLOCK: BE AWARE THAT THE CONV2DBLOCK DIDN'T PAD AS MUCH AS THIS ONE")
@@ -388,16 +435,91 @@ class InceptionBlock(Conv2dBlock):
         return x
 
     def inceptionForward(self, x):
-        results = []
-        res = None
-        for thread in self.inceptionThreads:
-            y = thread(x)
-            if res is None:
-                res = y
+        """
+        Every branch writes into its channels of one preallocated output.
+        After fuse() the branches that start with a 1x1 convolution on x share a single convolution,
+        its output is split and the branches continue from their slice. Before, every branch runs on x.
+        On the GPU the branches run on their own streams.
+        """
+        if self.fused_lead is not None:
+            shared = torch.split(self.fused_lead(x), self.fused_lead_dims, dim=1)
+
+        memory_format = torch.channels_last if is_channels_last(x) else torch.contiguous_format
+        out = torch.empty(x.size(0), sum(self.branch_dims), x.size(2), x.size(3),
+                          dtype=x.dtype, device=x.device, memory_format=memory_format)
+        streams = inception_streams(x.device, len(self.inceptionThreads)) if x.is_cuda else None
+        if streams is not None:
+            current = torch.cuda.current_stream(x.device)
+        offset = 0
+        lead_index = 0
+        for i, (size, thread, dim) in enumerate(zip(self.kernels, self.inceptionThreads, self.branch_dims)):
+            if (self.fused_lead is None or size == "max_pooling"):
+                y = x
             else:
-                res = torch.cat((res, y), dim=1)
-            results += y
-        return res
+                y = shared[lead_index]
+                lead_index += 1
+            if streams is None:
+                out[:, offset:offset + dim] = thread(y)
+            else:
+                streams[i].wait_stream(current)
+                # y was allocated on the current stream, keep its memory alive until the branch is done
+                y.record_stream(streams[i])
+                with torch.cuda.stream(streams[i]):
+                    out[:, offset:offset + dim] = thread(y)
+            offset += dim
+        if streams is not None:
+            for stream in streams:
+                current.wait_stream(stream)
+        return out
+
+    def inceptionForwardSequential(self, x):
+        # Unfused reference for inceptionForward, runs the branches one after another. Not valid after fuse()
+        return torch.cat([thread(x) for thread in self.inceptionThreads], dim=1)
+
+    def fuse(self, max_flop_ratio=1.0):
+        """
+        Rewrites the branches in place into fewer, denser convolutions, only meant for inference.
+        The first convolutions of all branches on x are always merged into one convolution.
+        Optionally ParallelConv2dBlocks become single 3x3 convolutions and a leading 1x1 convolution
+        is folded into the convolution after it. Both save kernels but can cost more multiply-adds,
+        so the variant with the fewest convolutions within max_flop_ratio times the multiply-adds
+        of the unfolded block is used.
+        """
+        if self.fused_lead is not None or not any(size != "max_pooling" for size in self.kernels):
+            return
+        candidates = [self.fusedBranches(fold, merge_parallel)
+                      for fold in (False, True) for merge_parallel in (False, True)]
+        budget = max_flop_ratio * count_macs(candidates[0])
+        candidates = [c for c in candidates if count_macs(c) <= budget] or candidates[:1]
+        lead, tails = min(candidates, key=lambda c: (count_convs(c), count_macs(c)))
+        self.fused_lead_dims = list(lead.split_dims)
+        self.fused_lead = lead
+        self.inceptionThreads = tails
+
+    def fusedBranches(self, fold, merge_parallel):
+        # Returns the merged leading convolution and what follows it in each branch
+        branches = []
+        for size, thread in zip(self.kernels, self.inceptionThreads):
+            layers = list(thread) if isinstance(thread, nn.Sequential) else [thread]
+            if merge_parallel:
+                layers = [layer.fused() if isinstance(layer, ParallelConv2dBlock) else layer for layer in layers]
+            if (fold and size != "max_pooling"):
+                layers = fold_conv_chain(layers)
+            branches.append(layers)
+        leads = [layers[0] for size, layers in zip(self.kernels, branches) if size != "max_pooling"]
+        tails = nn.ModuleList([nn.Sequential(*(layers if size == "max_pooling" else layers[1:]))
+                               for size, layers in zip(self.kernels, branches)])
+        return merge_parallel_convs(leads), tails
+
+
+inception_stream_cache = {}
+
+def inception_streams(device, count):
+    # Side streams are shared by all InceptionBlocks on a device, streams can't be deep-copied with the modules
+    key = (device, count)
+    if key not in inception_stream_cache:
+        inception_stream_cache[key] = [torch.cuda.Stream(device=device) for i in range(count)]
+    return inception_stream_cache[key]
 
 class ParallelConv2dBlock(nn.Module):
     def __init__(self, in_dim, out_dim, kernel_size, stride, bias=True, padding_mode='zeros'):
@@ -414,6 +536,97 @@ class ParallelConv2dBlock(nn.Module):
         r = self.right(x)
         return torch.cat((l,r), dim=1)
 
+    def fused(self):
+        # One 3x3 convolution, the 1x3 kernels fill its middle row and the 3x1 kernels its middle column
+        left, right = self.left, self.right
+        weight = left.weight.new_zeros(left.out_channels + right.out_channels, left.in_channels, 3, 3)
+        weight[:left.out_channels, :, 1:2, :] = left.weight
+        weight[left.out_channels:, :, :, 1:2] = right.weight
+        bias = torch.cat((left.bias, right.bias)) if left.bias is not None else None
+        return conv_from_weights(weight, bias, 1, 1, left.padding_mode)
+
+
+def conv_from_weights(weight, bias, stride, padding, padding_mode='zeros'):
+    conv = nn.Conv2d(weight.size(1), weight.size(0), tuple(weight.shape[2:]), stride, padding,
+                     padding_mode=padding_mode, bias=bias is not None)
+    conv = conv.to(device=weight.device, dtype=weight.dtype)
+    with torch.no_grad():
+        conv.weight.copy_(weight)
+        if bias is not None:
+            conv.bias.copy_(bias)
+    return conv
+
+
+def fold_convs(first, second):
+    """
+    Returns one convolution computing second(first(x)) if first is a 1x1 convolution, None otherwise.
+    With zero padding the bias of first can't be folded, since second pads with zeros
+    where the folded convolution would see the bias.
+    """
+    if not (isinstance(first, nn.Conv2d) and isinstance(second, nn.Conv2d)):
+        return None
+    if (first.kernel_size != (1, 1) or first.stride != (1, 1) or first.padding != (0, 0)
+            or first.groups != 1 or second.groups != 1 or second.dilation != (1, 1)):
+        return None
+    if (first.bias is not None and second.padding_mode == 'zeros' and second.padding != (0, 0)):
+        return None
+    weight = torch.einsum('omhw,mi->oihw', second.weight, first.weight[:, :, 0, 0])
+    bias = second.bias
+    if first.bias is not None:
+        folded_bias = torch.einsum('omhw,m->o', second.weight, first.bias)
+        bias = folded_bias if bias is None else bias + folded_bias
+    return conv_from_weights(weight, bias, second.stride, second.padding, second.padding_mode)
+
+
+def fold_conv_chain(layers):
+    layers = list(layers)
+    i = 0
+    while (i < len(layers) - 1):
+        folded = fold_convs(layers[i], layers[i + 1])
+        if folded is None:
+            i += 1
+        else:
+            layers[i:i + 2] = [folded]
+    return layers
+
+
+def merge_parallel_convs(convs):
+    """
+    Returns one convolution computing torch.cat([conv(x) for conv in convs], dim=1).
+    The convolutions must have stride 1 and keep the size, smaller kernels are zero-padded to the largest one.
+    """
+    kh = max(conv.kernel_size[0] for conv in convs)
+    kw = max(conv.kernel_size[1] for conv in convs)
+    padding_modes = set(conv.padding_mode for conv in convs if conv.kernel_size != (1, 1))
+    assert len(padding_modes) <= 1, "Can't merge convolutions with different padding modes"
+    padding_mode = padding_modes.pop() if padding_modes else 'zeros'
+    weight = convs[0].weight.new_zeros(sum(conv.out_channels for conv in convs), convs[0].in_channels, kh, kw)
+    use_bias = any(conv.bias is not None for conv in convs)
+    bias = weight.new_zeros(weight.size(0)) if use_bias else None
+    offset = 0
+    for conv in convs:
+        h, w = conv.kernel_size
+        assert conv.stride == (1, 1) and conv.padding == ((h - 1) // 2, (w - 1) // 2), \
+            "Can only merge convolutions that keep the size"
+        top, left = (kh - h) // 2, (kw - w) // 2
+        weight[offset:offset + conv.out_channels, :, top:top + h, left:left + w] = conv.weight
+        if conv.bias is not None:
+            bias[offset:offset + conv.out_channels] = conv.bias
+        offset += conv.out_channels
+    merged = conv_from_weights(weight, bias, 1, ((kh - 1) // 2, (kw - 1) // 2), padding_mode)
+    merged.split_dims = tuple(conv.out_channels for conv in convs)
+    return merged
+
+
+def count_convs(modules):
+    return sum(1 for module in modules for m in module.modules() if isinstance(m, nn.Conv2d))
+
+
+def count_macs(modules):
+    # Multiply-adds per output pixel, all convolutions in an InceptionBlock keep the size
+    return sum(m.out_channels * m.in_channels // m.groups * m.kernel_size[0] * m.kernel_size[1]
+               for module in modules for m in module.modules() if isinstance(m, nn.Conv2d))
+
 class Printer(nn.Module):
     def __init__(self, perma_save_counter = 10000, running_save_counter = 100):
         super(Printer, self).__init__()
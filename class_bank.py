@@ -0,0 +1,240 @@
+"""
+Encodes class image folders once per checkpoint and keeps the class codes in a bank on disk, so that
+test_k_shot.py and acc_test.py don't run enc_class_model on the same exemplars for every translation.
+    <bank_dir>/<checkpoint hash>/<folder hash>.npy         mean class code of all images of the folder, (1, latent_dim, 1, 1)
+    <bank_dir>/<checkpoint hash>/<folder hash>_adain.npy   AdaIN parameters the MLP computes from it (only with --adain)
+    <bank_dir>/<checkpoint hash>/index.json                folder, number of images and files of every entry
+The checkpoint hash is over the checkpoint file, the folder hash over the names and bytes of the images,
+the name of the folder (default_loader_custom preprocesses by class name) and desired_size, so a changed
+checkpoint or exemplar gets a new entry instead of a stale code. The .npy files are loaded memory mapped.
+Both hashes are cached by path, size and modification time, in <bank_dir>/checkpoints.json and
+<bank_dir>/folders.json, so looking up a folder that hasn't changed doesn't read its images again.
+
+USE FOLLOWING COMMAND TO EXECUTE:
+python class_bank.py --config configs/funit_B022.yaml --ckpt pretrained/gen_00470000.pt --bank_dir class_bank --class_image_folders images/n02138411
+python test_k_shot.py --config configs/funit_B022.yaml --ckpt pretrained/gen_00470000.pt --class_bank class_bank --class_image_folder images/n02138411 --input images/input_content.jpg --output images/output.jpg
+"""
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import torch
+
+from globalConstants import GlobalConstants
+from utils import get_config, get_test_transform
+from data import default_loader_custom
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+HASH_LENGTH = 16
+CHUNK_SIZE = 1 << 20
+
+
+def list_class_images(folder):
+    # The images of a class folder in a fixed order, subfolders are not included
+    return sorted(os.path.join(folder, name) for name in next(os.walk(folder))[2]
+                  if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def update_file_hash(sha, path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    update_file_hash(sha, path)
+    return sha.hexdigest()[:HASH_LENGTH]
+
+
+def folder_hash(paths, desired_size):
+    sha = hashlib.sha256(('%s;%s;' % (os.path.basename(os.path.dirname(os.path.abspath(paths[0]))),
+                                      desired_size)).encode())
+    for path in paths:
+        sha.update(os.path.basename(path).encode() + b';')
+        update_file_hash(sha, path)
+    return sha.hexdigest()[:HASH_LENGTH]
+
+
+def encode_class_images(gen, paths, transform, batch_size=8):
+    # Mean class code of the images in paths, encoded batch_size images at a time
+    device = next(gen.parameters()).device
+    total = None
+    with torch.no_grad():
+        for start in range(0, len(paths), batch_size):
+            images = torch.stack([transform(default_loader_custom(p)) for p in paths[start:start + batch_size]])
+            images = images.to(device, memory_format=GlobalConstants.getMemoryFormat())
+            codes = gen.enc_class_model(images).float().sum(0, keepdim=True)
+            total = codes if total is None else total + codes
+    return total / len(paths)
+
+
+class ClassCodeBank():
+    """
+    The class codes of one checkpoint in bank_dir for images center cropped to desired_size.
+    The checkpoint is hashed once, later instances look the hash up in <bank_dir>/checkpoints.json
+    by path, size and modification time. Folder hashes are cached the same way in <bank_dir>/folders.json,
+    by the path of the folder and the names, sizes and modification times of its images.
+    """
+    def __init__(self, bank_dir, ckpt_name, desired_size):
+        self.bank_dir = bank_dir
+        self.desired_size = desired_size
+        self.folders_path = os.path.join(bank_dir, 'folders.json')
+        self.folders = None
+        self.ckpt_dir = os.path.join(bank_dir, self.checkpoint_hash(ckpt_name))
+        self.index_path = os.path.join(self.ckpt_dir, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def checkpoint_hash(self, ckpt_name):
+        cache_path = os.path.join(self.bank_dir, 'checkpoints.json')
+        cache = {}
+        if not os.path.exists(self.bank_dir):
+            os.makedirs(self.bank_dir)
+        elif os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cache = json.load(f)
+        stat = os.stat(ckpt_name)
+        key = os.path.abspath(ckpt_name)
+        entry = cache.get(key)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash(ckpt_name)}
+            cache[key] = entry
+            write_json(cache_path, cache)
+        return entry['hash']
+
+    def paths(self, key):
+        return (os.path.join(self.ckpt_dir, key + '.npy'), os.path.join(self.ckpt_dir, key + '_adain.npy'))
+
+    def key(self, folder):
+        paths = list_class_images(folder)
+        assert len(paths) > 0, "No images in class folder {}".format(folder)
+        if self.folders is None:
+            self.folders = {}
+            if os.path.exists(self.folders_path):
+                with open(self.folders_path) as f:
+                    self.folders = json.load(f)
+        stats = [os.stat(p) for p in paths]
+        files = [[os.path.basename(p), st.st_size, st.st_mtime_ns] for p, st in zip(paths, stats)]
+        cache_key = '%s;%s' % (os.path.abspath(folder), self.desired_size)
+        entry = self.folders.get(cache_key)
+        if entry is None or entry['files'] != files:
+            entry = {'files': files, 'hash': folder_hash(paths, self.desired_size)}
+            self.folders[cache_key] = entry
+            write_json(self.folders_path, self.folders)
+        return entry['hash'], paths
+
+    def add(self, gen, folder, transform, adain=False, batch_size=8):
+        """
+        Encodes the images of folder with gen and stores their mean class code, and with adain also
+        the AdaIN parameters gen.mlp computes from it. Returns the key of the entry.
+        An existing entry is only encoded again to add missing AdaIN parameters.
+        """
+        key, paths = self.key(folder)
+        code_path, adain_path = self.paths(key)
+        if os.path.exists(code_path) and (not adain or os.path.exists(adain_path)):
+            return key
+        class_code = encode_class_images(gen, paths, transform, batch_size)
+        if not os.path.exists(self.ckpt_dir):
+            os.makedirs(self.ckpt_dir)
+        save_npy(code_path, class_code.cpu().numpy())
+        if adain:
+            with torch.no_grad():
+                adain_params = gen.mlp(class_code.to(next(gen.mlp.parameters()).dtype))
+            save_npy(adain_path, adain_params.float().cpu().numpy())
+        self.index[key] = {'folder': os.path.abspath(folder), 'images': len(paths),
+                           'desired_size': self.desired_size, 'adain': os.path.exists(adain_path)}
+        write_json(self.index_path, self.index)
+        return key
+
+    def load(self, folder):
+        """
+        Returns the memory mapped class code and AdaIN parameters of folder as numpy arrays,
+        (None, None) if the folder is not in the bank and the AdaIN parameters None if they weren't stored.
+        """
+        code_path, adain_path = self.paths(self.key(folder)[0])
+        if not os.path.exists(code_path):
+            return None, None
+        adain_params = np.load(adain_path, mmap_mode='r') if os.path.exists(adain_path) else None
+        return np.load(code_path, mmap_mode='r'), adain_params
+
+    def class_code(self, gen, folder, transform):
+        """
+        The class code and AdaIN parameters (or None) of folder as tensors on the device of gen.
+        Folders that are not in the bank yet are encoded and added first.
+        """
+        class_code, adain_params = self.load(folder)
+        if class_code is None:
+            self.add(gen, folder, transform)
+            class_code, adain_params = self.load(folder)
+        param = next(gen.parameters())
+        if adain_params is not None:
+            adain_params = torch.from_numpy(np.array(adain_params)).to(param.device, param.dtype)
+        return torch.from_numpy(np.array(class_code)).to(param.device, param.dtype), adain_params
+
+
+def save_npy(path, array):
+    # Written under a temporary name first, a reader never maps a half written file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',
+                        type=str,
+                        default='configs/funit_B022.yaml')
+    parser.add_argument('--ckpt',
+                        type=str,
+                        default='pretrained/animal119_gen_00200000.pt')
+    parser.add_argument('--bank_dir',
+                        type=str,
+                        default='class_bank')
+    parser.add_argument('--class_image_folders',
+                        type=str,
+                        nargs='+',
+                        default=['images/n02138411'])
+    parser.add_argument('--adain',
+                        action="store_true",
+                        help="also store the AdaIN parameters the MLP computes from the class codes")
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=8)
+    parser.add_argument('--device',
+                        type=str,
+                        default="",
+                        help="device to run on (cpu, cuda, cuda:1, ...), overrides the config")
+    opts = parser.parse_args()
+
+    config = get_config(opts.config)
+    GlobalConstants.setPrecision(config['precision'])
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+    GlobalConstants.setDevice(opts.device if opts.device != "" else config.get('device', 'auto'),
+                              config.get('num_threads'), config.get('num_interop_threads'))
+    GlobalConstants.setMemoryFormat(config.get('channels_last', False))
+
+    from inference import load_gen_test
+    gen = load_gen_test(config, opts.ckpt, GlobalConstants.getDevice())
+    gen = gen.to(memory_format=GlobalConstants.getMemoryFormat())
+    bank = ClassCodeBank(opts.bank_dir, opts.ckpt, config['desired_size'])
+    transform = get_test_transform(config['desired_size'])
+    for folder in opts.class_image_folders:
+        key = bank.add(gen, folder, transform, opts.adain, opts.batch_size)
+        print('%s: %d images -> %s' % (folder, bank.index[key]['images'], bank.paths(key)[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,17 +13,16 @@ def gradient_penalty(real_data, generated_data, discriminator, gp_weight=10):
     # Calculate interpolation
     alpha = torch.rand(batch_size, 1, 1, 1)
     alpha = alpha.expand_as(real_data)
-    alpha = alpha.cuda()
+    alpha = alpha.to(real_data.device)
     interpolated = alpha * real_data.data + (1 - alpha) * generated_data.data
     interpolated = Variable(interpolated, requires_grad=True)
-    interpolated = interpolated.cuda()
 
     # Calculate probability of interpolated examples
     prob_interpolated = discriminator(interpolated)
 
     # Calculate gradients of probabilities with respect to examples
     gradients = torch_grad(outputs=prob_interpolated, inputs=interpolated,
-                            grad_outputs=torch.ones(prob_interpolated.size()).cuda(),
+                            grad_outputs=torch.ones(prob_interpolated.size(), device=prob_interpolated.device),
                             create_graph=True, retain_graph=True)[0]
 
     # Gradients have shape (batch_size, num_channels, img_width, img_height),
@@ -47,17 +46,16 @@ def gradient_penalty_FUNIT(real_data, generated_data, discriminator, label, gp_w
     # Calculate interpolation
     alpha = torch.rand(batch_size, 1, 1, 1)
     alpha = alpha.expand_as(real_data)
-    alpha = alpha.cuda()
+    alpha = alpha.to(real_data.device)
     interpolated = alpha * real_data.data + (1 - alpha) * generated_data.data
     interpolated = Variable(interpolated, requires_grad=True)
-    interpolated = interpolated.cuda()
 
     # Calculate probability of interpolated examples
     _, prob_interpolated = discriminator(interpolated, label)
     
     # Calculate gradients of probabilities with respect to examples
     gradients = torch_grad(outputs=prob_interpolated, inputs=interpolated,
-                            grad_outputs=torch.ones(prob_interpolated.size()).cuda(),
+                            grad_outputs=torch.ones(prob_interpolated.size(), device=prob_interpolated.device),
                             create_graph=True, retain_graph=True)[0]
 
     # Gradients have shape (batch_size, num_channels, img_width, img_height),
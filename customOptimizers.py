@@ -1,77 +1,175 @@
-import math
+import torch
 from torch.optim.optimizer import Optimizer
 
-#COPIED FROM: https://gist.github.com/ajbrock/075c0ca4036dc4d8581990a6e76e07a3
-
-# This version of Adam keeps an fp32 copy of the parameters and 
-# does all of the parameter updates in fp32, while still doing the
-# forwards and backwards passes using fp16 (i.e. fp16 copies of the 
-# parameters and fp16 activations).
+# Keeps a float32 master copy of float16 or bfloat16 parameters and does all of the parameter
+# updates in float32, while the forward and backward passes use the low precision parameters.
 #
-# Note that this calls .float().cuda() on the params such that it 
-# moves them to gpu 0--if you're using a different GPU or want to 
-# do multi-GPU you may need to deal with this.
-class Adam16(Optimizer):
+# The master weights and the optimizer state of every parameter group live in one flat, contiguous
+# float32 buffer each, on the device of the parameters. A step goes through the flat buffers in chunks
+# of consecutive parameters: their gradients are copied into a float32 work buffer of the size of a chunk,
+# the chunk is updated in place and the result is copied back into the parameters. Besides the work buffers
+# no memory of the size of the model is needed, weights and state take as much memory as torch.optim in float32.
+# Like torch.optim, parameters without a gradient are skipped and every parameter counts its own steps.
+# With a GradScaler the scale and the inf check stay on the device, a step with inf or NaN gradients
+# leaves the weights and the state unchanged without a sync with the host.
+class MasterWeightOptimizer(Optimizer):
+    ALGORITHMS = ['Adam', 'RMSprop']
+    # On the CPU a chunk stays in the cache across the ops, on the GPU it only bounds the work buffers
+    CPU_CHUNK = 1 << 18
+    CUDA_CHUNK = 1 << 22
+
+    # GradScaler skips unscale_ and passes grad_scale and found_inf, the gradients are unscaled
+    # while they are copied into the work buffer
+    _step_supports_amp_scaling = True
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
+    def __init__(self, params, algorithm='Adam', lr=1e-3, betas=(0.9, 0.999), alpha=0.99, eps=1e-8,
                  weight_decay=0):
-        defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay)
-        params = list(params)
-        super(Adam16, self).__init__(params, defaults)
-        # for group in self.param_groups:
-            # for p in group['params']:
-        
-        self.fp32_param_groups = [p.data.float().cuda() for p in params]
-        if not isinstance(self.fp32_param_groups[0], dict):
-            self.fp32_param_groups = [{'params': self.fp32_param_groups}]
+        algorithm = next((a for a in self.ALGORITHMS if a.upper() == algorithm.upper()), None)
+        if algorithm is None:
+            raise ValueError("Unsupported algorithm, use one of " + ", ".join(self.ALGORITHMS))
+        defaults = dict(lr=lr, betas=betas, alpha=alpha, eps=eps, weight_decay=weight_decay)
+        super(MasterWeightOptimizer, self).__init__(params, defaults)
+        self.algorithm = algorithm
+        self.flat = []
+        # Chunks of every group for each pattern of parameters with and without a gradient
+        self.chunks = [{} for group in self.param_groups]
+        self.work = {}
+        for group in self.param_groups:
+            params = group['params']
+            devices = set(p.device for p in params)
+            assert len(devices) == 1, "All parameters of a group have to be on the same device"
+            master = torch.cat([p.detach().reshape(-1).float() for p in params])
+            flat = {'steps': torch.zeros(len(params), device=master.device), 'master': master}
+            if algorithm == 'Adam':
+                flat['exp_avg'] = torch.zeros_like(master)
+                flat['exp_avg_sq'] = torch.zeros_like(master)
+            else:
+                flat['square_avg'] = torch.zeros_like(master)
+            self.flat.append(flat)
+            device = master.device
+            chunk = self.CUDA_CHUNK if device.type == 'cuda' else self.CPU_CHUNK
+            size = min(master.numel(), max([chunk] + [p.numel() for p in params]))
+            if self.work.get(device) is None or self.work[device][0].numel() < size:
+                self.work[device] = (torch.empty(size, device=device), torch.empty(size, device=device))
 
-    def step(self, closure=None):
-        """Performs a single optimization step.
-        Arguments:
-            closure (callable, optional): A closure that reevaluates the model
-                and returns the loss.
+    def group_chunks(self, index, has_grad):
         """
-        loss = None
-        if closure is not None:
-            loss = closure()
-
-        for group,fp32_group in zip(self.param_groups,self.fp32_param_groups):
-            for p,fp32_p in zip(group['params'],fp32_group['params']):
-                if p.grad is None:
-                    continue
-                    
-                grad = p.grad.data.float()
-                state = self.state[p]
-
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['exp_avg'] = grad.new().resize_as_(grad).zero_()
-                    # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = grad.new().resize_as_(grad).zero_()
+        (first parameter, end parameter, start offset, end offset) of consecutive parameters with a gradient,
+        at most a chunk of elements each unless a single parameter is larger.
+        """
+        if has_grad not in self.chunks[index]:
+            params = self.param_groups[index]['params']
+            limit = self.work[params[0].device][0].numel()
+            chunks = []
+            offset = 0
+            for i, (p, with_grad) in enumerate(zip(params, has_grad)):
+                if with_grad:
+                    if chunks and chunks[-1][1] == i and offset + p.numel() - chunks[-1][2] <= limit:
+                        chunks[-1] = (chunks[-1][0], i + 1, chunks[-1][2], offset + p.numel())
+                    else:
+                        chunks.append((i, i + 1, offset, offset + p.numel()))
+                offset += p.numel()
+            self.chunks[index][has_grad] = chunks
+        return self.chunks[index][has_grad]
 
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                beta1, beta2 = group['betas']
+    def update(self, group, buffers, grad, denom, scales, keep=None):
+        """
+        One Adam or RMSprop update of a chunk of the flat buffers, in place. grad holds the float32 gradients
+        and is overwritten, denom is a work buffer. scales are per parameter views of denom and the
+        (step size, eps) of each parameter. keep is 0 on steps with inf or NaN gradients, else 1 or None.
+        """
+        master = buffers['master']
+        if group['weight_decay'] != 0:
+            grad.add_(master, alpha=group['weight_decay'])
+        if keep is not None:
+            # Zero gradients and weights of 0 leave the state unchanged, inf * 0 would be NaN
+            grad.masked_fill_(keep == 0, 0)
+        views, step_sizes, eps = scales
+        if self.algorithm == 'Adam':
+            beta1, beta2 = group['betas']
+            exp_avg, exp_avg_sq = buffers['exp_avg'], buffers['exp_avg_sq']
+            exp_avg.lerp_(grad, (1 - beta1) if keep is None else (1 - beta1) * keep)
+            exp_avg_sq.mul_(beta2 if keep is None else 1 - (1 - beta2) * keep).addcmul_(grad, grad, value=1 - beta2)
+            # sqrt(v) / bias_correction2 + eps with the bias correction moved into eps and the step size
+            torch.sqrt(exp_avg_sq, out=denom)
+            torch._foreach_add_(views, eps)
+            torch.div(exp_avg, denom, out=denom)
+        else:
+            alpha = group['alpha']
+            square_avg = buffers['square_avg']
+            square_avg.mul_(alpha if keep is None else 1 - (1 - alpha) * keep).addcmul_(grad, grad, value=1 - alpha)
+            torch.sqrt(square_avg, out=denom).add_(group['eps'])
+            torch.div(grad, denom, out=denom)
+        torch._foreach_mul_(views, step_sizes)
+        master.add_(denom)
 
-                state['step'] += 1
+    def views(self, buffer, params):
+        # Views of a flat buffer in the shapes of params
+        return [v.view_as(p) for v, p in zip(buffer.split([p.numel() for p in params]), params)]
 
-                if group['weight_decay'] != 0:
-                    grad = grad.add(group['weight_decay'], fp32_p)
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        grad_scale = getattr(self, 'grad_scale', None)
+        found_inf = getattr(self, 'found_inf', None)
 
-                # Decay the first and second moment running average coefficient
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+        for index, (group, flat) in enumerate(zip(self.param_groups, self.flat)):
+            params = group['params']
+            has_grad = tuple(p.grad is not None for p in params)
+            if not any(has_grad):
+                continue
+            device = flat['master'].device
+            keep = None if found_inf is None else (found_inf.to(device) == 0).float()
+            inv_scale = None if grad_scale is None else grad_scale.to(device).reciprocal()
+            # The step counts, bias corrections and step sizes of all parameters of the group at once
+            steps = flat['steps']
+            increment = torch.tensor(has_grad, dtype=steps.dtype).to(device, non_blocking=True)
+            steps.add_(increment if keep is None else increment * keep)
+            if self.algorithm == 'Adam':
+                beta1, beta2 = group['betas']
+                counted = steps.clamp(min=1)
+                bias_correction1 = 1 - beta1 ** counted
+                bias_correction2 = (1 - beta2 ** counted).sqrt_()
+                step_sizes = -group['lr'] * bias_correction2 / bias_correction1
+                eps = (group['eps'] * bias_correction2).unbind()
+            else:
+                step_sizes = torch.full_like(steps, -group['lr'])
+                eps = None
+            if keep is not None:
+                step_sizes = step_sizes * keep
+            step_sizes = step_sizes.unbind()
 
-                denom = exp_avg_sq.sqrt().add_(group['eps'])
+            work_grad, work_denom = self.work[device]
+            for first, end, start, stop in self.group_chunks(index, has_grad):
+                chunk_params = params[first:end]
+                grad = work_grad[:stop - start]
+                denom = work_denom[:stop - start]
+                torch._foreach_copy_(self.views(grad, chunk_params), [p.grad for p in chunk_params])
+                if inv_scale is not None:
+                    grad.mul_(inv_scale)
+                scales = (self.views(denom, chunk_params), step_sizes[first:end],
+                          None if eps is None else eps[first:end])
+                self.update(group, {k: v[start:stop] for k, v in flat.items() if k != 'steps'},
+                            grad, denom, scales, keep)
+                torch._foreach_copy_(chunk_params, self.views(flat['master'][start:stop], chunk_params))
+        return loss
 
-                bias_correction1 = 1 - beta1 ** state['step']
-                bias_correction2 = 1 - beta2 ** state['step']
-                step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
-            
-                # print(type(fp32_p))
-                fp32_p.addcdiv_(-step_size, exp_avg, denom)
-                p.data = fp32_p.half()
+    def state_dict(self):
+        state_dict = super(MasterWeightOptimizer, self).state_dict()
+        state_dict['flat'] = [dict(flat) for flat in self.flat]
+        return state_dict
 
-        return loss
\ No newline at end of file
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        # Copied into the existing buffers, so they stay in float32 on the device of the parameters
+        for flat, saved in zip(self.flat, state_dict.pop('flat')):
+            for k, v in saved.items():
+                if k == 'step':
+                    # Saved before the steps were counted per parameter
+                    flat['steps'].fill_(v)
+                elif k in flat:
+                    flat[k].copy_(v)
+        super(MasterWeightOptimizer, self).load_state_dict(state_dict)
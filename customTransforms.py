@@ -42,17 +42,8 @@ class RescaleToOneOne(object):
         Returns:
             Tensor: Converted image.
         """
-        #half does not support the max operation on the CPU but only on CUDA
-        if (pic.dtype == torch.float16):
-            maximum = pic.numpy().max()
-            pic = pic.numpy()
-            maximum = pic.max()
-            res = ((pic / maximum) *2)-1
-            res = torch.from_numpy(res)
-            res = res.half()
-        else:
-            maximum = pic.max()
-            res = ((pic/ maximum) *2)-1
+        maximum = pic.max()
+        res = ((pic/ maximum) *2)-1
         return res
 
     def __repr__(self):
@@ -76,9 +67,8 @@ class ToTensor(object):
         elif (GlobalConstants.getInputChannels()==1 and len(pic.shape)==2):
             pic=pic.reshape((1, pic.shape[0], pic.shape[1]))
 
-        tensor = torch.from_numpy(pic.copy())
-        if (not GlobalConstants.usingApex):
-            tensor = GlobalConstants.setTensorToPrecision(tensor)
+        # The data stays in float32 whatever the precision, autocast casts it where it is used
+        tensor = torch.from_numpy(pic.copy()).float()
         return tensor
 
     def __repr__(self):
@@ -3,6 +3,7 @@ Copyright (C) 2019 NVIDIA Corporation.  All rights reserved.
 Licensed under the CC BY-NC-SA 4.0 license
 (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
+import io
 import os.path
 from PIL import Image
 
@@ -21,8 +22,15 @@ def default_loader(path):
     return pic
 
 def default_loader_custom(path):
-    pic = imread(path)
-    class_name = get_class(path)
+    return preprocess_custom(imread(path), get_class(path))
+
+
+def bytes_loader_custom(data, class_name=""):
+    # Loads an encoded image file from memory, e.g. one sent to server.py, and preprocesses it like its class folder would
+    return preprocess_custom(imread(io.BytesIO(data)), class_name)
+
+
+def preprocess_custom(pic, class_name):
     if class_name == "malaria":
         pic = color.rgb2grey(pic)
         pic = invert(pic)
@@ -39,9 +47,6 @@ def default_loader_custom(path):
     #    else:
     #        print("Converting to int32")
     #        pic = pic.astype('int32')
-    if (GlobalConstants.usingApex):
-        pic = pic.astype('float32')
-
     #if (pic.dtype  == 'int32'):
     #    print("Converting to uint32")
     #    pic = pic.astype('uint32')
@@ -96,6 +101,27 @@ def default_filelist_reader(filelist):
     return im_list
 
 
+class ImageList(data.Dataset):
+    """
+    Images of a list of paths without labels, returns each image with its index in the list,
+    e.g. the content images of translate_batch.py
+    """
+
+    def __init__(self, paths, transform=None, loader=default_loader_custom):
+        self.paths = paths
+        self.transform = transform
+        self.loader = loader
+
+    def __getitem__(self, index):
+        img = self.loader(self.paths[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, index
+
+    def __len__(self):
+        return len(self.paths)
+
+
 class ImageLabelFilelist(data.Dataset):
     def __init__(self,
                  root,
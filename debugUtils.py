@@ -1,6 +1,10 @@
 import torch
 from skimage.io import imsave
 import os
+import collections
+import threading
+from abc import ABC, abstractmethod
+from fnmatch import fnmatch
 import numpy as np
 
 def printCheckpoint(index, funcName, className="", prefix=""):
@@ -31,6 +35,9 @@ class Debugger():
         self.index+=1
 
     def checkForNaNandInf(self, tensor, msg=""):
+        # Syncs with the host, which would split a compiled graph. Skipped there, use the AnomalyMonitor instead
+        if torch.compiler.is_compiling():
+            return
         nan = torch.isnan(tensor)
         inf = torch.isinf(tensor)
         if (torch.sum(nan) != 0):
@@ -56,25 +63,178 @@ class Debugger():
         #print(grad_output)
 
 
+class SampledHooks(ABC):
+    """
+    Base class for debugging tools that hook into the forward pass of selected modules.
+    Modules are selected by class name and, optionally, by fnmatch patterns on their qualified name.
+    Hooks are only attached during sampled iterations, all other iterations run without them.
+    Subclasses implement hook(index), which returns the forward hook for self.watched[index].
+    """
+    def __init__(self, model, sample_every=1, modules=("ActFirstResBlock", "Conv2dBlock"), layers=None):
+        self.sample_every = max(1, sample_every)
+        self.names = []
+        self.watched = []
+        for name, m in model.named_modules():
+            if m.__class__.__name__ not in modules:
+                continue
+            if layers and not any(fnmatch(name, pattern) for pattern in layers):
+                continue
+            self.names.append(name)
+            self.watched.append(m)
+        self.handles = []
+        self.iteration = 0
+
+    def step(self):
+        if (self.iteration % self.sample_every == 0):
+            self.attach()
+        else:
+            self.detach()
+        self.iteration += 1
+
+    def attach(self):
+        if (len(self.handles) == 0):
+            for i, m in enumerate(self.watched):
+                self.handles.append(m.register_forward_hook(self.hook(i)))
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    @abstractmethod
+    def hook(self, index):
+        # Returns the forward hook for the index-th watched module
+        pass
+
+
+class AnomalyMonitor(SampledHooks):
+    """
+    Watches the outputs of selected modules for NaN and Inf without syncing with the host.
+    Flags are or-ed into a preallocated buffer on the device and only copied back in report(),
+    so the training loop should call report() every log_iter.
+    Expected usage:
+        monitor = AnomalyMonitor(model, sample_every=10)
+        monitor.step()          # once per iteration, before the forward passes
+        monitor.report(it)      # every log_iter
+    """
+    def __init__(self, model, sample_every=1, modules=("ActFirstResBlock", "Conv2dBlock")):
+        super(AnomalyMonitor, self).__init__(model, sample_every, modules)
+        device = next(model.parameters()).device
+        # One row per module, columns are [NaN, Inf]
+        self.flags = torch.zeros(len(self.watched), 2, dtype=torch.bool, device=device)
+
+    def hook(self, index):
+        def check(module, inputs, output):
+            output = output.detach()
+            found = torch.stack((torch.isnan(output).any(), torch.isinf(output).any()))
+            self.flags[index].logical_or_(found.to(self.flags.device, non_blocking=True))
+        return check
+
+    def report(self, iteration=None):
+        # tolist() copies to the host, this is the only place where the monitor syncs
+        flags = self.flags.tolist()
+        self.flags.zero_()
+        offending = []
+        for name, m, found in zip(self.names, self.watched, flags):
+            if not any(found):
+                continue
+            kinds = [kind for kind, f in zip(("NaN", "Inf"), found) if f]
+            offending.append(name)
+            print("AnomalyMonitor:", " and ".join(kinds), "in forward pass of", name,
+                  "(" + m.__class__.__name__ + ")",
+                  "" if iteration is None else "up to iteration %d" % iteration)
+        return offending
+
+
+class ActivationCapture(SampledHooks):
+    """
+    Saves the channel-wise max projection of selected activations as png files.
+    The projection is computed on the device and copied asynchronously into a bounded ring buffer,
+    a background thread writes the buffer to disk. If the writer falls behind, the oldest
+    captures are dropped instead of stalling the forward pass.
+    Files are named pic_<layer>_<i>_0.png, where i counts the captures of that layer.
+    Expected usage:
+        capture = ActivationCapture(model, "pics", sample_every=100, layers=["dec.*"])
+        capture.step()          # once per iteration, before the forward passes
+        capture.close()         # flushes the buffer
+    """
+    def __init__(self, model, output_dir="pics", sample_every=1, modules=("Conv2dBlock",),
+                 layers=None, batch_index=0, buffer_size=32):
+        super(ActivationCapture, self).__init__(model, sample_every, modules, layers)
+        self.output_dir = output_dir
+        self.batch_index = batch_index
+        self.buffer = collections.deque(maxlen=max(1, buffer_size))
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        # Continue the numbering of earlier runs with one listing instead of probing every name
+        self.counters = {name: 0 for name in self.names}
+        for f in os.listdir(output_dir):
+            for name in self.names:
+                prefix = "pic_" + name + "_"
+                index = f[len(prefix):-len("_0.png")]
+                if f.startswith(prefix) and f.endswith("_0.png") and index.isdigit():
+                    self.counters[name] = max(self.counters[name], int(index) + 1)
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def hook(self, index):
+        name = self.names[index]
+        def capture(module, inputs, output):
+            if (self.batch_index >= output.size(0)):
+                return
+            pic = output.detach()[self.batch_index]
+            if (pic.dim() == 3):
+                pic = pic.amax(dim=0)
+            event = None
+            if pic.is_cuda:
+                host = torch.empty(pic.shape, dtype=pic.dtype, pin_memory=True)
+                host.copy_(pic, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+            else:
+                host = pic.clone()
+            file_name = os.path.join(self.output_dir, "pic_%s_%d_0.png" % (name, self.counters[name]))
+            self.counters[name] += 1
+            with self.condition:
+                if (len(self.buffer) == self.buffer.maxlen):
+                    self.dropped += 1
+                self.buffer.append((file_name, host, event))
+                self.condition.notify()
+        return capture
+
+    def write(self):
+        while True:
+            with self.condition:
+                while (len(self.buffer) == 0 and not self.closed):
+                    self.condition.wait()
+                if (len(self.buffer) == 0):
+                    return
+                file_name, host, event = self.buffer.popleft()
+            if event is not None:
+                event.synchronize()
+            pic = host.float().numpy()
+            pic = pic - pic.min()
+            if (pic.max() > 0):
+                pic = pic / pic.max()
+            imsave(file_name, (pic * 255).astype(np.uint8), check_contrast=False)
+
+    def close(self):
+        self.detach()
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+        if (self.dropped > 0):
+            print("ActivationCapture: dropped %d captures since the writer fell behind" % self.dropped)
+
+
 class DebugNet():
     name = ""
-    safeImgSwitch = False
 
     def setName(n):
-        DebugNet.name = n
-    
-    def safeImage(pic):
-        if (DebugNet.safeImgSwitch):
-            picName = "pics/pic_"+DebugNet.name+"_"
-            i = 0
-            while (os.path.exists(picName + ((str)(i)) + "_0" + ".png")):
-                i+=1
-            pic = pic.detach().cpu().numpy()
-            print(pic.shape)
-            if len(pic.shape) == 4 :
-                pic = pic[0]
-            #pic = pic.astype(np.uint8) #may be lossy
-            #for j in range(pic.shape[0]):
-            #    imsave(picName + ((str)(i)) + "_" + ((str)(j)) + ".png", pic[j])
-            pic = np.max(pic, axis = 0)
-            imsave(picName + ((str)(i))+ "_0.png", pic)
\ No newline at end of file
+        # Only eagerly, in compiled graphs the assignment would be replayed after every graph
+        if not torch.compiler.is_compiling():
+            DebugNet.name = n
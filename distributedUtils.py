@@ -0,0 +1,97 @@
+import os
+import torch
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
+
+# Data parallel training with one process per GPU or per CPU socket, started by torchrun, e.g.
+#   torchrun --nproc_per_node=4 train.py --config configs/funit_B022.yaml
+# Every process loads its own shard of the data and runs the batch_size of the config. The gradients
+# are summed over the processes before every optimizer step, so all processes keep the same weights.
+#
+# The models are not wrapped in DistributedDataParallel: FUNITModel runs the backward passes inside
+# its forward, runs the discriminator several times per step and differentiates twice for the R1
+# penalty, none of which DDP's reducer supports. The gradients are synchronized explicitly instead,
+# in buckets like DDP does.
+
+BUCKET_SIZE = 25 * 1024 * 1024
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def is_main_process():
+    # Checkpoints, images and logs are only written by the first process
+    return get_rank() == 0
+
+
+def init_distributed(device="auto"):
+    """
+    Joins the process group if torchrun started more than one process and returns the device of
+    this process: the GPU of its local rank with NCCL, the CPU with Gloo. Otherwise returns device.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return device
+    if (device is None or device == "auto"):
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if torch.device(device).type == "cuda":
+        device = "cuda:%d" % int(os.environ['LOCAL_RANK'])
+        backend = "nccl"
+    else:
+        backend = "gloo"
+    dist.init_process_group(backend)
+    print("Process %d of %d uses %s with %s" % (get_rank(), get_world_size(), device, backend))
+    return device
+
+
+def cpu_threads_per_process():
+    # torchrun sets OMP_NUM_THREADS to 1, the processes on one machine share its cores instead
+    return max(1, os.cpu_count() // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+
+
+def set_epoch(loaders, epoch):
+    # The DistributedSamplers shuffle with the epoch as seed, the same on every process
+    for loader in loaders:
+        if isinstance(loader.sampler, DistributedSampler):
+            loader.sampler.set_epoch(epoch)
+
+
+def broadcast_module(module, src=0):
+    # Every process starts from the parameters and buffers of src
+    with torch.no_grad():
+        for t in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(t.data, src)
+
+
+def all_reduce_gradients(params, bucket_size=BUCKET_SIZE):
+    """
+    Sums the gradients of params over all processes, in flat buckets of about bucket_size bytes
+    per dtype and device so that each bucket is one all_reduce.
+    Parameters without a gradient are skipped, they have to be the same on all processes.
+    """
+    groups = {}
+    for p in params:
+        if p.grad is not None:
+            groups.setdefault((p.grad.dtype, p.grad.device), []).append(p.grad)
+    for grads in groups.values():
+        bucket, size = [], 0
+        for i, g in enumerate(grads):
+            bucket.append(g)
+            size += g.numel() * g.element_size()
+            if size >= bucket_size or i == len(grads) - 1:
+                flat = torch.cat([g.reshape(-1) for g in bucket])
+                dist.all_reduce(flat)
+                torch._foreach_copy_(bucket, [v.view_as(g) for v, g in
+                                              zip(flat.split([g.numel() for g in bucket]), bucket)])
+                bucket, size = [], 0
+
+
+def all_reduce_sum(values):
+    # Sums scalar tensors over all processes with a single all_reduce
+    flat = torch.stack([torch.as_tensor(v).detach().float().reshape(()) for v in values])
+    dist.all_reduce(flat)
+    return list(flat.unbind())
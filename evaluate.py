@@ -0,0 +1,220 @@
+"""
+Evaluates a checkpoint like acc_test.py, without moving files around and one batch instead of one image at a time.
+A fixed seed picks --num_samples content images from the classes of --content_dir, except --target_class, and
+--shots class images of --class_dir for each of them. Like acc_test.py every sample first picks a content class
+and then one of its images, so every class weighs the same however many images it has. Every content image is translated with the mean class
+code of its class images and compared with its reference image, the target_class image of the same field of view
+that --csv names, by the Otsu overlap of utils.otsu_iou and the Dice coefficient of the Otsu masks. The translations
+stay in memory and are thresholded as one batch on the device of the generator with metrics.py. The masks of the
+references are loaded by a pool of threads and cached, the channels of one field of view share their reference.
+Prints the overlap per content class and overall, --output saves the overlap of every sample as csv.
+
+USE FOLLOWING COMMAND TO EXECUTE:
+python evaluate.py --config outputs/config/config.yaml --ckpt outputs/config/checkpoints/gen_00470000.pt --content_dir ../../../scratch/slivinskiy/new_datasets/run2/Test --class_dir ../../../scratch/slivinskiy/new_datasets/high_conc/Train/OrigHoechst --reference_dirs ../../../scratch/slivinskiy/new_datasets/classes/Test/OrigHoechst ../../../scratch/slivinskiy/new_datasets/classes/Val/OrigHoechst ../../../scratch/slivinskiy/new_datasets/classes/Train/OrigHoechst --csv ../../../scratch/slivinskiy/new_datasets/conf/BBBC022_v1_image.csv
+"""
+import os
+import csv
+import time
+import random
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from globalConstants import GlobalConstants
+from utils import get_config, get_test_transform
+from data import ImageList, get_class
+from inference import load_gen_test
+from metrics import ReferenceMaskCache, otsu_masks, mask_iou, mask_dice
+from class_bank import list_class_images
+
+# Columns of the BBBC022 image table with the file names of the channels of one field of view
+CSV_CLASSES = ["OrigER", "OrigHoechst", "OrigMito", "OrigPh_golgi", "OrigSyto"]
+# utils.prepare_evaluation_pic crops the images to this size
+EVALUATION_SIZE = 256
+
+
+def read_reference_names(csv_path, target_class):
+    # Maps the file name of every channel image to the file name of the target_class image of its field of view
+    target = CSV_CLASSES.index(target_class) + 1
+    references = {}
+    with open(csv_path) as csvfile:
+        for row in csv.reader(csvfile, delimiter=',', quotechar='"'):
+            for i in range(1, len(CSV_CLASSES) + 1):
+                references[row[i]] = row[target]
+    return references
+
+
+def sample_evaluation_set(content_dir, class_dir, reference_dirs, csv_path, target_class, num_samples, shots, seed):
+    """
+    Returns num_samples (content path, class image paths, reference path) tuples, the same ones for the same seed.
+    Each sample is a uniformly chosen content class and one of its images that wasn't picked yet, like
+    getRandomInputPics_Paths in acc_test.py. Content images without a reference are left out, like acc_test.py
+    skipped them.
+    """
+    rng = random.Random(seed)
+    reference_names = read_reference_names(csv_path, target_class)
+    reference_paths = {}
+    # The first folder that has an image wins, like the Test, Val, Train order of acc_test.py
+    for folder in reversed(reference_dirs):
+        reference_paths.update({name: os.path.join(folder, name) for name in os.listdir(folder)})
+    class_images = list_class_images(class_dir)
+    if shots > len(class_images):
+        raise ValueError("%d shots requested, but %s has only %d images" % (shots, class_dir, len(class_images)))
+    contents = {}
+    for content_class in sorted(next(os.walk(content_dir))[1]):
+        if content_class == target_class:
+            continue
+        for path in list_class_images(os.path.join(content_dir, content_class)):
+            reference = reference_paths.get(reference_names.get(os.path.basename(path)))
+            if reference is not None:
+                contents.setdefault(content_class, []).append((path, reference))
+    samples = []
+    while len(samples) < num_samples and len(contents) > 0:
+        content_class = rng.choice(sorted(contents))
+        images = contents[content_class]
+        path, reference = images.pop(rng.randrange(len(images)))
+        if len(images) == 0:
+            del contents[content_class]
+        samples.append((path, sorted(rng.sample(class_images, shots)), reference))
+    return samples
+
+
+def translation_masks(output_images):
+    """
+    Otsu masks of a batch of translations as acc_test.py computed them: saved as 8 bit images, loaded back
+    with prepare_evaluation_pic, center cropped to EVALUATION_SIZE and scaled to [0, 1].
+    """
+    images = ((output_images.float() + 1) * 0.5 * 255.0).clamp(0, 255).to(torch.uint8).squeeze(1)
+    top = (images.size(-2) - EVALUATION_SIZE) // 2
+    left = (images.size(-1) - EVALUATION_SIZE) // 2
+    if images.size(-2) > EVALUATION_SIZE or images.size(-1) > EVALUATION_SIZE:
+        images = images[..., max(0, top):max(0, top) + EVALUATION_SIZE, max(0, left):max(0, left) + EVALUATION_SIZE]
+    images = images.double()
+    return otsu_masks(images / images.flatten(1).amax(1).clamp_min(1).view(-1, *([1] * (images.dim() - 1))))
+
+
+def encode_class_codes(gen, paths, transform, batch_size, num_workers):
+    # Class code of every path, each image is encoded once even if many samples use it
+    device = next(gen.parameters()).device
+    loader = DataLoader(ImageList(paths, transform), batch_size, num_workers=num_workers)
+    codes = []
+    with torch.no_grad():
+        for images, indices in loader:
+            codes.append(gen.enc_class_model(images.to(device, memory_format=GlobalConstants.getMemoryFormat())))
+    return dict(zip(paths, torch.cat(codes)))
+
+
+def print_table(samples, overlaps, dices):
+    classes = {}
+    for (path, class_paths, reference), overlap, dice in zip(samples, overlaps, dices):
+        classes.setdefault(get_class(path), []).append((overlap, dice))
+    print("%-40s %8s %8s %8s %8s %8s %8s" % ("content class", "samples", "mean", "std", "min", "max", "dice"))
+    for name, values in sorted(classes.items()) + [("all", list(zip(overlaps, dices)))]:
+        values = np.array(values)
+        print("%-40s %8d %7.2f%% %7.2f%% %7.2f%% %7.2f%% %7.2f%%" % (
+            name, len(values), values[:, 0].mean(), values[:, 0].std(), values[:, 0].min(), values[:, 0].max(),
+            values[:, 1].mean()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',
+                        type=str,
+                        default='configs/funit_B022.yaml')
+    parser.add_argument('--ckpt',
+                        type=str,
+                        default='pretrained/gen_00470000.pt')
+    parser.add_argument('--content_dir',
+                        type=str,
+                        default='../../../scratch/slivinskiy/new_datasets/run2/Test')
+    parser.add_argument('--class_dir',
+                        type=str,
+                        default='../../../scratch/slivinskiy/new_datasets/high_conc/Train/OrigHoechst')
+    parser.add_argument('--reference_dirs',
+                        type=str,
+                        nargs='+',
+                        default=['../../../scratch/slivinskiy/new_datasets/classes/%s/OrigHoechst' % s
+                                 for s in ("Test", "Val", "Train")])
+    parser.add_argument('--csv',
+                        type=str,
+                        default='../../../scratch/slivinskiy/new_datasets/conf/BBBC022_v1_image.csv')
+    parser.add_argument('--target_class',
+                        type=str,
+                        default='OrigHoechst')
+    parser.add_argument('--num_samples',
+                        type=int,
+                        default=1500)
+    parser.add_argument('--shots',
+                        type=int,
+                        default=1,
+                        help="class images per content image, their class codes are averaged")
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0)
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=16)
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=2,
+                        help="DataLoader processes that load the content and class images")
+    parser.add_argument('--reference_threads',
+                        type=int,
+                        default=4,
+                        help="threads that load the reference images")
+    parser.add_argument('--output',
+                        type=str,
+                        default="",
+                        help="csv file for the overlap of every sample")
+    parser.add_argument('--device',
+                        type=str,
+                        default="",
+                        help="device to run on (cpu, cuda, cuda:1, ...), overrides the config")
+    opts = parser.parse_args()
+
+    config = get_config(opts.config)
+    GlobalConstants.setPrecision(config['precision'])
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+    GlobalConstants.setDevice(opts.device if opts.device != "" else config.get('device', 'auto'),
+                              config.get('num_threads'), config.get('num_interop_threads'))
+    GlobalConstants.setMemoryFormat(config.get('channels_last', False))
+    device = GlobalConstants.getDevice()
+    transform = get_test_transform(config['desired_size'])
+    gen = load_gen_test(config, opts.ckpt, device).to(memory_format=GlobalConstants.getMemoryFormat())
+
+    start = time.perf_counter()
+    samples = sample_evaluation_set(opts.content_dir, opts.class_dir, opts.reference_dirs, opts.csv,
+                                    opts.target_class, opts.num_samples, opts.shots, opts.seed)
+    print("%d samples, %d shots, seed %d" % (len(samples), opts.shots, opts.seed))
+    codes = encode_class_codes(gen, sorted(set(p for s in samples for p in s[1])), transform,
+                               opts.batch_size, opts.num_workers)
+    loader = DataLoader(ImageList([s[0] for s in samples], transform), opts.batch_size,
+                        num_workers=opts.num_workers, pin_memory=(device.type == 'cuda'))
+    reference_masks = ReferenceMaskCache(device, num_threads=opts.reference_threads)
+    overlaps, dices = [], []
+    with torch.no_grad():
+        for images, indices in loader:
+            batch = [samples[i] for i in indices.tolist()]
+            class_codes = torch.stack([torch.stack([codes[p] for p in s[1]]).mean(0) for s in batch])
+            images = images.to(device, non_blocking=True, memory_format=GlobalConstants.getMemoryFormat())
+            fake = translation_masks(gen.decode(gen.enc_content(images), class_codes))
+            real = reference_masks([s[2] for s in batch])
+            overlaps += mask_iou(fake, real).tolist()
+            dices += mask_dice(fake, real).tolist()
+    reference_masks.close()
+    print("Evaluated in %.1f s, %d references loaded" % (time.perf_counter() - start, reference_masks.misses))
+    print_table(samples, overlaps, dices)
+
+    if opts.output != "":
+        with open(opts.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["content", "content_class", "class_images", "reference", "overlap", "dice"])
+            for (path, class_paths, reference), overlap, dice in zip(samples, overlaps, dices):
+                writer.writerow([path, get_class(path), ";".join(class_paths), reference,
+                                 "%.4f" % overlap, "%.4f" % dice])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+Exports gen_test as standalone artifacts that run on the CPU without the training stack:
+    enc_content       content image -> content code
+    enc_class_model   class images -> class codes
+    mlp               class code -> AdaIN parameters (only with --adain_input)
+    decode            (content code, class code or AdaIN parameters) -> translated image
+The exported decode takes the class code as an input, nothing is kept in the artifacts between calls.
+ExportedGenerator runs the artifacts with ONNX Runtime or TorchScript.
+
+USE FOLLOWING COMMAND TO EXECUTE:
+python export.py --config configs/funit_B022.yaml --ckpt pretrained/gen_00470000.pt --output_dir exported --format onnx
+python export.py --run exported --input images/input_content.jpg --class_image_folder images/n02138411 --output images/output.jpg
+"""
+import os
+import json
+import shutil
+import argparse
+
+import torch
+import torch.nn as nn
+
+from globalConstants import GlobalConstants
+
+FORMATS = ['onnx', 'torchscript']
+
+
+class Decode(nn.Module):
+    """
+    FewShotGen.decode with the class code, or the AdaIN parameters the MLP makes of it, as an explicit input.
+    The AdaIN layers still receive their parameters by assignment in gen.decode_adain, but only inside forward,
+    so the exported graph computes them from its input.
+    """
+    def __init__(self, gen, adain_input=False):
+        super(Decode, self).__init__()
+        self.gen = gen
+        self.adain_input = adain_input
+
+    def forward(self, content, code):
+        adain_params = code if self.adain_input else self.gen.mlp(code)
+        return self.gen.decode_adain(content, adain_params)
+
+
+def export_generator(gen, output_dir, fmt='onnx', adain_input=False, size=256):
+    """
+    Exports the parts of gen into output_dir and returns their paths.
+    Batch size and image size stay dynamic, size only sets the example input for tracing.
+    """
+    assert fmt in FORMATS, "Unsupported export format: {}".format(fmt)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    gen = gen.eval()
+    device = next(gen.parameters()).device
+    # The first convolution may be a quantized one, so look for it by its attribute
+    input_nc = next(m.in_channels for m in gen.enc_content.modules() if hasattr(m, 'in_channels'))
+    with torch.no_grad():
+        image = torch.zeros(1, input_nc, size, size, device=device)
+        content = gen.enc_content(image)
+        class_code = gen.enc_class_model(image)
+        adain_params = gen.mlp(class_code)
+    # name: (module, example inputs, input names, output names)
+    parts = {
+        'enc_content': (gen.enc_content, (image,), ['image'], ['content_code']),
+        'enc_class_model': (gen.enc_class_model, (image,), ['image'], ['class_code']),
+        'decode': (Decode(gen, adain_input), (content, adain_params if adain_input else class_code),
+                   ['content_code', 'adain_params' if adain_input else 'class_code'], ['image']),
+    }
+    if adain_input:
+        parts['mlp'] = (gen.mlp, (class_code,), ['class_code'], ['adain_params'])
+    dynamic_axes = {
+        'image': {0: 'batch', 2: 'height', 3: 'width'},
+        'content_code': {0: 'batch', 2: 'code_height', 3: 'code_width'},
+        'class_code': {0: 'batch'},
+        'adain_params': {0: 'batch'},
+    }
+    paths = {}
+    for name, (module, inputs, input_names, output_names) in parts.items():
+        with torch.no_grad():
+            if fmt == 'onnx':
+                paths[name] = os.path.join(output_dir, name + '.onnx')
+                torch.onnx.export(module, inputs, paths[name],
+                                  input_names=input_names, output_names=output_names,
+                                  dynamic_axes={n: dynamic_axes[n] for n in input_names + output_names},
+                                  dynamo=False)
+            else:
+                paths[name] = os.path.join(output_dir, name + '.pt')
+                torch.jit.trace(module, inputs, check_trace=False).save(paths[name])
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump({'format': fmt, 'adain_input': adain_input, 'input_nc': input_nc}, f)
+    return paths
+
+
+class ExportedGenerator():
+    """
+    Runs the artifacts of export_generator on the CPU with the inference interface of FewShotGen,
+    torch tensors in and out.
+    """
+    def __init__(self, export_dir, num_threads=0):
+        with open(os.path.join(export_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.format = meta['format']
+        self.adain_input = meta['adain_input']
+        names = ['enc_content', 'enc_class_model', 'decode'] + (['mlp'] if self.adain_input else [])
+        self.parts = {}
+        if self.format == 'onnx':
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            for name in names:
+                self.parts[name] = ort.InferenceSession(os.path.join(export_dir, name + '.onnx'), options,
+                                                        providers=['CPUExecutionProvider'])
+        else:
+            if num_threads:
+                torch.set_num_threads(num_threads)
+            for name in names:
+                self.parts[name] = torch.jit.load(os.path.join(export_dir, name + '.pt'), map_location='cpu')
+
+    def run(self, name, *inputs):
+        inputs = [x.detach().float().cpu().contiguous() for x in inputs]
+        if self.format == 'onnx':
+            session = self.parts[name]
+            feed = {i.name: x.numpy() for i, x in zip(session.get_inputs(), inputs)}
+            return torch.from_numpy(session.run(None, feed)[0])
+        with torch.no_grad():
+            return self.parts[name](*inputs)
+
+    def enc_content(self, image):
+        return self.run('enc_content', image)
+
+    def enc_class_model(self, image):
+        return self.run('enc_class_model', image)
+
+    def adain_params(self, class_code):
+        return self.run('mlp', class_code) if self.adain_input else class_code
+
+    def decode(self, content, class_code):
+        # One class code is shared by the whole batch
+        if class_code.size(0) == 1 and content.size(0) > 1:
+            class_code = class_code.expand(content.size(0), *class_code.shape[1:])
+        return self.run('decode', content, self.adain_params(class_code))
+
+    def translate_simple(self, content_image, class_code):
+        return self.decode(self.enc_content(content_image), class_code)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',
+                        type=str,
+                        default='configs/funit_B022.yaml')
+    parser.add_argument('--ckpt',
+                        type=str,
+                        default='pretrained/animal119_gen_00200000.pt')
+    parser.add_argument('--output_dir',
+                        type=str,
+                        default='exported')
+    parser.add_argument('--format',
+                        type=str,
+                        choices=FORMATS,
+                        default='onnx')
+    parser.add_argument('--adain_input',
+                        action="store_true",
+                        help="export decode with the AdaIN parameters as input instead of the class code")
+    parser.add_argument('--run',
+                        type=str,
+                        default="",
+                        help="translate --input with the artifacts in this folder instead of exporting")
+    parser.add_argument('--class_image_folder',
+                        type=str,
+                        default='images/n02138411')
+    parser.add_argument('--input',
+                        type=str,
+                        default='images/input_content.jpg')
+    parser.add_argument('--output',
+                        type=str,
+                        default='images/output.jpg')
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=0)
+    opts = parser.parse_args()
+
+    # The training stack is only needed for the config and the preprocessing, not by ExportedGenerator
+    from utils import get_config, get_test_transform, to_output_image
+    from data import default_loader_custom
+    from skimage.io import imsave
+    config = get_config(os.path.join(opts.run, 'config.yaml') if opts.run != "" else opts.config)
+    GlobalConstants.setPrecision(config['precision'])
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+
+    if opts.run == "":
+        from inference import load_gen_test
+        gen = load_gen_test(config, opts.ckpt, torch.device('cpu'))
+        paths = export_generator(gen, opts.output_dir, opts.format, opts.adain_input, config['desired_size'])
+        shutil.copy(opts.config, os.path.join(opts.output_dir, 'config.yaml'))
+        for name, path in paths.items():
+            print('Exported %s to %s' % (name, path))
+        return
+
+    gen = ExportedGenerator(opts.run, opts.num_threads)
+    transform = get_test_transform(config['desired_size'])
+    # Like test_k_shot.py, the class code comes from the first image of the class folder
+    class_image = sorted(next(os.walk(opts.class_image_folder))[2])[0]
+    class_image = transform(default_loader_custom(os.path.join(opts.class_image_folder, class_image)))
+    class_code = gen.enc_class_model(class_image.unsqueeze(0))
+    content_img = transform(default_loader_custom(opts.input)).unsqueeze(0)
+    output_image = gen.translate_simple(content_img, class_code)
+    imsave(opts.output, to_output_image(output_image))
+    print('Save output to %s' % opts.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ Copyright (C) 2019 NVIDIA Corporation.  All rights reserved.
 Licensed under the CC BY-NC-SA 4.0 license
 (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
+import contextlib
 import copy
 
 import torch
@@ -13,15 +14,19 @@ from debugUtils import printCheckpoint, Debugger
 import torch.nn.functional as F
 from globalConstants import GlobalConstants
 
-import apex.amp as amp
-
 PREFIX = "funit_model.py"
 
 def recon_criterion(predict, target):
     if (target.shape[-1]!=predict.shape[-1]):
         print("Funit_model.py recon_criterion: SHAPE OF INPUT", target.shape, "AND OF PREDICTION", predict.shape, "AREN'T EQUAL!")
         predict = F.interpolate(predict, target.shape[-1])
-    return torch.mean(torch.abs(predict - target))
+    # In float32, under autocast predict may be float16 or bfloat16
+    return torch.mean(torch.abs(predict.float() - target.float()))
+
+
+def run_eagerly(enabled=True):
+    # Compiled graphs don't support the double backward of the R1 penalty, its passes run the compiled modules eagerly
+    return torch.compiler.set_stance("force_eager") if enabled else contextlib.nullcontext()
 
 
 class FUNITModel(nn.Module):
@@ -30,74 +35,91 @@ class FUNITModel(nn.Module):
         self.gen = FewShotGen(hp['gen'])
         self.dis = GPPatchMcResDis(hp['dis'])
         self.gen_test = copy.deepcopy(self.gen)
+        self.gen_scaler = None
+        self.dis_scaler = None
 
-    def forward(self, co_data, cl_data, hp, mode):
+    def forward(self, co_data, cl_data, hp, mode, it=0, batch_fraction=1.0):
+        # batch_fraction: share of a micro-batch in the whole batch of an optimizer step. The losses
+        # and accuracies are weighted with it, so that summing over the micro-batches gives the batch values
 
         #debug = Debugger(self.forward.__name__, self.__class__.__name__, PREFIX) #Delete afterwards
 
-        xa = co_data[0].cuda()
-        la = co_data[1].cuda()
-        xb = cl_data[0].cuda()
-        lb = cl_data[1].cuda()
+        device = self.get_device()
+        xa = self.to_device(co_data[0])
+        la = co_data[1].to(device)
+        xb = self.to_device(cl_data[0])
+        lb = cl_data[1].to(device)
         if mode == 'gen_update':
-            c_xa = self.gen.enc_content(xa)
-            s_xa = self.gen.enc_class_model(xa)
-            s_xb = self.gen.enc_class_model(xb)
-            xt = self.gen.decode(c_xa, s_xb)  # translation
-            xr = self.gen.decode(c_xa, s_xa)  # reconstruction
-            #if (xt.shape[1]!=xa.shape[1]):
-            #    print("SHAPE OF INPUT %d AND OF PREDICTION %d AREN'T EQUAL!" % (xa.shape, xt.shape))
-            #    xt = F.interpolate(xt, xa.shape[1])
-            l_adv_t, gacc_t, xt_gan_feat = self.dis.calc_gen_loss(xt, lb)
-            l_adv_r, gacc_r, xr_gan_feat = self.dis.calc_gen_loss(xr, la)
-            _, xb_gan_feat = self.dis(xb, lb)
-            _, xa_gan_feat = self.dis(xa, la)
-            l_c_rec = recon_criterion(xr_gan_feat.mean(3).mean(2),
-                                      xa_gan_feat.mean(3).mean(2))
-            l_m_rec = recon_criterion(xt_gan_feat.mean(3).mean(2),
-                                      xb_gan_feat.mean(3).mean(2))
-            l_x_rec = recon_criterion(xr, xa.float())
-            l_adv = 0.5 * (l_adv_t + l_adv_r)
-            acc = 0.5 * (gacc_t + gacc_r)
-            l_total = (hp['gan_w'] * l_adv + hp['r_w'] * l_x_rec + hp[
-                'fm_w'] * (l_c_rec + l_m_rec))
-            if (GlobalConstants.usingApex):
-                with amp.scale_loss(l_total, [self.gen_opt, self.dis_opt]) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                l_total.backward()
-            return l_total, l_adv, l_x_rec, l_c_rec, l_m_rec, acc
+            # The forward passes run under autocast, the backward passes outside of it
+            with GlobalConstants.autocast():
+                c_xa = self.gen.enc_content(xa)
+                s_xa = self.gen.enc_class_model(xa)
+                s_xb = self.gen.enc_class_model(xb)
+                xt = self.gen.decode(c_xa, s_xb)  # translation
+                xr = self.gen.decode(c_xa, s_xa)  # reconstruction
+                #if (xt.shape[1]!=xa.shape[1]):
+                #    print("SHAPE OF INPUT %d AND OF PREDICTION %d AREN'T EQUAL!" % (xa.shape, xt.shape))
+                #    xt = F.interpolate(xt, xa.shape[1])
+                l_adv_t, gacc_t, xt_gan_feat = self.dis.calc_gen_loss(xt, lb)
+                l_adv_r, gacc_r, xr_gan_feat = self.dis.calc_gen_loss(xr, la)
+                _, xb_gan_feat = self.dis(xb, lb)
+                _, xa_gan_feat = self.dis(xa, la)
+                l_c_rec = recon_criterion(xr_gan_feat.mean(3).mean(2),
+                                          xa_gan_feat.mean(3).mean(2))
+                l_m_rec = recon_criterion(xt_gan_feat.mean(3).mean(2),
+                                          xb_gan_feat.mean(3).mean(2))
+                l_x_rec = recon_criterion(xr, xa.float())
+                l_adv = 0.5 * (l_adv_t + l_adv_r)
+                acc = 0.5 * (gacc_t + gacc_r)
+                l_total = (hp['gan_w'] * l_adv + hp['r_w'] * l_x_rec + hp[
+                    'fm_w'] * (l_c_rec + l_m_rec))
+            self.gen_scaler.scale(batch_fraction * l_total).backward()
+            return tuple(batch_fraction * l for l in (l_total, l_adv, l_x_rec, l_c_rec, l_m_rec, acc))
         elif mode == 'dis_update':
-            xb.requires_grad_()
-            l_real_pre, acc_r, resp_r = self.dis.calc_dis_real_loss(xb, lb)
-            l_real = hp['gan_w'] * l_real_pre
-            if (GlobalConstants.usingApex):
-                with amp.scale_loss(l_real, [self.gen_opt, self.dis_opt]) as scaled_loss:
-                    scaled_loss.backward(retain_graph=True)
-            else:
-                l_real.backward(retain_graph=True)
-            l_reg_pre = self.dis.calc_grad2(resp_r, xb)
-            l_reg = 10 * l_reg_pre
-            if (GlobalConstants.usingApex):
-                with amp.scale_loss(l_reg, [self.gen_opt, self.dis_opt]) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                l_reg.backward()
-            with torch.no_grad():
+            # Lazy R1: the penalty only every r1_interval steps with its weight scaled up to match,
+            # optionally on the first r1_batch_fraction of the real batch
+            r1_interval = hp.get('r1_interval', 1)
+            r1_step = (it % r1_interval == 0)
+            r1_size = max(1, int(round(xb.size(0) * hp.get('r1_batch_fraction', 1.0))))
+            # On the whole batch the real pass is differentiated once more for the penalty
+            r1_shared = r1_step and r1_size == xb.size(0)
+            # Translated before any graph of the discriminator is built
+            with torch.no_grad(), GlobalConstants.autocast():
                 c_xa = self.gen.enc_content(xa)
                 s_xb = self.gen.enc_class_model(xb)
                 xt = self.gen.decode(c_xa, s_xb)
-            l_fake_p, acc_f, resp_f = self.dis.calc_dis_fake_loss(xt.detach(),
-                                                                  lb)
-            l_fake = hp['gan_w'] * l_fake_p
-            if (GlobalConstants.usingApex):
-                with amp.scale_loss(l_fake, [self.gen_opt, self.dis_opt]) as scaled_loss:
-                    scaled_loss.backward()
-            else: 
-                l_fake.backward()
-            l_total = l_fake + l_real + l_reg
+            if r1_shared:
+                xb.requires_grad_()
+            with GlobalConstants.autocast(), run_eagerly(r1_shared):
+                l_real_pre, acc_r, resp_r = self.dis.calc_dis_real_loss(xb, lb)
+                l_real = hp['gan_w'] * l_real_pre
+            if r1_step:
+                if r1_shared:
+                    x_reg, resp_reg = xb, resp_r
+                else:
+                    x_reg = xb[:r1_size].detach().requires_grad_()
+                    with GlobalConstants.autocast(), run_eagerly():
+                        resp_reg, _ = self.dis(x_reg, lb[:r1_size])
+                # calc_grad2 divides by the square of the batch it is given, scaled back to the whole batch
+                # so that r1_batch_fraction only saves compute and doesn't change the strength of the penalty
+                l_reg_pre = self.dis.calc_grad2(resp_reg, x_reg, self.dis_scaler) * (r1_size / xb.size(0)) ** 2
+                l_reg = 10 * r1_interval * l_reg_pre
+            else:
+                l_reg_pre = torch.zeros((), device=device)
+                l_reg = l_reg_pre
+            with GlobalConstants.autocast():
+                l_fake_p, acc_f, resp_f = self.dis.calc_dis_fake_loss(xt.detach(),
+                                                                      lb)
+                l_fake = hp['gan_w'] * l_fake_p
+            # The R1 penalty of a batch is sum(grad ** 2) / batch_size ** 3, with the gradient of the
+            # mean response, so a micro-batch contributes with the cube of its share
+            reg_fraction = batch_fraction ** 3
+            # One backward pass through the real, R1 and fake graphs instead of one per loss
+            l_total = batch_fraction * (l_fake + l_real) + reg_fraction * l_reg
+            self.dis_scaler.scale(l_total).backward()
             acc = 0.5 * (acc_f + acc_r)
-            return l_total, l_fake_p, l_real_pre, l_reg_pre, acc
+            return (l_total, batch_fraction * l_fake_p, batch_fraction * l_real_pre,
+                    reg_fraction * l_reg_pre, batch_fraction * acc)
         else:
             assert 0, 'Not support operation'
 
@@ -105,25 +127,31 @@ class FUNITModel(nn.Module):
         self.eval()
         self.gen.eval()
         self.gen_test.eval()
-        xa = co_data[0].cuda()
-        xb = cl_data[0].cuda()
-        c_xa_current = self.gen.enc_content(xa)
-        s_xa_current = self.gen.enc_class_model(xa)
-        s_xb_current = self.gen.enc_class_model(xb)
-        xt_current = self.gen.decode(c_xa_current, s_xb_current)
-        xr_current = self.gen.decode(c_xa_current, s_xa_current)
-        c_xa = self.gen_test.enc_content(xa)
-        s_xa = self.gen_test.enc_class_model(xa)
-        s_xb = self.gen_test.enc_class_model(xb)
-        xt = self.gen_test.decode(c_xa, s_xb)
-        xr = self.gen_test.decode(c_xa, s_xa)
+        xa = self.to_device(co_data[0])
+        xb = self.to_device(cl_data[0])
+        # With master_weights gen is kept in low precision, see Trainer
+        dtype = next(self.gen.parameters()).dtype
+        xa_current, xb_current = xa.to(dtype), xb.to(dtype)
+        c_xa_current = self.gen.enc_content(xa_current)
+        s_xa_current = self.gen.enc_class_model(xa_current)
+        s_xb_current = self.gen.enc_class_model(xb_current)
+        xt_current = self.gen.decode(c_xa_current, s_xb_current).to(xa)
+        xr_current = self.gen.decode(c_xa_current, s_xa_current).to(xa)
+        # gen_test may be kept in another dtype or on another device, see ModelAverage
+        p = next(self.gen_test.parameters())
+        xa_test, xb_test = xa.to(p.device, p.dtype), xb.to(p.device, p.dtype)
+        c_xa = self.gen_test.enc_content(xa_test)
+        s_xa = self.gen_test.enc_class_model(xa_test)
+        s_xb = self.gen_test.enc_class_model(xb_test)
+        xt = self.gen_test.decode(c_xa, s_xb).to(xa)
+        xr = self.gen_test.decode(c_xa, s_xa).to(xa)
         self.train()
         return xa, xr_current, xt_current, xb, xr, xt
 
     def translate_k_shot(self, co_data, cl_data, k):
         self.eval()
-        xa = co_data[0].cuda()
-        xb = cl_data[0].cuda()
+        xa = self.to_device(co_data[0])
+        xb = self.to_device(cl_data[0])
         c_xa_current = self.gen_test.enc_content(xa)
         if k == 1:
             c_xa_current = self.gen_test.enc_content(xa)
@@ -142,21 +170,33 @@ class FUNITModel(nn.Module):
 
     def compute_k_style(self, style_batch, k):
         self.eval()
-        style_batch = style_batch.cuda()
+        style_batch = self.to_device(style_batch)
         s_xb_before = self.gen_test.enc_class_model(style_batch)
         s_xb_after = s_xb_before.squeeze(-1).permute(1, 2, 0)
         s_xb_pool = torch.nn.functional.avg_pool1d(s_xb_after, k)
         s_xb = s_xb_pool.permute(2, 0, 1).unsqueeze(-1)
         return s_xb
 
-    def translate_simple(self, content_image, class_code):
+    def translate_simple(self, content_image, class_code, adain_params=None):
+        # adain_params, e.g. from a class_bank.ClassCodeBank, replace the mlp pass over class_code
         self.eval()
-        xa = content_image.cuda()
-        s_xb_current = class_code.cuda()
+        xa = self.to_device(content_image)
         c_xa_current = self.gen_test.enc_content(xa)
+        if adain_params is not None:
+            return self.gen_test.decode_adain(c_xa_current, adain_params.to(self.get_device()))
+        s_xb_current = class_code.to(self.get_device())
         xt_current = self.gen_test.decode(c_xa_current, s_xb_current)
         return xt_current
 
-    def setOptimizersForApex(self, gen_opt, dis_opt):
-        self.gen_opt = gen_opt
-        self.dis_opt = dis_opt
+    def get_device(self):
+        # DataParallel replicas live on their own device, so ask the weights instead of GlobalConstants
+        return next(self.gen.parameters()).device
+
+    def to_device(self, images):
+        # Moves a batch of images to the model, in the memory format the model runs in
+        return images.to(self.get_device(), memory_format=GlobalConstants.getMemoryFormat())
+
+    def setGradScalers(self, gen_scaler, dis_scaler):
+        # The losses are scaled in forward, the Trainer unscales and steps with the same scalers
+        self.gen_scaler = gen_scaler
+        self.dis_scaler = dis_scaler
@@ -3,39 +3,44 @@ import torch
 class GlobalConstants():
     outputPath = None
     precision = None
-    usingApex = False
 
     inputchannels = None
     outputchannels = None
 
     optimizer = None
 
+    device = None
+    memoryFormat = torch.contiguous_format
 
     def getPrecision():
         return GlobalConstants.checkIfSet(GlobalConstants.precision, "Precision", GlobalConstants.setPrecision.__name__)
 
     def setPrecision(precision):
+        # Parameters, data and losses stay in float32, float16 and bfloat16 only set the autocast dtype
+        if (precision.upper().endswith("_APEX")):
+            precision = precision[:-len("_APEX")]
+            print("APEX is no longer used, falling back to native mixed precision with", precision)
         if (precision == "float16"):
             precision = torch.float16
+        elif (precision == "bfloat16"):
+            precision = torch.bfloat16
         elif (precision == "float32"):
             precision = torch.float32
-        elif (precision.upper() == "float16_APEX".upper()):
-            precision = torch.float16
-            GlobalConstants.usingApex = True
-            print("Using APEX")
-        elif (precision.upper() == "float32_APEX".upper()):
-            precision = torch.float32
-            GlobalConstants.usingApex = True
-            print("Using APEX")
+        else:
+            raise Exception("Unsupported precision: "+str(precision)+". Use float32, float16 or bfloat16.")
         print("Set precision to:", precision)
         GlobalConstants.precision = precision
 
-    def setTensorToPrecision(tensor):
+    def autocast():
+        # Runs the ops in the block in the mixed precision dtype where autocast considers that safe
         precision = GlobalConstants.getPrecision()
-        if (precision == torch.float16):
-            return tensor.half()
-        elif (precision == torch.float32):
-            return tensor.float()
+        return torch.autocast(GlobalConstants.getDevice().type, dtype=precision,
+                              enabled=(precision != torch.float32))
+
+    def gradScaler():
+        # Only float16 needs loss scaling, bfloat16 has the exponent range of float32
+        return torch.amp.GradScaler(GlobalConstants.getDevice().type,
+                                    enabled=(GlobalConstants.getPrecision() == torch.float16))
 
     def getOutputPath():
         return GlobalConstants.checkIfSet(GlobalConstants.outputPath, "Output path", GlobalConstants.setOutputPath.__name__)
@@ -53,6 +58,39 @@ class GlobalConstants():
     def getOutputChannels():
         return GlobalConstants.checkIfSet(GlobalConstants.outputchannels, "Output channels", GlobalConstants.setInputOutputChannels.__name__)
 
+    def getDevice():
+        return GlobalConstants.checkIfSet(GlobalConstants.device, "Device", GlobalConstants.setDevice.__name__)
+
+    def setDevice(device="auto", num_threads=None, num_interop_threads=None):
+        # "auto" picks the GPU if there is one and falls back to the CPU otherwise
+        if (device is None or device == "auto"):
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = torch.device(device)
+        if (device.type == "cuda" and not torch.cuda.is_available()):
+            raise Exception("Device "+str(device)+" was requested but CUDA is not available. Use device: cpu instead.")
+        if (device.type == "cuda" and device.index is not None):
+            torch.cuda.set_device(device)
+        elif (device.type == "cpu"):
+            # Intra-op threads parallelize single kernels, inter-op threads run independent ops concurrently
+            if (num_threads):
+                torch.set_num_threads(num_threads)
+            if (num_interop_threads):
+                try:
+                    torch.set_num_interop_threads(num_interop_threads)
+                except RuntimeError:
+                    print("Could not set inter-op threads since parallel work has already started")
+            print("Using %d intra-op and %d inter-op threads" % (torch.get_num_threads(), torch.get_num_interop_threads()))
+        print("Set device to:", device)
+        GlobalConstants.device = device
+
+    def getMemoryFormat():
+        return GlobalConstants.memoryFormat
+
+    def setMemoryFormat(channels_last=False):
+        # channels_last (NHWC) lets oneDNN on the CPU and the tensor cores on the GPU pick their faster conv kernels
+        GlobalConstants.memoryFormat = torch.channels_last if channels_last else torch.contiguous_format
+        print("Set memory format to:", GlobalConstants.memoryFormat)
+
     def setOptimizer(optimizer):
         GlobalConstants.optimizer = optimizer
     
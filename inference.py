@@ -0,0 +1,99 @@
+"""
+Helpers to run gen_test for inference without building the Trainer and its optimizers.
+"""
+import torch
+import torch.nn.functional as F
+
+from networks import FewShotGen
+from globalConstants import GlobalConstants
+
+
+def load_gen_test(config, ckpt_name, device):
+    # Loads the averaged generator that test_k_shot.py translates with
+    gen = FewShotGen(config['gen'])
+    state_dict = torch.load(ckpt_name, map_location=device)
+    gen.load_state_dict(state_dict['gen_test'])
+    return gen.to(device).eval()
+
+
+def tile_positions(length, tile_size, overlap):
+    # Start of every tile along one axis, the last tile ends with the image
+    stride = max(1, tile_size - overlap)
+    positions = list(range(0, max(1, length - tile_size + 1), stride))
+    if (positions[-1] + tile_size < length):
+        positions.append(length - tile_size)
+    return positions
+
+
+def feather_weights(tile_size, overlap):
+    # Weights that rise linearly over the overlap at every border of a tile, they never reach zero
+    ramp = torch.ones(tile_size)
+    if (overlap > 0):
+        edge = torch.arange(1, overlap + 1, dtype=torch.float) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = torch.minimum(ramp[-overlap:], edge.flip(0))
+    return ramp[:, None] * ramp[None, :]
+
+
+def translate_tiled(gen, image, class_code, tile_size=256, overlap=32, batch_size=8):
+    """
+    Translates an image of any size with gen in overlapping tiles of tile_size pixels.
+    image is a (C, H, W) tensor in [-1, 1] on any device, class_code is computed once by the caller.
+    Tiles go through enc_content and decode batch_size at a time, so the memory on the device
+    is bounded by batch_size and tile_size. The translated tiles are blended with feathered
+    weights on the CPU, the result is a (C, H, W) tensor.
+    tile_size has to be a multiple of 2**n_downs_content, images smaller than a tile are reflect padded.
+    """
+    device = next(gen.parameters()).device
+    height, width = image.shape[1:]
+    pad_bottom, pad_right = max(0, tile_size - height), max(0, tile_size - width)
+    if (pad_bottom > 0 or pad_right > 0):
+        mode = 'reflect' if (pad_bottom < height and pad_right < width) else 'replicate'
+        image = F.pad(image.unsqueeze(0), (0, pad_right, 0, pad_bottom), mode=mode).squeeze(0)
+    padded_height, padded_width = image.shape[1:]
+    positions = [(top, left) for top in tile_positions(padded_height, tile_size, overlap)
+                 for left in tile_positions(padded_width, tile_size, overlap)]
+    weights = feather_weights(tile_size, overlap)
+    output = None
+    total_weight = torch.zeros(padded_height, padded_width)
+    with torch.no_grad():
+        for start in range(0, len(positions), batch_size):
+            batch = positions[start:start + batch_size]
+            tiles = torch.stack([image[:, top:top + tile_size, left:left + tile_size] for top, left in batch])
+            tiles = tiles.to(device, memory_format=GlobalConstants.getMemoryFormat())
+            codes = class_code.to(device).expand(len(batch), *class_code.shape[1:])
+            translated = gen.decode(gen.enc_content(tiles), codes).float().cpu()
+            if output is None:
+                output = torch.zeros(translated.size(1), padded_height, padded_width)
+            for (top, left), tile in zip(batch, translated):
+                output[:, top:top + tile_size, left:left + tile_size] += tile * weights
+                total_weight[top:top + tile_size, left:left + tile_size] += weights
+    return (output / total_weight)[:, :height, :width]
+
+
+def translate_matrix(gen, content_images, class_codes, batch_size=8):
+    """
+    Translates every content image into every class, e.g. for evaluation grids.
+    content_images is an (N, C, H, W) tensor in [-1, 1], class_codes a (K, latent_dim, 1, 1) tensor.
+    Every content image goes through enc_content once and the MLP runs once per class, instead of once per
+    pair like translate_simple. The (content, class) pairs are decoded batch_size at a time.
+    Returns an (N, K, C, H, W) tensor on the CPU.
+    """
+    device = next(gen.parameters()).device
+    num_contents, num_classes = content_images.size(0), class_codes.size(0)
+    with torch.no_grad():
+        adain_params = gen.mlp(class_codes.to(device))
+        output = None
+        # As many content images at a time as their pairs fill about one batch
+        contents_per_batch = max(1, batch_size // num_classes)
+        for start in range(0, num_contents, contents_per_batch):
+            images = content_images[start:start + contents_per_batch]
+            content = gen.enc_content(images.to(device, memory_format=GlobalConstants.getMemoryFormat()))
+            pairs = [(n, k) for n in range(content.size(0)) for k in range(num_classes)]
+            for first in range(0, len(pairs), batch_size):
+                n, k = [torch.tensor(i, device=device) for i in zip(*pairs[first:first + batch_size])]
+                translated = gen.decode_adain(content[n], adain_params[k]).float().cpu()
+                if output is None:
+                    output = torch.zeros(num_contents, num_classes, *translated.shape[1:])
+                output[start + n.cpu(), k.cpu()] = translated
+    return output
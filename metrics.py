@@ -0,0 +1,137 @@
+"""
+Otsu thresholds, foreground masks and their overlaps for whole batches of images as tensors, on the device of the images.
+The vectorized counterpart of utils.otsu_iou, which thresholds one numpy image at a time with skimage.
+
+otsu_thresholds follows skimage.filters.threshold_otsu: a histogram of nbins bins from the minimum to the maximum of
+each floating point image, with the bin edges of numpy.histogram, or one bin per value for integer images, and the
+center of the bin that maximizes the between-class variance, in the precision skimage and numpy use for the dtype.
+The thresholds match skimage up to the order in which the sums are rounded, tests/test_metrics.py checks the difference.
+Images that have only one value get that value as threshold and an empty mask, like skimage.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from utils import load_evaluation_pic
+
+NBINS = 256
+
+
+def histogram_bins(images, nbins=NBINS):
+    """
+    Bin of every pixel of the (B, N) images, the (B, bins) bin centers and the number of bins each image uses.
+    Floating point images have nbins bins each, integer images one per value from their minimum to their maximum.
+    Like numpy.histogram the bins of float32 images are computed in float32 and the others in float64.
+    """
+    if not images.dtype.is_floating_point:
+        values = images.long()
+        mins = values.min(1, keepdim=True)[0]
+        counts = (values.max(1)[0] - mins.squeeze(1)) + 1
+        # At least two bins, so that a batch of constant images still has a split between bins
+        centers = mins + torch.arange(max(int(counts.max()), 2), device=images.device)
+        return values - mins, centers.double(), counts
+    dtype = torch.float64 if images.dtype == torch.float64 else torch.float32
+    values = images.to(dtype)
+    mins = values.min(1, keepdim=True)[0]
+    maxs = values.max(1, keepdim=True)[0]
+    # Constant images get a range of 1 instead of 0, their threshold is their value anyway
+    ranges = maxs - mins
+    ranges = torch.where(ranges > 0, ranges, torch.ones_like(ranges))
+    # numpy.linspace computes the edges in float64 and casts them to the dtype of the image
+    edges = mins.double() + ranges.double() * torch.linspace(0, 1, nbins + 1, device=images.device,
+                                                              dtype=torch.float64)
+    edges = edges.to(dtype)
+    edges[:, -1:] = maxs
+    # The bin from the scaled value, then corrected against the edges it would round past
+    index = ((values - mins) * (nbins / ranges)).clamp_(0, nbins - 1).long()
+    index.sub_((values < edges.gather(1, index)).long())
+    # The last bin also holds the maximum, its upper edge never moves a value up
+    upper = edges[:, 1:].clone()
+    upper[:, -1] = float('inf')
+    index.add_((values >= upper.gather(1, index)).long())
+    centers = (edges[:, :-1] + edges[:, 1:]) / 2
+    return index, centers, torch.full((images.size(0),), nbins, device=images.device, dtype=torch.long)
+
+
+def otsu_thresholds(images, nbins=NBINS):
+    # (B,) thresholds of a batch of (B, ...) grayscale images, in float64
+    images = images.reshape(images.size(0), -1)
+    index, centers, valid = histogram_bins(images, nbins)
+    # skimage counts in float32, the sums take the dtype of the bin centers
+    counts = torch.zeros(centers.shape, device=centers.device, dtype=torch.float32)
+    counts = counts.scatter_add_(1, index, torch.ones(index.shape, device=index.device)).to(centers.dtype)
+    weight1 = counts.cumsum(1)
+    weight2 = counts.flip(1).cumsum(1).flip(1)
+    mean1 = (counts * centers).cumsum(1) / weight1
+    mean2 = (counts * centers).flip(1).cumsum(1).flip(1) / weight2
+    variance12 = weight1[:, :-1] * weight2[:, 1:] * (mean1[:, :-1] - mean2[:, 1:]) ** 2
+    # Integer images with fewer values than the widest one of the batch leave empty bins at the end
+    bins = torch.arange(variance12.size(1), device=images.device)
+    variance12 = variance12.masked_fill(bins >= (valid - 1).unsqueeze(1), float('-inf')).nan_to_num(nan=float('-inf'))
+    thresholds = centers.gather(1, variance12.argmax(1, keepdim=True)).squeeze(1).double()
+    constant = images.amin(1) == images.amax(1)
+    return torch.where(constant, images[:, 0].double(), thresholds)
+
+
+def otsu_masks(images, nbins=NBINS):
+    # Foreground of every image of the batch, the pixels above its Otsu threshold
+    thresholds = otsu_thresholds(images, nbins)
+    return images.double() > thresholds.view(-1, *([1] * (images.dim() - 1)))
+
+
+def mask_iou(a, b):
+    # Intersection over union in percent of two batches of masks, 100 where both are empty like utils.otsu_iou
+    a, b = a.reshape(a.size(0), -1), b.reshape(b.size(0), -1)
+    intersection = (a & b).sum(1).double()
+    union = (a | b).sum(1).double()
+    return torch.where(union > 0, intersection / union.clamp_min(1) * 100, torch.full_like(union, 100.0))
+
+
+def mask_dice(a, b):
+    # Dice coefficient in percent of two batches of masks, 100 where both are empty
+    a, b = a.reshape(a.size(0), -1), b.reshape(b.size(0), -1)
+    intersection = (a & b).sum(1).double()
+    total = (a.sum(1) + b.sum(1)).double()
+    return torch.where(total > 0, 2 * intersection / total.clamp_min(1) * 100, torch.full_like(total, 100.0))
+
+
+def otsu_iou_batch(fake, real, nbins=NBINS):
+    # utils.otsu_iou of every pair of a batch of images, as a (B,) tensor
+    return mask_iou(otsu_masks(fake, nbins), otsu_masks(real, nbins))
+
+
+class ReferenceMaskCache():
+    """
+    Otsu masks of reference images on device, keyed by path, for evaluations that compare many translations with the
+    same references. The images are loaded by loader, acc_test.py's preprocessing by default, with num_threads threads.
+    At most max_size masks are kept, the least recently used one is dropped first.
+    """
+    def __init__(self, device, loader=load_evaluation_pic, max_size=2048, num_threads=4, nbins=NBINS):
+        self.device = device
+        self.loader = loader
+        self.max_size = max_size
+        self.nbins = nbins
+        self.pool = ThreadPoolExecutor(max_workers=num_threads)
+        self.masks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, paths):
+        # (B, H, W) masks of the images in paths, which have to be of the same size
+        missing = list(OrderedDict.fromkeys(p for p in paths if p not in self.masks))
+        self.misses += len(missing)
+        self.hits += len(paths) - len(missing)
+        if missing:
+            images = torch.stack([torch.as_tensor(image) for image in self.pool.map(self.loader, missing)])
+            for path, mask in zip(missing, otsu_masks(images.to(self.device), self.nbins)):
+                self.masks[path] = mask
+        result = torch.stack([self.masks[p] for p in paths])
+        for path in paths:
+            self.masks.move_to_end(path)
+        while len(self.masks) > self.max_size:
+            self.masks.popitem(last=False)
+        return result
+
+    def close(self):
+        self.pool.shutdown()
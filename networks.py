@@ -3,11 +3,16 @@ Copyright (C) 2019 NVIDIA Corporation.  All rights reserved.
 Licensed under the CC BY-NC-SA 4.0 license
 (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
+import math
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 
 import torch
 from torch import nn
 from torch import autograd
+from torch.utils.checkpoint import checkpoint
 
 from blocks import LinearBlock, ResBlocks, ActFirstResBlock, InceptionBlock, Conv2dBlock
 
@@ -36,6 +41,98 @@ def assign_adain_params(adain_params, model):
                 adain_params = adain_params[:, 2*m.num_features:]
 
 
+class AdainCache():
+    """
+    Bounded LRU cache of the AdaIN parameters FewShotGen.mlp computes from class codes, for inference that
+    translates many content images to a few classes. A class code is looked up by the identity of its tensor
+    first, which needs no copy from the device, and then by a hash of its values.
+    Every identity entry keeps its tensor alive, so no other tensor can take its memory while it is cached,
+    and changing it in place bumps its version. Changed MLP weights, e.g. by load_state_dict, empty the cache.
+    Codes expanded along the batch, like in inference.translate_tiled, are cached by their first row.
+    """
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.identities = OrderedDict()
+        self.weights_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.identities.clear()
+
+    def value_key(self, code):
+        data = code.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes()
+        return (hashlib.sha1(data).hexdigest(), tuple(code.shape), code.dtype)
+
+    def insert(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def __call__(self, mlp, code):
+        weights_version = tuple((p.data_ptr(), p._version) for p in mlp.parameters())
+        if weights_version != self.weights_version:
+            self.clear()
+            self.weights_version = weights_version
+        batch_size = code.size(0)
+        if batch_size > 1 and code.stride(0) == 0:
+            code = code[:1]
+        # Inference tensors have no version counter, they are always looked up by their values
+        identity = None if code.is_inference() else \
+            (code.data_ptr(), code._version, tuple(code.shape), code.stride(), code.dtype, code.device)
+        if identity in self.identities:
+            key = self.identities[identity][1]
+            self.identities.move_to_end(identity)
+        else:
+            key = self.value_key(code)
+            if identity is not None:
+                self.insert(self.identities, identity, (code, key))
+        adain_params = self.entries.get(key)
+        if adain_params is None:
+            self.misses += 1
+            adain_params = mlp(code)
+            self.insert(self.entries, key, adain_params)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return adain_params.expand(batch_size, -1) if adain_params.size(0) != batch_size else adain_params
+
+    def hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+    def __str__(self):
+        return "AdaIN cache: %d hits, %d misses (%.1f%% hit rate), %d of %d entries" % (
+            self.hits, self.misses, 100 * self.hit_rate(), len(self.entries), self.max_size)
+
+
+def run_sequential(model, x, segments=0, adain_params=None, adain_model=None):
+    """
+    Runs the nn.Sequential model on x. With segments > 0 it is split into that many segments
+    and only their inputs are kept for backward, the rest is recomputed during backward.
+    Non-reentrant checkpointing also supports the create_graph=True gradients of the R1 penalty,
+    but those keep the recomputed activations for the second backward.
+    adain_params are assigned to adain_model again before a segment is recomputed, since other
+    decode calls may have assigned their own in the meantime.
+    """
+    if (segments <= 0 or not model.training or not torch.is_grad_enabled()):
+        return model(x)
+    layers = list(model)
+    size = math.ceil(len(layers) / segments)
+    for start in range(0, len(layers), size):
+        x = checkpoint(run_segment, nn.Sequential(*layers[start:start + size]), x, adain_params, adain_model,
+                       use_reentrant=False)
+    return x
+
+
+def run_segment(segment, x, adain_params, adain_model):
+    if adain_params is not None:
+        assign_adain_params(adain_params, adain_model)
+    return segment(x)
+
+
 def get_num_adain_params(model):
     # return the number of AdaIN parameters needed by the model
     num_adain_params = 0
@@ -60,13 +157,13 @@ class GPPatchMcResDis(nn.Module):
                              norm='none',
                              activation='none')]
         for i in range(self.n_layers -1 ):
-            nf_out = np.min([nf * 2, 1024])
+            nf_out = min(nf * 2, 1024)
             cnn_f += [ActFirstResBlock(nf, nf, None, 'lrelu', 'none')]
             cnn_f += [ActFirstResBlock(nf, nf_out, None, 'lrelu', 'none')]
             cnn_f += [nn.ReflectionPad2d(1)]
             cnn_f += [nn.AvgPool2d(kernel_size=3, stride=2)]
-            nf = np.min([nf * 2, 1024])
-        nf_out = np.min([nf * 2, 1024])
+            nf = min(nf * 2, 1024)
+        nf_out = min(nf * 2, 1024)
         cnn_f += [ActFirstResBlock(nf, nf, None, 'lrelu', 'none')]
         cnn_f += [ActFirstResBlock(nf, nf_out, None, 'lrelu', 'none')]
         cnn_c = [Conv2dBlock(nf_out, hp['num_classes'], 1, 1,
@@ -75,6 +172,7 @@ class GPPatchMcResDis(nn.Module):
                              activation_first=True)]
         self.cnn_f = nn.Sequential(*cnn_f)
         self.cnn_c = nn.Sequential(*cnn_c)
+        self.checkpoint_segments = hp.get('checkpoint_segments', 0)
 
         #self.register_backward_hook(debug.printgradnorm)
         self.debug = Debugger()
@@ -83,18 +181,18 @@ class GPPatchMcResDis(nn.Module):
         DebugNet.setName("GPPatchMcResDis")
         #print("FORWARD ",self.__class__.__name__)
         assert(x.size(0) == y.size(0))
-        feat = self.cnn_f(x)
+        feat = run_sequential(self.cnn_f, x, self.checkpoint_segments)
         out = self.cnn_c(feat)
-        index = torch.LongTensor(range(out.size(0))).cuda()
+        index = torch.arange(out.size(0), device=out.device)
         out = out[index, y, :, :]
         return out, feat
 
     def calc_dis_fake_loss(self, input_fake, input_label):
         #self.debug.printCheckpoint(self.calc_dis_fake_loss)
-        resp_fake, gan_feat = self.forward(input_fake, input_label)
+        resp_fake, gan_feat = self(input_fake, input_label)
         total_count = torch.tensor(np.prod(resp_fake.size()),
-                                   dtype=torch.float).cuda()
-        fake_loss = torch.nn.ReLU()(1.0 + resp_fake).mean()
+                                   dtype=torch.float, device=resp_fake.device)
+        fake_loss = torch.nn.ReLU()(1.0 + resp_fake.float()).mean()
         correct_count = (resp_fake < 0).sum()
         fake_accuracy = correct_count.type_as(fake_loss) / total_count
         return fake_loss, fake_accuracy, resp_fake
@@ -102,23 +200,23 @@ class GPPatchMcResDis(nn.Module):
     def calc_dis_real_loss(self, input_real, input_label):
         #self.debug.printCheckpoint(self.calc_dis_real_loss)
         debug = Debugger(self.calc_dis_real_loss, self, PREFIX)
-        resp_real, gan_feat = self.forward(input_real, input_label)
+        resp_real, gan_feat = self(input_real, input_label)
         total_count = torch.tensor(np.prod(resp_real.size()),
-                                   dtype=torch.float).cuda()
-        real_loss = torch.nn.ReLU()(1.0 - resp_real).mean()
+                                   dtype=torch.float, device=resp_real.device)
+        real_loss = torch.nn.ReLU()(1.0 - resp_real.float()).mean()
         correct_count = (resp_real >= 0).sum()
         real_accuracy = correct_count.type_as(real_loss) / total_count
         return real_loss, real_accuracy, resp_real
 
     def calc_gen_loss(self, input_fake, input_fake_label):
         #self.debug.printCheckpoint(self.calc_gen_loss)
-        resp_fake, gan_feat = self.forward(input_fake, input_fake_label)
+        resp_fake, gan_feat = self(input_fake, input_fake_label)
         #print("resp_fake: max: %d, min: %d" % (resp_fake.max(), resp_fake.min()))
         #print("gan_feat: max: %d, min: %d" % (gan_feat.max(), gan_feat.min()))
         #print("input_fake: max: %d, min: %d" % (input_fake.max(), input_fake.min()))
         total_count = torch.tensor(np.prod(resp_fake.size()),
-                                   dtype=torch.float).cuda()
-        loss = -resp_fake.mean()
+                                   dtype=torch.float, device=resp_fake.device)
+        loss = -resp_fake.float().mean()
         #print("CALC_GEN_LOSS: ",loss)
         correct_count = (resp_fake >= 0).sum()
         #print("CORRECT COUNT: %d, TOTAL COUNT: %d" % (correct_count, total_count))
@@ -126,15 +224,21 @@ class GPPatchMcResDis(nn.Module):
         #print("ACC: ",accuracy)
         return loss, accuracy, gan_feat
 
-    def calc_grad2(self, d_out, x_in):
+    def calc_grad2(self, d_out, x_in, scaler=None):
         #self.debug.printCheckpoint(self.calc_grad2)
         batch_size = x_in.size(0)
-        grad_dout = autograd.grad(outputs=d_out.mean(),
+        d_out = d_out.float().mean()
+        if scaler is not None:
+            # Scaled like the losses so that float16 gradients don't underflow, unscaled right after
+            d_out = scaler.scale(d_out)
+        grad_dout = autograd.grad(outputs=d_out,
                                   inputs=x_in,
                                   create_graph=True,
                                   retain_graph=True,
                                   only_inputs=True)[0]
-        grad_dout2 = grad_dout.pow(2)
+        if scaler is not None and scaler.is_enabled():
+            grad_dout = grad_dout / scaler.get_scale()
+        grad_dout2 = grad_dout.float().pow(2)
         assert (grad_dout2.size() == x_in.size())
         reg = grad_dout2.sum()/batch_size
         return reg
@@ -159,6 +263,7 @@ class FewShotGen(nn.Module):
                                                  norm='none',
                                                  activ='relu',
                                                  pad_type='reflect')
+        self.adain_cache = None
 
         self.enc_content = ContentEncoder(down_content,
                                           n_res_blks,
@@ -166,7 +271,8 @@ class FewShotGen(nn.Module):
                                           nf,
                                           'in',
                                           activ='relu',
-                                          pad_type='reflect')
+                                          pad_type='reflect',
+                                          checkpoint_segments=hp.get('checkpoint_content', 0))
 
         self.dec = Decoder(down_content,
                            n_res_blks,
@@ -174,7 +280,8 @@ class FewShotGen(nn.Module):
                            output_channels,
                            res_norm='adain',
                            activ='relu',
-                           pad_type='reflect')
+                           pad_type='reflect',
+                           checkpoint_segments=hp.get('checkpoint_dec', 0))
 
         self.mlp = MLP(latent_dim,
                        get_num_adain_params(self.dec),
@@ -200,12 +307,41 @@ class FewShotGen(nn.Module):
         class_code = torch.mean(class_codes, dim=0).unsqueeze(0)
         return content, class_code
 
+    def fuse_for_inference(self, max_flop_ratio=1.0):
+        # Rewrites the blocks in place into equivalent single convolutions, afterwards the generator can't be trained.
+        # max_flop_ratio bounds how many more multiply-adds a rewrite with fewer convolutions may cost
+        self.eval()
+        with torch.no_grad():
+            for m in list(self.modules()):
+                if isinstance(m, Conv2dBlock):
+                    m.fuse(max_flop_ratio)
+        return self
+
+    def compile_submodules(self, mode="default"):
+        # Compiles the encoders, the MLP and the decoder in place with torch.compile, the state dict stays the same.
+        # assign_adain_params runs eagerly between the MLP and the decoder, whose graph reads the AdaIN parameters as inputs.
+        # Don't deep copy the generator afterwards, the copies would still call the compiled original
+        for m in (self.enc_content, self.enc_class_model, self.mlp, self.dec):
+            m.compile(mode=mode)
+        return self
+
+    def enable_adain_cache(self, max_size=16):
+        # Caches the AdaIN parameters of the last max_size class codes for decode without gradients, 0 disables it
+        self.adain_cache = AdainCache(max_size) if max_size > 0 else None
+        return self
+
     def decode(self, content, model_code):
         # decode content and style codes to an image
+        if self.adain_cache is not None and not torch.is_grad_enabled():
+            return self.decode_adain(content, self.adain_cache(self.mlp, model_code))
+        return self.decode_adain(content, self.mlp(model_code))
+
+    def decode_adain(self, content, adain_params):
+        # decode content codes with the AdaIN parameters the mlp computed from a class code,
+        # e.g. the ones stored in a class_bank.ClassCodeBank
         DebugNet.setName("FewShotGen_Decode")
-        adain_params = self.mlp(model_code)
         assign_adain_params(adain_params, self.dec)
-        images = self.dec(content)
+        images = self.dec(content, adain_params)
         return images
 
 
@@ -243,7 +379,7 @@ class ClassModelEncoder(nn.Module):
 
 
 class ContentEncoder(nn.Module):
-    def __init__(self, downs, n_res, input_dim, dim, norm, activ, pad_type):
+    def __init__(self, downs, n_res, input_dim, dim, norm, activ, pad_type, checkpoint_segments=0):
         super(ContentEncoder, self).__init__()
         #InceptionBlock = Conv2dBlock
         self.model = []
@@ -282,17 +418,18 @@ class ContentEncoder(nn.Module):
                                  inception=True)]
         self.model = nn.Sequential(*self.model)
         self.output_dim = dim
+        self.checkpoint_segments = checkpoint_segments
 
         #self.register_backward_hook(debug.printgradnorm)
 
     def forward(self, x):
         #print("FORWARD ",self.__class__.__name__)
         DebugNet.setName("Content_Encoder")
-        return self.model(x)
+        return run_sequential(self.model, x, self.checkpoint_segments)
 
 
 class Decoder(nn.Module):
-    def __init__(self, ups, n_res, dim, out_dim, res_norm, activ, pad_type):
+    def __init__(self, ups, n_res, dim, out_dim, res_norm, activ, pad_type, checkpoint_segments=0):
         super(Decoder, self).__init__()
         #InceptionBlock = Conv2dBlock
         self.model = []
@@ -312,15 +449,17 @@ class Decoder(nn.Module):
                                    pad_type=pad_type)]
 
         self.model = nn.Sequential(*self.model)
+        self.checkpoint_segments = checkpoint_segments
 
         #self.register_backward_hook(debug.printgradnorm)
 
 
 
-    def forward(self, x):
+    def forward(self, x, adain_params=None):
+        # adain_params are only needed to recompute checkpointed segments, they have to be assigned already
         #print("FORWARD ",self.__class__.__name__)
         DebugNet.setName("Decoder")
-        return self.model(x)
+        return run_sequential(self.model, x, self.checkpoint_segments, adain_params, self)
 
 
 class MLP(nn.Module):
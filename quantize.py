@@ -0,0 +1,196 @@
+"""
+Post-training INT8 quantization of gen_test for serving on the CPU.
+    MLP                         dynamic quantization of the LinearBlocks
+    ContentEncoder, Decoder     static quantization of the Conv2dBlock convolutions, calibrated on the train loaders
+Padding, normalization and activations stay in float, every quantized convolution gets its own quant/dequant pair.
+Each layer is checked on its own against the float generator with the Otsu overlap of acc_test.py,
+layers that degrade the translation too much stay in float.
+The quantized generator is saved as TorchScript artifacts of export.py, ExportedGenerator runs them.
+
+USE FOLLOWING COMMAND TO EXECUTE:
+python quantize.py --config configs/funit_B022.yaml --ckpt pretrained/gen_00470000.pt --output_dir exported_int8
+python export.py --run exported_int8 --input images/input_content.jpg --class_image_folder images/n02138411 --output images/output.jpg
+"""
+import io
+import os
+import shutil
+import argparse
+import itertools
+
+import torch
+import torch.nn as nn
+import torch.ao.quantization as quantization
+
+from blocks import LinearBlock
+from globalConstants import GlobalConstants
+from utils import get_config, get_train_loaders_custom, time_it
+from metrics import otsu_iou_batch
+from export import export_generator
+
+
+def quantization_engine():
+    engines = torch.backends.quantized.supported_engines
+    return 'x86' if 'x86' in engines else 'qnnpack'
+
+
+def quantizable_layers(gen):
+    # (name, owner, attribute) of every layer that can be swapped for a quantized one
+    layers = []
+    for part in ('enc_content', 'dec'):
+        for name, m in getattr(gen, part).named_modules():
+            # Exact class name, the InceptionBlock subclass has its own forward
+            if m.__class__.__name__ == "Conv2dBlock":
+                layers.append((part + '.' + name + '.conv', m, 'conv'))
+    for name, m in gen.mlp.named_modules():
+        if isinstance(m, LinearBlock):
+            layers.append(('mlp.' + name + '.fc', m, 'fc'))
+    return layers
+
+
+def translate(gen, batches):
+    # Translates every (content, class) batch with the class codes of the class images
+    outputs = []
+    with torch.no_grad():
+        for content, classes in batches:
+            outputs.append(gen.decode(gen.enc_content(content), gen.enc_class_model(classes)))
+    return outputs
+
+
+def translation_iou(outputs, references):
+    # Mean Otsu overlap in percent of every translated image with its float reference
+    ious = torch.cat([otsu_iou_batch(output, reference) for output, reference in zip(outputs, references)])
+    return ious.mean().item()
+
+
+def model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def quantize_generator(gen, calibration_batches, evaluation_batches, layer_tolerance=0.5, tolerance=2.0):
+    """
+    Quantizes gen in place and returns the names of the quantized and float layers and the
+    mean overlap in percent of the quantized with the float translation.
+    A layer stays in float if quantizing only that layer lowers the mean overlap with the
+    float translation by more than layer_tolerance percent. If all remaining layers together
+    lower it by more than tolerance percent, the most sensitive ones go back to float as well.
+    """
+    torch.backends.quantized.engine = quantization_engine()
+    gen = gen.cpu().eval()
+    references = translate(gen, evaluation_batches)
+    layers = quantizable_layers(gen)
+
+    # Observe the float activations of all convolutions in one calibration pass
+    qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+    float_layers = {name: getattr(owner, attribute) for name, owner, attribute in layers}
+    observed = {}
+    for name, owner, attribute in layers:
+        if attribute == 'conv':
+            layer = nn.Sequential(quantization.QuantStub(), float_layers[name], quantization.DeQuantStub())
+            layer.qconfig = qconfig
+            # prepare works on a copy, the float convolution stays untouched
+            observed[name] = quantization.prepare(layer)
+            setattr(owner, attribute, observed[name])
+    translate(gen, calibration_batches)
+
+    candidates = {}
+    for name, owner, attribute in layers:
+        if attribute == 'conv':
+            quantized_layer = quantization.convert(observed[name])
+        else:
+            quantized_layer = quantization.quantize_dynamic(nn.Sequential(float_layers[name]), {nn.Linear},
+                                                            dtype=torch.qint8)[0]
+        # The qconfig holds local functions, without it the quantized generator can be pickled
+        for m in quantized_layer.modules():
+            if hasattr(m, 'qconfig'):
+                del m.qconfig
+        setattr(owner, attribute, float_layers[name])
+        candidates[name] = (owner, attribute, float_layers[name], quantized_layer)
+
+    def set_quantized(names):
+        for name, (owner, attribute, float_layer, quantized_layer) in candidates.items():
+            setattr(owner, attribute, quantized_layer if name in names else float_layer)
+
+    sensitivity = {}
+    for name in candidates:
+        set_quantized([name])
+        sensitivity[name] = 100 - translation_iou(translate(gen, evaluation_batches), references)
+        print("%-40s overlap drop %6.3f%%" % (name, sensitivity[name]))
+    quantized = sorted((name for name in candidates if sensitivity[name] <= layer_tolerance),
+                       key=lambda name: sensitivity[name])
+    overlap = 100.0
+    while quantized:
+        set_quantized(quantized)
+        overlap = translation_iou(translate(gen, evaluation_batches), references)
+        if (100 - overlap <= tolerance):
+            break
+        quantized.pop()
+        overlap = 100.0
+    set_quantized(quantized)
+    return quantized, [name for name in candidates if name not in quantized], overlap
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',
+                        type=str,
+                        default='configs/funit_B022.yaml')
+    parser.add_argument('--ckpt',
+                        type=str,
+                        default='pretrained/animal119_gen_00200000.pt')
+    parser.add_argument('--output_dir',
+                        type=str,
+                        default='exported_int8')
+    parser.add_argument('--calibration_batches',
+                        type=int,
+                        default=16)
+    parser.add_argument('--evaluation_batches',
+                        type=int,
+                        default=4)
+    parser.add_argument('--layer_tolerance',
+                        type=float,
+                        default=0.5,
+                        help="overlap drop in percent at which a single layer stays in float")
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=2.0,
+                        help="overlap drop in percent allowed for the whole generator")
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=0)
+    opts = parser.parse_args()
+
+    config = get_config(opts.config)
+    GlobalConstants.setPrecision(config['precision'])
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+    GlobalConstants.setDevice('cpu', opts.num_threads)
+
+    from inference import load_gen_test
+    gen = load_gen_test(config, opts.ckpt, torch.device('cpu'))
+    float_size = model_size(gen)
+    # Calibrate on the train loaders and evaluate on the test loaders, as in training
+    train_content, train_class, test_content, test_class = get_train_loaders_custom(config)
+    calibration = [(co[0], cl[0]) for co, cl in
+                   itertools.islice(zip(train_content, train_class), opts.calibration_batches)]
+    evaluation = [(co[0], cl[0]) for co, cl in
+                  itertools.islice(zip(test_content, test_class), opts.evaluation_batches)]
+
+    float_time = time_it(lambda: translate(gen, evaluation[:1]), torch.device('cpu'), 5, 1)
+    quantized, kept_float, overlap = quantize_generator(gen, calibration, evaluation,
+                                                        opts.layer_tolerance, opts.tolerance)
+    quantized_time = time_it(lambda: translate(gen, evaluation[:1]), torch.device('cpu'), 5, 1)
+    # Quantized convolutions don't survive pickling the whole module, TorchScript keeps them
+    export_generator(gen, opts.output_dir, 'torchscript', size=config['desired_size'])
+    shutil.copy(opts.config, os.path.join(opts.output_dir, 'config.yaml'))
+
+    print("quantized %d layers, %d stay in float: %s" % (len(quantized), len(kept_float), ", ".join(kept_float)))
+    print("overlap with the float generator: %.3f%%" % overlap)
+    print("model size: %.2f MB -> %.2f MB" % (float_size / 2**20, model_size(gen) / 2**20))
+    batch_size = evaluation[0][0].size(0)
+    print("throughput: %.2f -> %.2f images/s" % (batch_size / float_time * 1000, batch_size / quantized_time * 1000))
+    print('Save quantized generator to %s' % opts.output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""
+Local HTTP service that loads gen_test once and translates images on request. Requests that arrive within
+--max_latency_ms of each other are translated together, up to --max_batch_size images per batch.
+    POST /translate?class_id=<id>[&content_class=<name>]   body: encoded content image   -> PNG of the translation
+    POST /translate                                        body: content image followed by a class image, with
+                                                           the length of the class image in X-Class-Image-Length
+    POST /classes?class_id=<id>                            body: encoded class image, or a class code saved with
+                                                           numpy.save and Content-Type application/x-npy
+    GET  /classes                                          ids of the registered classes
+    GET  /metrics                                          requests, batch sizes and latencies as JSON
+content_class is the class folder name whose preprocessing default_loader_custom applies to the content image.
+The class folders given at startup are registered under their folder name with their mean class code,
+from --class_bank if given.
+
+USE FOLLOWING COMMAND TO EXECUTE:
+python server.py --config configs/funit_B022.yaml --ckpt pretrained/gen_00470000.pt --class_image_folders images/n02138411 --port 8000
+curl --data-binary @images/input_content.jpg "http://127.0.0.1:8000/translate?class_id=n02138411" -o images/output.png
+"""
+import io
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import torch
+from PIL import Image
+
+from globalConstants import GlobalConstants
+from utils import get_config, get_test_transform, to_output_image
+from data import bytes_loader_custom
+from class_bank import ClassCodeBank, list_class_images, encode_class_images
+
+
+class Metrics():
+    # Counts requests and batches and keeps the latencies of the last window requests
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batch_sizes = Counter()
+        self.queue_times = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+
+    def record(self, queue_times, latencies):
+        with self.lock:
+            self.requests += len(latencies)
+            self.batch_sizes[len(latencies)] += 1
+            self.queue_times.extend(queue_times)
+            self.latencies.extend(latencies)
+
+    def summary(self):
+        with self.lock:
+            batches = sum(self.batch_sizes.values())
+            summary = {'requests': self.requests,
+                       'batches': batches,
+                       'mean_batch_size': self.requests / max(1, batches),
+                       'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())}}
+            for name, values in (('queue_ms', self.queue_times), ('latency_ms', self.latencies)):
+                if len(values) > 0:
+                    values = np.array(values) * 1000
+                    summary[name] = {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+                                     'p95': float(np.percentile(values, 95)), 'p99': float(np.percentile(values, 99)),
+                                     'max': float(values.max())}
+        return summary
+
+
+class DynamicBatcher():
+    """
+    Collects the requests of the handler threads into batches for a single generator thread. A batch is
+    translated when max_batch_size requests are waiting or max_latency seconds after its first request arrived.
+    Requests of different classes share a batch, the AdaIN parameters of each class come from the cache of gen.
+    Content images of different sizes are translated in separate batches.
+    """
+    def __init__(self, gen, max_batch_size=16, max_latency=0.01):
+        self.gen = gen
+        self.device = next(gen.parameters()).device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.metrics = Metrics()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, content, class_code):
+        # content is a (C, H, W) tensor in [-1, 1], returns a Future of the translated (C, H, W) tensor on the CPU
+        future = Future()
+        self.queue.put((time.perf_counter(), content, class_code, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = first[0] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.queue.get(timeout=max(0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.queue.put(None)
+                    break
+                batch.append(request)
+            start = time.perf_counter()
+            shapes = {}
+            for request in batch:
+                shapes.setdefault(tuple(request[1].shape), []).append(request)
+            for requests in shapes.values():
+                self.translate(requests, start)
+
+    def adain_params(self, class_code):
+        if self.gen.adain_cache is not None:
+            return self.gen.adain_cache(self.gen.mlp, class_code)
+        return self.gen.mlp(class_code)
+
+    def translate(self, requests, start):
+        try:
+            with torch.no_grad():
+                content = torch.stack([r[1] for r in requests]).to(
+                    self.device, memory_format=GlobalConstants.getMemoryFormat())
+                adain_params = torch.cat([self.adain_params(r[2]) for r in requests])
+                output_images = self.gen.decode_adain(self.gen.enc_content(content), adain_params).float().cpu()
+        except Exception as e:
+            for r in requests:
+                r[3].set_exception(e)
+            return
+        end = time.perf_counter()
+        self.metrics.record([start - r[0] for r in requests], [end - r[0] for r in requests])
+        for r, output_image in zip(requests, output_images):
+            r[3].set_result(output_image)
+
+
+class TranslationService():
+    # The state the request handlers share: the generator, its batcher and the registered class codes
+    def __init__(self, gen, transform, max_batch_size=16, max_latency=0.01):
+        self.gen = gen
+        self.transform = transform
+        self.batcher = DynamicBatcher(gen, max_batch_size, max_latency)
+        self.class_codes = {}
+        self.lock = threading.Lock()
+
+    def add_class(self, class_id, class_code):
+        with self.lock:
+            self.class_codes[class_id] = class_code.to(next(self.gen.parameters()).device)
+
+    def encode_class(self, data, class_name=""):
+        image = self.transform(bytes_loader_custom(data, class_name)).unsqueeze(0)
+        with torch.no_grad():
+            return self.gen.enc_class_model(image.to(next(self.gen.parameters()).device))
+
+    def translate(self, content_data, class_code, content_class=""):
+        content = self.transform(bytes_loader_custom(content_data, content_class))
+        return self.batcher.submit(content, class_code).result()
+
+
+def encode_png(output_image):
+    buffer = io.BytesIO()
+    Image.fromarray(to_output_image(output_image)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body, content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self.reply(200, service.batcher.metrics.summary())
+        elif path == '/classes':
+            self.reply(200, sorted(service.class_codes.keys()))
+        else:
+            self.reply(404, {'error': 'unknown path %s' % path})
+
+    def do_POST(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if url.path == '/classes':
+                if 'class_id' not in query:
+                    return self.reply(400, {'error': 'class_id is missing'})
+                if self.headers.get('Content-Type') == 'application/x-npy':
+                    class_code = torch.from_numpy(np.load(io.BytesIO(body))).to(next(service.gen.parameters()).dtype)
+                else:
+                    class_code = service.encode_class(body, query.get('class_name', ''))
+                service.add_class(query['class_id'], class_code.reshape(1, -1, 1, 1))
+                self.reply(200, {'class_id': query['class_id']})
+            elif url.path == '/translate':
+                class_image_length = int(self.headers.get('X-Class-Image-Length', 0))
+                if class_image_length > 0:
+                    class_code = service.encode_class(body[-class_image_length:], query.get('class_name', ''))
+                    body = body[:-class_image_length]
+                elif query.get('class_id') in service.class_codes:
+                    class_code = service.class_codes[query['class_id']]
+                else:
+                    return self.reply(404, {'error': 'unknown class_id %s' % query.get('class_id')})
+                output_image = service.translate(body, class_code, query.get('content_class', ''))
+                self.reply(200, encode_png(output_image), 'image/png')
+            else:
+                self.reply(404, {'error': 'unknown path %s' % url.path})
+        except Exception as e:
+            self.reply(400, {'error': '%s: %s' % (type(e).__name__, e)})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def create_server(service, host='127.0.0.1', port=8000, verbose=False):
+    # Port 0 picks a free port, server.server_address has the one that was bound
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',
+                        type=str,
+                        default='configs/funit_B022.yaml')
+    parser.add_argument('--ckpt',
+                        type=str,
+                        default='pretrained/animal119_gen_00200000.pt')
+    parser.add_argument('--class_image_folders',
+                        type=str,
+                        nargs='*',
+                        default=[])
+    parser.add_argument('--class_bank',
+                        type=str,
+                        default="",
+                        help="load the class codes of --class_image_folders from this class_bank.py folder")
+    parser.add_argument('--host',
+                        type=str,
+                        default='127.0.0.1')
+    parser.add_argument('--port',
+                        type=int,
+                        default=8000)
+    parser.add_argument('--max_batch_size',
+                        type=int,
+                        default=16)
+    parser.add_argument('--max_latency_ms',
+                        type=float,
+                        default=10,
+                        help="how long the first request of a batch waits for more requests")
+    parser.add_argument('--device',
+                        type=str,
+                        default="",
+                        help="device to run on (cpu, cuda, cuda:1, ...), overrides the config")
+    parser.add_argument('--fuse',
+                        action="store_true",
+                        help="rewrite the generator into fewer convolutions before serving")
+    parser.add_argument('--verbose',
+                        action="store_true",
+                        help="log every request")
+    opts = parser.parse_args()
+
+    config = get_config(opts.config)
+    GlobalConstants.setPrecision(config['precision'])
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+    GlobalConstants.setDevice(opts.device if opts.device != "" else config.get('device', 'auto'),
+                              config.get('num_threads'), config.get('num_interop_threads'))
+    GlobalConstants.setMemoryFormat(config.get('channels_last', False))
+    transform = get_test_transform(config['desired_size'])
+
+    from inference import load_gen_test
+    gen = load_gen_test(config, opts.ckpt, GlobalConstants.getDevice())
+    gen = gen.to(memory_format=GlobalConstants.getMemoryFormat())
+    if opts.fuse:
+        gen.fuse_for_inference()
+    gen.enable_adain_cache(max(16, len(opts.class_image_folders)))
+
+    service = TranslationService(gen, transform, opts.max_batch_size, opts.max_latency_ms / 1000)
+    bank = ClassCodeBank(opts.class_bank, opts.ckpt, config['desired_size']) if opts.class_bank != "" else None
+    for folder in opts.class_image_folders:
+        if bank is not None:
+            class_code = bank.class_code(gen, folder, transform)[0]
+        else:
+            class_code = encode_class_images(gen, list_class_images(folder), transform)
+        service.add_class(os.path.basename(os.path.normpath(folder)), class_code)
+
+    server = create_server(service, opts.host, opts.port, opts.verbose)
+    print('Serving %d classes on http://%s:%d' % (len(service.class_codes), *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.batcher.close()
+
+
+if __name__ == '__main__':
+    main()
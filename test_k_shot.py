@@ -11,21 +11,21 @@ import torch
 import torch.backends.cudnn as cudnn
 from torchvision import transforms
 
-from utils import get_config
+from utils import get_config, get_test_transform
+from inference import translate_tiled
+from class_bank import ClassCodeBank
 from trainer import Trainer
 from imgaug import augmenters as iaa
 from globalConstants import GlobalConstants
 import customTransforms
 from data import default_loader_custom
 
-from debugUtils import DebugNet
+from debugUtils import DebugNet, ActivationCapture
 
 import argparse
 
 from skimage.io import imsave
 
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
-
 parser = argparse.ArgumentParser()
 parser.add_argument('--config',
                     type=str,
@@ -36,12 +36,49 @@ parser.add_argument('--ckpt',
 parser.add_argument('--class_image_folder',
                     type=str,
                     default='images/n02138411')
+parser.add_argument('--class_bank',
+                    type=str,
+                    default="",
+                    help="load the mean class code of all class images from this class_bank.py folder, "
+                         "encodes and adds them if they are not in it yet")
 parser.add_argument('--input',
                     type=str,
                     default='images/input_content.jpg')
 parser.add_argument('--output',
                     type=str,
                     default='images/output.jpg')
+parser.add_argument('--device',
+                    type=str,
+                    default="",
+                    help="device to run on (cpu, cuda, cuda:1, ...), overrides the config")
+parser.add_argument('--fuse',
+                    action="store_true",
+                    help="rewrite the generator into fewer convolutions before translating")
+parser.add_argument('--compile',
+                    action="store_true",
+                    help="torch.compile the generator, pays off when many images are translated")
+parser.add_argument('--capture_dir',
+                    type=str,
+                    default='pics',
+                    help="where to save the activations of the generator, empty to disable")
+parser.add_argument('--capture_layers',
+                    type=str,
+                    nargs='*',
+                    default=None,
+                    help="fnmatch patterns of the layers to capture, e.g. 'dec.*'")
+parser.add_argument('--capture_batch_index',
+                    type=int,
+                    default=0)
+parser.add_argument('--tile_size',
+                    type=int,
+                    default=0,
+                    help="translate the whole input in tiles of this size instead of its center crop, 0 to crop")
+parser.add_argument('--tile_overlap',
+                    type=int,
+                    default=32)
+parser.add_argument('--tile_batch_size',
+                    type=int,
+                    default=8)
 opts = parser.parse_args()
 cudnn.benchmark = True
 opts.vis = True
@@ -50,19 +87,32 @@ config = get_config(opts.config)
 config['batch_size'] = 1
 config['gpus'] = 1
 
-DebugNet.safeImgSwitch = True
-
 GlobalConstants.setPrecision(config['precision'])
 GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
 GlobalConstants.setOptimizer(config['optimizer'])
+GlobalConstants.setDevice(opts.device if opts.device != "" else config.get('device', 'auto'),
+                          config.get('num_threads'), config.get('num_interop_threads'))
+GlobalConstants.setMemoryFormat(config.get('channels_last', False))
 desired_size = config['desired_size']
 
 #python test_k_shot.py --config outputs7_RMSprop/config.yaml --ckpt outputs7_RMSprop/checkpoints/gen_00075000.pt --input ../../../scratch/bunk/cell2cell/test/A/malaria/ac3358f1-ef9a-4ccc-b66c-da5e47e352e0.png --class_image_folder ../../../scratch/bunk/cell2cell/test/A/Human_HT29_Colon_Cancer_DNA/00733-DNA.tif --output images/output.jpg 
 #python test_k_shot.py --config ../../../scratch/slivinskiy/outputs_run_8_NoInception_F32_RMSprop_BetterScaling/funit_confs_custom/config.yaml --ckpt ../../../scratch/slivinskiy/outputs_run_8_NoInception_F32_RMSprop_BetterScaling/funit_confs_custom/checkpoints/gen_00090000.pt --input ../../../scratch/bunk/cell2cell/test_FUNIT/f2574be3-81c6-4fc3-8a40-0230d1264f52.png --class_image_folder ../../../scratch/bunk/cell2cell/test_FUNIT --output images/output_malaria_1_1_same_1.png
 trainer = Trainer(config)
-trainer.cuda()
+trainer.to(GlobalConstants.getDevice())
 trainer.load_ckpt(opts.ckpt)
 trainer.eval()
+if opts.fuse:
+    trainer.model.gen_test.fuse_for_inference()
+if opts.compile:
+    trainer.model.gen_test.compile_submodules(config.get('compile', {}).get('mode', 'default'))
+# Every tile batch of translate_tiled decodes with the same class code
+trainer.model.gen_test.enable_adain_cache()
+capture = None
+if opts.capture_dir != "":
+    capture = ActivationCapture(trainer.model.gen_test, opts.capture_dir,
+                                layers=opts.capture_layers,
+                                batch_index=opts.capture_batch_index)
+    capture.step()
 #resume_directory = opts.ckpt
 #trainer.resume(resume_directory,hp=config,multigpus=False)
 
@@ -76,18 +126,10 @@ transform = transforms.Compose(transform_list)
 
 print("YOU HAVE INCLUDED RESIZING IN TEST-K-SHOT!!")
 
-transform = transforms.Compose([
-        iaa.Sequential([
-            #iaa.Resize({"shorter-side":256, "longer-side":"keep-aspect-ratio"}), #Don't forget to exclude this later
-            iaa.CropToFixedSize(width=desired_size, height=desired_size, position = 'center', seed = 0),
-            #iaa.HorizontalFlip(p=0.5),
-            #iaa.VerticalFlip(p=0.5),
-        ]).augment_image,
-        customTransforms.ToTensor(),
-        customTransforms.RescaleToOneOne()
-    ])
+transform = get_test_transform(desired_size)
 
 print('Compute average class codes for images in %s' % opts.class_image_folder)
+adain_params = None
 
 
 classPath = opts.class_image_folder
@@ -100,7 +142,7 @@ for imgName in imgNames:
 """
 for i, f in enumerate(imgPths):
     img = default_loader_custom(f)
-    img_tensor = transform(img).unsqueeze(0).cuda()
+    img_tensor = trainer.model.to_device(transform(img).unsqueeze(0))
     with torch.no_grad():
         class_code = trainer.model.compute_k_style(img_tensor, 1)
         if i == 0:
@@ -110,17 +152,24 @@ for i, f in enumerate(imgPths):
 final_class_code = new_class_code / len(imgPths)
 
 """
-final_class_code = trainer.model.gen_test.enc_class_model(transform(default_loader_custom(imgPths[0])).unsqueeze(0).cuda())
+if opts.class_bank != "":
+    bank = ClassCodeBank(opts.class_bank, opts.ckpt, desired_size)
+    final_class_code, adain_params = bank.class_code(trainer.model.gen_test, classPath, transform)
+else:
+    final_class_code = trainer.model.gen_test.enc_class_model(trainer.model.to_device(transform(default_loader_custom(imgPths[0])).unsqueeze(0)))
 print("Shape: ",final_class_code.shape)
 DebugNet.setName("input")
 image = default_loader_custom(opts.input)
-content_img = transform(image)
+content_img = (get_test_transform(None) if opts.tile_size > 0 else transform)(image)
 #DebugNet.safeImage(content_img)
-content_img = content_img.unsqueeze(0)
 
 print('Compute translation for %s' % opts.input)
 with torch.no_grad():
-    output_image = trainer.model.translate_simple(content_img, final_class_code)
+    if (opts.tile_size > 0):
+        output_image = translate_tiled(trainer.model.gen_test, content_img, final_class_code,
+                                       opts.tile_size, opts.tile_overlap, opts.tile_batch_size)
+    else:
+        output_image = trainer.model.translate_simple(content_img.unsqueeze(0), final_class_code, adain_params)
     image = output_image.detach().cpu().squeeze().numpy()
     print("Image has shape: ", image.shape)
     print("MIN: ",image.min())
@@ -135,3 +184,6 @@ with torch.no_grad():
     #output_img = Image.fromarray(np.uint8(image))
     #output_img.save(opts.output, 'JPEG', quality=99)
     print('Save output to %s' % opts.output)
+    print(trainer.model.gen_test.adain_cache)
+if capture is not None:
+    capture.close()
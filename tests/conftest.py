@@ -0,0 +1,32 @@
+import os
+import copy
+
+import pytest
+import torch
+
+from globalConstants import GlobalConstants
+from utils import get_config
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs', 'funit_B022.yaml')
+
+
+@pytest.fixture
+def config():
+    # configs/funit_B022.yaml with small models, in float32 on the CPU
+    config = copy.deepcopy(get_config(CONFIG_PATH))
+    config['gen'].update(nf=8, nf_mlp=16, latent_dim=16, n_res_blks=1)
+    config['dis'].update(nf=8, n_res_blks=2)
+    config['precision'] = 'float32'
+    GlobalConstants.setPrecision(config['precision'])
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+    GlobalConstants.setOptimizer(config['optimizer'])
+    GlobalConstants.setDevice('cpu')
+    GlobalConstants.setMemoryFormat(False)
+    torch.manual_seed(0)
+    return config
+
+
+@pytest.fixture
+def gen(config):
+    from networks import FewShotGen
+    return FewShotGen(config['gen']).eval()
@@ -0,0 +1,33 @@
+import copy
+
+import pytest
+import torch
+
+from blocks import InceptionBlock, count_convs
+
+
+def inception_block():
+    torch.manual_seed(0)
+    return InceptionBlock(16, 16, 3, 1, 1, norm='in', activation='relu', pad_type='reflect')
+
+
+def test_inception_forward_matches_sequential():
+    block = inception_block()
+    x = torch.randn(2, 16, 16, 16, requires_grad=True)
+    out = block.inceptionForward(x)
+    grad, = torch.autograd.grad(out.square().sum(), x)
+    reference = block.inceptionForwardSequential(x)
+    reference_grad, = torch.autograd.grad(reference.square().sum(), x)
+    assert torch.allclose(out, reference, atol=1e-6)
+    assert torch.allclose(grad, reference_grad, atol=1e-5)
+
+
+@pytest.mark.parametrize('max_flop_ratio', [1.0, 4.0])
+def test_fused_inception_matches_eager(max_flop_ratio):
+    block = inception_block().eval()
+    fused = copy.deepcopy(block)
+    fused.fuse(max_flop_ratio)
+    assert count_convs([fused]) < count_convs([block])
+    x = torch.randn(2, 16, 16, 16)
+    with torch.no_grad():
+        assert torch.allclose(fused(x), block(x), atol=1e-5)
@@ -0,0 +1,50 @@
+import copy
+
+import pytest
+import torch
+
+from blocks import InceptionBlock, InstanceNorm2d, AdaptiveInstanceNorm2d, is_channels_last
+
+
+def channels_last(x):
+    return x.contiguous(memory_format=torch.channels_last)
+
+
+@pytest.mark.parametrize('affine', [False, True])
+def test_instance_norm(affine):
+    torch.manual_seed(0)
+    norm = InstanceNorm2d(8, affine=affine)
+    if affine:
+        with torch.no_grad():
+            norm.weight.normal_()
+            norm.bias.normal_()
+    x = torch.randn(2, 8, 16, 16) * 3 + 1
+    out = norm(channels_last(x))
+    assert is_channels_last(out)
+    assert torch.allclose(out, norm(x), atol=1e-5)
+
+
+def test_adaptive_instance_norm():
+    torch.manual_seed(0)
+    norm = AdaptiveInstanceNorm2d(8)
+    norm.weight = torch.randn(2 * 8)
+    norm.bias = torch.randn(2 * 8)
+    x = torch.randn(2, 8, 16, 16) * 3 + 1
+    out = norm(channels_last(x))
+    assert is_channels_last(out)
+    assert torch.allclose(out, norm(x), atol=1e-5)
+
+
+@pytest.mark.parametrize('max_flop_ratio', [None, 1.0, 4.0])
+def test_inception_block(max_flop_ratio):
+    # None is the unfused block
+    torch.manual_seed(0)
+    block = InceptionBlock(16, 16, 3, 1, 1, norm='in', activation='relu', pad_type='reflect').eval()
+    if max_flop_ratio is not None:
+        block.fuse(max_flop_ratio)
+    x = torch.randn(2, 16, 16, 16)
+    with torch.no_grad():
+        reference = block(x)
+        out = copy.deepcopy(block).to(memory_format=torch.channels_last)(channels_last(x))
+    assert is_channels_last(out)
+    assert torch.allclose(out, reference, atol=1e-5)
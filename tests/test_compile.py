@@ -0,0 +1,13 @@
+import copy
+
+import torch
+
+
+def test_compiled_generator_matches_eager(config, gen):
+    torch._dynamo.reset()
+    compiled = copy.deepcopy(gen).compile_submodules()
+    x = torch.randn(2, config['gen']['input_nc'], 32, 32)
+    with torch.no_grad():
+        reference = gen.decode(gen.enc_content(x), gen.enc_class_model(x))
+        out = compiled.decode(compiled.enc_content(x), compiled.enc_class_model(x))
+    assert torch.allclose(out, reference, atol=1e-5)
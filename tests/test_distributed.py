@@ -0,0 +1,46 @@
+import os
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from globalConstants import GlobalConstants
+from test_trainer import train_step
+
+WORLD_SIZE = 2
+
+
+def worker(rank, config, port, results_dir):
+    from distributedUtils import init_distributed
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), LOCAL_RANK=str(rank),
+                      WORLD_SIZE=str(WORLD_SIZE), LOCAL_WORLD_SIZE=str(WORLD_SIZE))
+    GlobalConstants.setPrecision(config['precision'])
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+    GlobalConstants.setOptimizer(config['optimizer'])
+    GlobalConstants.setDevice(init_distributed('cpu'), 1)
+    GlobalConstants.setMemoryFormat(False)
+    torch.save(train_step(config, rank, WORLD_SIZE), os.path.join(results_dir, '%d.pt' % rank))
+    dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_processes_match_one_process(config, tmp_path):
+    # With a learning rate of 0 the generator step sees the discriminator it started with
+    config = dict(config, lr_gen=0, lr_dis=0)
+    reference = train_step(config)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    mp.spawn(worker, args=(config, port, str(tmp_path)), nprocs=WORLD_SIZE)
+    results = [torch.load(str(tmp_path / ('%d.pt' % rank))) for rank in range(WORLD_SIZE)]
+    for losses, dis_gradients, gen_gradients, state in results:
+        # The losses are summed over the processes in float32
+        assert torch.allclose(losses, reference[0], rtol=1e-6)
+        for gradients, reference_gradients in ((dis_gradients, reference[1]), (gen_gradients, reference[2])):
+            assert len(gradients) == len(reference_gradients)
+            for g, r in zip(gradients, reference_gradients):
+                assert torch.allclose(g, r, rtol=1e-10, atol=1e-14)
+        # The same weights and average on every process
+        assert all(torch.equal(state[k], results[0][3][k]) for k in state)
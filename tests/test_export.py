@@ -0,0 +1,22 @@
+import pytest
+import torch
+
+from export import FORMATS, ExportedGenerator, export_generator
+
+
+@pytest.mark.parametrize('adain_input', [False, True])
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_exported_generator_matches_eager(config, gen, tmp_path, fmt, adain_input):
+    if fmt == 'onnx':
+        pytest.importorskip('onnx')
+        pytest.importorskip('onnxruntime')
+    x = torch.randn(3, config['gen']['input_nc'], 64, 64)
+    with torch.no_grad():
+        class_code = gen.enc_class_model(x[:1])
+        reference = gen.decode(gen.enc_content(x), class_code.expand(x.size(0), *class_code.shape[1:]))
+    # Traced with another batch and image size than the inputs, so the dynamic axes are checked too
+    export_generator(gen, str(tmp_path), fmt, adain_input, size=32)
+    exported = ExportedGenerator(str(tmp_path))
+    output = exported.translate_simple(x, exported.enc_class_model(x[:1]))
+    assert output.shape == reference.shape
+    assert torch.allclose(output, reference, atol=1e-4)
@@ -0,0 +1,58 @@
+import torch
+
+from globalConstants import GlobalConstants
+from funit_model import FUNITModel
+
+
+def dis_model(config):
+    model = FUNITModel(config)
+    model.setGradScalers(GlobalConstants.gradScaler(), GlobalConstants.gradScaler())
+    return model
+
+
+def batches(config, batch_size=4, size=32):
+    # Content and class batches of random images, the second half of the class batch repeats the first
+    nc = config['gen']['input_nc']
+    xb = torch.randn(batch_size // 2, nc, size, size).repeat(2, 1, 1, 1)
+    lb = torch.arange(batch_size // 2).repeat(2)
+    return (torch.randn(batch_size, nc, size, size), torch.zeros(batch_size, dtype=torch.long)), (xb, lb)
+
+
+def test_r1_batch_fraction_keeps_the_penalty(config):
+    # On a batch whose halves are equal, the penalty of the first half is the one of the whole batch
+    model = dis_model(config)
+    co_data, cl_data = batches(config)
+    regs = []
+    for fraction in (1.0, 0.5):
+        hp = dict(config, r1_batch_fraction=fraction)
+        regs.append(model(co_data, (cl_data[0].clone(), cl_data[1]), hp, 'dis_update')[3].item())
+        model.dis.zero_grad(set_to_none=True)
+    assert regs[0] > 0
+    assert abs(regs[0] - regs[1]) <= 1e-5 * regs[0]
+
+
+def test_single_backward_matches_backward_per_loss(config):
+    # The discriminator update before its losses were merged into one backward pass
+    model = dis_model(config)
+    gen, dis = model.gen, model.dis
+    co_data, cl_data = batches(config)
+    xa, lb = co_data[0], cl_data[1]
+
+    def gradients(fn):
+        dis.zero_grad(set_to_none=True)
+        fn()
+        return [p.grad.clone() for p in dis.parameters()]
+
+    def backward_per_loss():
+        xb = cl_data[0].clone().requires_grad_()
+        l_real, _, resp_r = dis.calc_dis_real_loss(xb, lb)
+        (config['gan_w'] * l_real).backward(retain_graph=True)
+        (10 * dis.calc_grad2(resp_r, xb)).backward()
+        with torch.no_grad():
+            xt = gen.decode(gen.enc_content(xa), gen.enc_class_model(xb))
+        (config['gan_w'] * dis.calc_dis_fake_loss(xt, lb)[0]).backward()
+
+    reference = gradients(backward_per_loss)
+    merged = gradients(lambda: model(co_data, (cl_data[0].clone(), cl_data[1]), config, 'dis_update'))
+    for r, m in zip(reference, merged):
+        assert (r - m).abs().max() <= 1e-4 * r.abs().max().clamp(min=1e-12)
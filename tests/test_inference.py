@@ -0,0 +1,15 @@
+import torch
+
+from inference import translate_matrix
+
+
+def test_translate_matrix_matches_translating_each_pair(config, gen):
+    contents = torch.randn(5, config['gen']['input_nc'], 32, 32)
+    with torch.no_grad():
+        class_codes = gen.enc_class_model(torch.randn(3, *contents.shape[1:]))
+        reference = torch.stack([torch.cat([gen.decode(gen.enc_content(x.unsqueeze(0)), code.unsqueeze(0))
+                                            for code in class_codes]) for x in contents])
+    # Batches of 4 pairs split the classes of a content image over two batches
+    out = translate_matrix(gen, contents, class_codes, batch_size=4)
+    assert out.shape == reference.shape
+    assert torch.allclose(out, reference, atol=1e-5)
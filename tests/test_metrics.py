@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('skimage')
+from skimage.filters import threshold_otsu
+
+from utils import otsu_iou
+from metrics import otsu_thresholds, otsu_iou_batch
+
+
+def images(batch_size=16, size=64, shift=0.0):
+    # Translation-like images in [-1, 1]
+    return torch.tanh(torch.randn(batch_size, size, size) * 2 + shift)
+
+
+@pytest.mark.parametrize('dtype, atol', [(torch.float32, 3e-8), (torch.float64, 0), (torch.uint8, 0)])
+def test_otsu_thresholds_match_skimage(dtype, atol):
+    torch.manual_seed(0)
+    x = images()
+    x = ((x + 1) * 127.5).to(dtype) if dtype == torch.uint8 else x.to(dtype)
+    reference = np.array([threshold_otsu(image) for image in x.numpy()])
+    assert np.abs(otsu_thresholds(x).numpy() - reference).max() <= atol
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.uint8])
+def test_constant_images(dtype):
+    # The threshold is their value and the masks are empty, like skimage and utils.otsu_iou
+    x = torch.full((2, 8, 8), 3, dtype=dtype)
+    assert torch.equal(otsu_thresholds(x), torch.full((2,), 3, dtype=torch.float64))
+    assert torch.equal(otsu_iou_batch(x, x), torch.full((2,), 100, dtype=torch.float64))
+
+
+def test_otsu_iou_batch_matches_otsu_iou():
+    torch.manual_seed(0)
+    fake, real = images(), images(shift=0.3)
+    reference = np.array([otsu_iou(f, r) for f, r in zip(fake.numpy(), real.numpy())])
+    assert np.allclose(otsu_iou_batch(fake, real).numpy(), reference, atol=1e-4)
@@ -0,0 +1,50 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from utils import ModelAverage
+
+
+def test_average_of_a_bfloat16_model_keeps_moving():
+    # (1 - beta) * 0.05 is below the resolution of bfloat16 around 1, the float32 average still follows
+    torch.manual_seed(0)
+    src = nn.Linear(16, 16)
+    with torch.no_grad():
+        src.weight.fill_(1.0)
+    tgt = copy.deepcopy(src)
+    src.to(torch.bfloat16)
+    model_average = ModelAverage(tgt, src, beta=0.999)
+    with torch.no_grad():
+        src.weight.add_(0.05)
+    for i in range(500):
+        model_average.update(i)
+    assert tgt.weight.dtype == torch.float32
+    expected = 1 + (src.weight.float() - 1) * (1 - 0.999 ** 500)
+    assert torch.allclose(tgt.weight, expected, atol=1e-4)
+    # The staging copies are allocated once and reused
+    staging = model_average.staging
+    model_average.update(0)
+    assert model_average.staging is staging
+
+
+def update_average(model_tgt, model_src, beta=0.999):
+    # The loop over named_parameters ModelAverage replaced
+    with torch.no_grad():
+        param_dict_src = dict(model_src.named_parameters())
+        for p_name, p_tgt in model_tgt.named_parameters():
+            p_src = param_dict_src[p_name]
+            p_tgt.copy_(beta*p_tgt + (1. - beta)*p_src)
+
+
+def test_matches_the_named_parameters_loop(gen):
+    reference, average = copy.deepcopy(gen), copy.deepcopy(gen)
+    model_average = ModelAverage(average, gen)
+    for i in range(5):
+        with torch.no_grad():
+            for p in gen.parameters():
+                p.add_(torch.randn_like(p), alpha=0.01)
+        update_average(reference, gen)
+        model_average.update(i)
+    for r, a in zip(reference.parameters(), average.parameters()):
+        assert torch.allclose(r, a, atol=1e-6)
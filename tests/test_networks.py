@@ -0,0 +1,27 @@
+import copy
+
+import torch
+
+
+def test_fuse_for_inference_matches_eager(config, gen):
+    fused = copy.deepcopy(gen).fuse_for_inference()
+    x = torch.randn(2, config['gen']['input_nc'], 32, 32)
+    with torch.no_grad():
+        class_code = gen.enc_class_model(x)
+        reference = gen.decode(gen.enc_content(x), class_code)
+        out = fused.decode(fused.enc_content(x), class_code)
+    assert torch.allclose(out, reference, atol=1e-5)
+
+
+def test_adain_cache_matches_mlp(config, gen):
+    x = torch.randn(2, config['gen']['input_nc'], 32, 32)
+    with torch.no_grad():
+        content = gen.enc_content(x)
+        class_codes = [gen.enc_class_model(torch.randn_like(x[:1])).expand(2, -1, -1, -1) for c in range(3)]
+        reference = [gen.decode(content, code) for code in class_codes]
+        gen.enable_adain_cache(3)
+        # Copies have another identity and are found by their hash, the second round hits the cache
+        for codes in (class_codes, [code[:1].clone().expand_as(code) for code in class_codes]):
+            for code, expected in zip(codes, reference):
+                assert torch.allclose(gen.decode(content, code), expected, atol=1e-6)
+    assert gen.adain_cache.hits == 3
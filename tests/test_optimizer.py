@@ -0,0 +1,104 @@
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from customOptimizers import MasterWeightOptimizer
+
+
+def model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(3, 8, 3), nn.Conv2d(8, 8, 1), nn.Linear(8, 700), nn.Linear(700, 4))
+
+
+def set_gradients(params, step, skip=()):
+    # The same gradients for every copy of the model, parameters in skip get none
+    generator = torch.Generator().manual_seed(step)
+    for i, p in enumerate(params):
+        grad = torch.randn(p.shape, generator=generator) * 1e-3
+        p.grad = None if i in skip else grad.to(p.dtype)
+
+
+@pytest.mark.parametrize('algorithm', MasterWeightOptimizer.ALGORITHMS)
+def test_matches_torch_optim(monkeypatch, algorithm):
+    # Small chunks, so the parameters are spread over several chunks and the large ones get their own
+    monkeypatch.setattr(MasterWeightOptimizer, 'CPU_CHUNK', 1000)
+    reference = list(model().parameters())
+    params = list(model().parameters())
+    reference_opt = getattr(torch.optim, algorithm)(reference, lr=1e-3, weight_decay=1e-4)
+    master_opt = MasterWeightOptimizer(params, algorithm, lr=1e-3, weight_decay=1e-4)
+    # The second parameter has no gradient in some steps, it is skipped and counts its own steps
+    for step in range(6):
+        skip = (1,) if step % 2 else ()
+        set_gradients(reference, step, skip)
+        set_gradients(params, step, skip)
+        reference_opt.step()
+        master_opt.step()
+    for p, q in zip(reference, params):
+        assert torch.allclose(p, q, rtol=1e-5, atol=1e-7)
+
+
+def test_parameters_without_gradient_are_unchanged():
+    params = list(model().parameters())
+    before = [p.detach().clone() for p in params]
+    opt = MasterWeightOptimizer(params, 'Adam', lr=1e-3, weight_decay=1e-2)
+    set_gradients(params, 0, skip=(0, 3))
+    opt.step()
+    assert torch.equal(params[0], before[0]) and torch.equal(params[3], before[3])
+    assert not torch.equal(params[1], before[1])
+
+
+def test_bfloat16_parameters_follow_the_float32_master():
+    # The master weights start from the bfloat16 parameters
+    reference = list(model().to(torch.bfloat16).float().parameters())
+    params = list(model().to(torch.bfloat16).parameters())
+    reference_opt = torch.optim.Adam(reference, lr=1e-3)
+    master_opt = MasterWeightOptimizer(params, 'Adam', lr=1e-3)
+    for step in range(3):
+        set_gradients(reference, step)
+        set_gradients(params, step)
+        for p, q in zip(reference, params):
+            p.grad.copy_(q.grad.float())
+        reference_opt.step()
+        master_opt.step()
+    for p, q, master in zip(reference, params, master_opt.views(master_opt.flat[0]['master'], params)):
+        assert q.dtype == torch.bfloat16
+        assert torch.allclose(p, master, rtol=1e-5, atol=1e-7)
+        assert torch.equal(q, master.to(torch.bfloat16))
+
+
+def test_scaled_step_and_inf_skip():
+    # grad_scale and found_inf as GradScaler passes them, a step with inf gradients changes nothing
+    reference = list(model().parameters())
+    params = list(model().parameters())
+    reference_opt = torch.optim.Adam(reference, lr=1e-3)
+    opt = MasterWeightOptimizer(params, 'Adam', lr=1e-3)
+    set_gradients(reference, 0)
+    set_gradients(params, 0)
+    for p in params:
+        p.grad.mul_(1024)
+    opt.grad_scale, opt.found_inf = torch.tensor(1024.0), torch.tensor(0.0)
+    opt.step()
+    reference_opt.step()
+    state = copy.deepcopy(opt.flat)
+    before = [p.detach().clone() for p in params]
+    params[0].grad[0] = float('inf')
+    opt.found_inf = torch.tensor(1.0)
+    opt.step()
+    for p, q, r in zip(reference, params, before):
+        assert torch.allclose(p, q, rtol=1e-5, atol=1e-7)
+        assert torch.equal(q, r)
+    for k, v in state[0].items():
+        assert torch.equal(v, opt.flat[0][k]), k
+
+
+def test_state_dict_round_trip():
+    params = list(model().parameters())
+    opt = MasterWeightOptimizer(params, 'Adam', lr=1e-3)
+    set_gradients(params, 0)
+    opt.step()
+    restored = MasterWeightOptimizer(list(model().parameters()), 'Adam', lr=1e-3)
+    restored.load_state_dict(opt.state_dict())
+    for k, v in opt.flat[0].items():
+        assert torch.equal(v, restored.flat[0][k]), k
@@ -0,0 +1,62 @@
+import io
+import threading
+import urllib.request
+
+import numpy as np
+import torch
+from PIL import Image
+
+from utils import get_test_transform, to_output_image
+from data import bytes_loader_custom
+from server import TranslationService, create_server
+
+
+def png(rng, mode):
+    # data.preprocess_custom scales images below 256 pixels up, the transform crops them
+    shape = (256, 256) if mode == 'L' else (256, 256, 3)
+    buffer = io.BytesIO()
+    Image.fromarray(rng.randint(0, 256, shape).astype(np.uint8), mode).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def post(address, path, data):
+    url = 'http://%s:%d%s' % (address[0], address[1], path)
+    with urllib.request.urlopen(urllib.request.Request(url, data=data, method='POST')) as response:
+        return response.read()
+
+
+def test_batched_requests_match_translating_one_image(config, gen):
+    gen.enable_adain_cache()
+    rng = np.random.RandomState(0)
+    mode = 'L' if config['gen']['input_nc'] == 1 else 'RGB'
+    content_images = [png(rng, mode) for i in range(6)]
+    class_images = [png(rng, mode) for c in range(2)]
+    transform = get_test_transform(32)
+    service = TranslationService(gen, transform, max_batch_size=4, max_latency=0.05)
+    server = create_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        address = server.server_address
+        for c, class_image in enumerate(class_images):
+            post(address, '/classes?class_id=%d' % c, class_image)
+        outputs = {}
+
+        def client(i):
+            outputs[i] = post(address, '/translate?class_id=%d' % (i % 2), content_images[i])
+
+        clients = [threading.Thread(target=client, args=(i,)) for i in range(len(content_images))]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.batcher.close()
+    assert len(outputs) == len(content_images)
+    with torch.no_grad():
+        for i, output in outputs.items():
+            content = transform(bytes_loader_custom(content_images[i])).unsqueeze(0)
+            expected = to_output_image(gen.decode(gen.enc_content(content), service.class_codes[str(i % 2)]))
+            # Batches round differently than single images, by at most one gray level
+            assert np.abs(np.array(Image.open(io.BytesIO(output))).astype(int) - expected.astype(int)).max() <= 1
@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from trainer import Trainer
+
+
+def train_step(config, rank=0, world_size=1):
+    """
+    Losses and gradients of one discriminator and one generator step of a float64 copy of the models on the
+    shard of a batch of this process, and the weights afterwards. In float32 the L1 feature matching losses
+    take the sign of nearly equal features, which turns rounding differences into gradient differences.
+    Every process starts from other weights, the Trainer has to start all of them from the first one.
+    """
+    torch.manual_seed(1)
+    nc = config['gen']['input_nc']
+    co_data = (torch.randn(4, nc, 32, 32, dtype=torch.float64), torch.randint(2, (4,)))
+    cl_data = (torch.randn(4, nc, 32, 32, dtype=torch.float64), torch.randint(2, (4,)))
+    co_data, cl_data = [tuple(t.chunk(world_size)[rank] for t in data) for data in (co_data, cl_data)]
+    torch.manual_seed(rank)
+    trainer = Trainer(config).double()
+    trainer.dis_update(co_data, cl_data, config, 0)
+    dis_gradients = [p.grad.clone() for p in trainer.model.dis.parameters()]
+    trainer.gen_update(co_data, cl_data, config, False, 0)
+    gen_gradients = [p.grad.clone() for p in trainer.model.gen.parameters() if p.grad is not None]
+    losses = torch.stack([trainer.loss_dis_total, trainer.loss_gen_total]).detach()
+    return losses, dis_gradients, gen_gradients, trainer.model.state_dict()
+
+
+@pytest.mark.parametrize('micro_batches', [2, 4])
+def test_micro_batches_match_the_whole_batch(config, micro_batches):
+    # With a learning rate of 0 the generator step sees the discriminator it started with
+    config = dict(config, lr_gen=0, lr_dis=0)
+    reference = train_step(config)
+    result = train_step(dict(config, micro_batches=micro_batches))
+    # The loss totals are summed in float32
+    assert torch.allclose(result[0], reference[0], rtol=1e-6)
+    for gradients, reference_gradients in zip(result[1:3], reference[1:3]):
+        assert len(gradients) == len(reference_gradients)
+        for g, r in zip(gradients, reference_gradients):
+            assert torch.allclose(g, r, rtol=1e-10, atol=1e-14)
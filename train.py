@@ -16,16 +16,17 @@ from utils import get_config, get_train_loaders, make_result_folders, get_train_
 from utils import write_loss, write_html, write_1images, Timer, make_log_folder
 from trainer import Trainer
 from globalConstants import GlobalConstants
-from blocks import AdaptiveInstanceNorm2d
-from torch.nn import BatchNorm1d, BatchNorm2d
+from debugUtils import AnomalyMonitor, ActivationCapture
+from distributedUtils import init_distributed, get_world_size, is_main_process, cpu_threads_per_process, set_epoch
 
 import torch.backends.cudnn as cudnn
-os.environ['CUDA_VISIBLE_DEVICES'] = '1' #"0,1" for the hard stuff, "2" for your everyday bread and butter
 # Enable auto-tuner to find the best algorithm to use for your hardware.
 cudnn.benchmark = True
 
 #USE FOLLOWING COMMAND TO EXECUTE: 
 #python train.py --config configs/funit_confs_custom.yaml --output_path ../../../scratch/slivinskiy/new_datasets/outputs/GPU0
+#One process per GPU or CPU socket:
+#torchrun --nproc_per_node=4 train.py --config configs/funit_confs_custom.yaml
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--config',
@@ -47,6 +48,10 @@ parser.add_argument('--test_batch_size',
 parser.add_argument("--resume",
                     type = str,
                     default="")
+parser.add_argument('--device',
+                    type=str,
+                    default="",
+                    help="device to train on (cpu, cuda, cuda:1, ...), overrides the config")
 
 opts = parser.parse_args()
 
@@ -60,10 +65,21 @@ if opts.batch_size != 0:
 GlobalConstants.setPrecision(config['precision'])
 GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
 GlobalConstants.setOptimizer(config['optimizer'])
-
+# Started by torchrun with several processes, each one trains on its own device and shard of the data
+device = init_distributed(opts.device if opts.device != "" else config.get('device', 'auto'))
+distributed = get_world_size() > 1
+main_process = is_main_process()
+if distributed and opts.multigpus:
+    raise Exception("--multigpus uses DataParallel in a single process, it can not be combined with torchrun")
+num_threads = config.get('num_threads')
+if distributed and not num_threads:
+    num_threads = cpu_threads_per_process()
+GlobalConstants.setDevice(device, num_threads, config.get('num_interop_threads'))
+GlobalConstants.setMemoryFormat(config.get('channels_last', False))
+
+# Trainer places the model itself, gen_test may stay on another device (ema: device)
 trainer = Trainer(config)
-trainer.cuda()
-if opts.multigpus:
+if opts.multigpus and GlobalConstants.getDevice().type == 'cuda':
     ngpus = torch.cuda.device_count()
     config['gpus'] = ngpus
     print("Number of GPUs: %d" % ngpus)
@@ -72,21 +88,22 @@ if opts.multigpus:
 else:
     config['gpus'] = 1
 
-loaders = get_train_loaders_custom(config)
+loaders = get_train_loaders_custom(config, distributed)
 train_content_loader = loaders[0]
 train_class_loader = loaders[1]
 test_content_loader = loaders[2]
 test_class_loader = loaders[3]
 
-# Setup logger and output folders
+# Setup logger and output folders, only the first process writes logs, images and checkpoints
 model_name = os.path.splitext(os.path.basename(opts.config))[0]
-logs_path = make_log_folder("./")
-train_writer = SummaryWriter(
-    os.path.join(logs_path, model_name))
 output_directory = os.path.join(opts.output_path + "/outputs", model_name)
 GlobalConstants.setOutputPath(output_directory)
-checkpoint_directory, image_directory = make_result_folders(output_directory)
-shutil.copy(opts.config, os.path.join(output_directory, 'config.yaml'))
+if main_process:
+    logs_path = make_log_folder("./")
+    train_writer = SummaryWriter(
+        os.path.join(logs_path, model_name))
+    checkpoint_directory, image_directory = make_result_folders(output_directory)
+    shutil.copy(opts.config, os.path.join(output_directory, 'config.yaml'))
 
 resume_directory = opts.resume
 
@@ -94,33 +111,51 @@ iterations = trainer.resume(resume_directory,
                             hp=config,
                             multigpus=opts.multigpus) if opts.resume != "" else 0
 
-
-if (GlobalConstants.getPrecision() == torch.float16 and (not GlobalConstants.usingApex)):
-    trainer.model.half()  # convert to half precision
-    for layer in trainer.model.modules():
-        if isinstance(layer, AdaptiveInstanceNorm2d):
-            layer.float()
-        elif isinstance(layer, BatchNorm2d):
-            layer.float()
-
+anomaly_conf = config.get('anomaly_monitor', {})
+anomaly_monitor = None
+if anomaly_conf.get('enabled', False) and main_process:
+    anomaly_monitor = AnomalyMonitor(trainer.model,
+                                     sample_every=anomaly_conf.get('sample_every', 1),
+                                     modules=anomaly_conf.get('modules', ['ActFirstResBlock', 'Conv2dBlock']))
+capture_conf = config.get('activation_capture', {})
+activation_capture = None
+if capture_conf.get('enabled', False) and main_process:
+    activation_capture = ActivationCapture(trainer.model,
+                                           os.path.join(output_directory, 'pics'),
+                                           sample_every=capture_conf.get('sample_every', 1),
+                                           layers=capture_conf.get('layers'),
+                                           batch_index=capture_conf.get('batch_index', 0),
+                                           buffer_size=capture_conf.get('buffer_size', 32))
 
 #trainer.summary(None)
+epoch = 0
 while True:
+    set_epoch([train_content_loader, train_class_loader], epoch)
+    epoch += 1
     for it, (co_data, cl_data) in enumerate(
             zip(train_content_loader, train_class_loader)):
+        if anomaly_monitor is not None:
+            anomaly_monitor.step()
+        if activation_capture is not None:
+            activation_capture.step()
         with Timer("Elapsed time in update: %f"):
             #torch.autograd.set_detect_anomaly(True)
-            d_acc = trainer.dis_update(co_data, cl_data, config, it)
+            # The global iteration, the lazy R1 and moving average schedules run across epochs
+            d_acc = trainer.dis_update(co_data, cl_data, config, iterations)
             g_acc = trainer.gen_update(co_data, cl_data, config,
-                                       opts.multigpus, it)
-            torch.cuda.synchronize()
-            print('D acc: %.4f\t G acc: %.4f' % (d_acc, g_acc))
+                                       opts.multigpus, iterations)
+            if GlobalConstants.getDevice().type == 'cuda':
+                torch.cuda.synchronize()
+            if main_process:
+                print('D acc: %.4f\t G acc: %.4f' % (d_acc, g_acc))
 
-        if (iterations + 1) % config['log_iter'] == 0:
+        if main_process and (iterations + 1) % config['log_iter'] == 0:
             print("Iteration: %08d/%08d" % (iterations + 1, max_iter))
             write_loss(iterations, trainer, train_writer)
+            if anomaly_monitor is not None:
+                anomaly_monitor.report(iterations + 1)
 
-        if ((iterations + 1) % config['image_save_iter'] == 0 or (
+        if main_process and ((iterations + 1) % config['image_save_iter'] == 0 or (
                 iterations + 1) % config['image_display_iter'] == 0):
             if (iterations + 1) % config['image_save_iter'] == 0:
                 key_str = '%08d' % (iterations + 1)
@@ -147,11 +182,15 @@ while True:
                     write_1images(test_image_outputs, image_directory,
                                   'test_%s_%02d' % (key_str, t))
 
-        if (iterations + 1) % config['snapshot_save_iter'] == 0:
+        if main_process and (iterations + 1) % config['snapshot_save_iter'] == 0:
             trainer.save(checkpoint_directory, iterations, opts.multigpus)
             print('Saved model at iteration %d' % (iterations + 1))
 
         iterations += 1
         if iterations >= max_iter:
             print("Finish Training")
+            if activation_capture is not None:
+                activation_capture.close()
+            if distributed:
+                torch.distributed.destroy_process_group()
             sys.exit(0)
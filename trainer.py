@@ -4,6 +4,7 @@ Licensed under the CC BY-NC-SA 4.0 license
 (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
 import copy
+import functools
 import os
 import math
 
@@ -11,27 +12,18 @@ import torch
 import torch.nn as nn
 import torch.nn.init as init
 from torch.optim import lr_scheduler
-from customOptimizers import Adam16
+from customOptimizers import MasterWeightOptimizer
 
 from funit_model import FUNITModel
 from torchvision import models
 from globalConstants import GlobalConstants
-
-import apex.amp as amp
+from utils import ModelAverage
+from distributedUtils import get_world_size, broadcast_module, all_reduce_gradients, all_reduce_sum
 
 from torchsummary import summary
 from tensorboardX import SummaryWriter
 
 
-def update_average(model_tgt, model_src, beta=0.999):
-    with torch.no_grad():
-        param_dict_src = dict(model_src.named_parameters())
-        for p_name, p_tgt in model_tgt.named_parameters():
-            p_src = param_dict_src[p_name]
-            assert(p_src is not p_tgt)
-            p_tgt.copy_(beta*p_tgt + (1. - beta)*p_src)
-
-
 class Trainer(nn.Module):
     def __init__(self, cfg):
         super(Trainer, self).__init__()
@@ -40,6 +32,19 @@ class Trainer(nn.Module):
         lr_dis = cfg['lr_dis']
         dis_params = list(self.model.dis.parameters())
         gen_params = list(self.model.gen.parameters())
+        # Initialized and placed before the optimizers, the master weights are copied from the parameters
+        self.apply(weights_init(cfg['init']))
+        self.model.to(GlobalConstants.getDevice(), memory_format=GlobalConstants.getMemoryFormat())
+        # With several processes all of them start from the weights of the first one and stay in sync,
+        # the gradients are summed over the processes before every step
+        self.world_size = get_world_size()
+        if (self.world_size > 1):
+            broadcast_module(self.model)
+
+        master_weights = cfg.get('master_weights', False)
+        if (master_weights and GlobalConstants.getPrecision() == torch.float32):
+            print("master_weights only applies to float16 and bfloat16, the models stay in float32")
+            master_weights = False
 
         if (GlobalConstants.getOptimizer().upper() == "Adam".upper()):
             Optimizer = torch.optim.Adam
@@ -47,6 +52,8 @@ class Trainer(nn.Module):
             Optimizer = torch.optim.RMSprop
         else:
             print(GlobalConstants.getOptimizer(), "is currently not supported")
+        if (master_weights):
+            Optimizer = functools.partial(MasterWeightOptimizer, algorithm=GlobalConstants.getOptimizer())
 
         self.dis_opt = Optimizer(
             [p for p in dis_params if p.requires_grad],
@@ -55,35 +62,62 @@ class Trainer(nn.Module):
             [p for p in gen_params if p.requires_grad],
             lr=lr_dis, weight_decay=cfg['weight_decay'])
 
-
-        self.model.cuda()
-        # APEX initialization
-        if (GlobalConstants.usingApex):
-            opt_level = 'O0'
-            self.model, [self.dis_opt, self.gen_opt] = amp.initialize(
-                self.model, [self.dis_opt, self.gen_opt], opt_level=opt_level, num_losses=4,
-                max_loss_scale=2**0,
-                verbosity=1 #For now
-                )
-            self.model.setOptimizersForApex(self.dis_opt, self.gen_opt)
+        # Mixed precision: the model scales its losses, the scalers unscale the gradients before each step
+        self.gen_scaler = GlobalConstants.gradScaler()
+        self.dis_scaler = GlobalConstants.gradScaler()
+        self.model.setGradScalers(self.gen_scaler, self.dis_scaler)
 
         self.dis_scheduler = get_scheduler(self.dis_opt, cfg)
         self.gen_scheduler = get_scheduler(self.gen_opt, cfg)
-        self.apply(weights_init(cfg['init']))
         self.model.gen_test = copy.deepcopy(self.model.gen)
+        ema = cfg.get('ema', {})
+        ema_device = ema.get('device', 'same')
+        self.gen_average = ModelAverage(self.model.gen_test, self.model.gen,
+                                        beta=ema.get('beta', 0.999), interval=ema.get('interval', 1),
+                                        device=None if ema_device == 'same' else torch.device(ema_device))
+        if (master_weights):
+            # The optimizers update their float32 master weights and copy them into the low precision models
+            self.model.gen.to(GlobalConstants.getPrecision())
+            self.model.dis.to(GlobalConstants.getPrecision())
+        compile_conf = cfg.get('compile', {})
+        if (compile_conf.get('enabled', False)):
+            # Last, gen_test is a deep copy of gen. Graphs are built on the first calls of each mode and batch shape
+            mode = compile_conf.get('mode', 'default')
+            self.model.gen.compile_submodules(mode)
+            self.model.gen_test.compile_submodules(mode)
+            self.model.dis.compile(mode=mode)
+
+    def micro_batches(self, co_data, cl_data, hp):
+        """
+        Splits a batch into micro_batches (content, class, share of the batch) parts.
+        Their gradients are accumulated into one optimizer step, so the batch size sets the
+        effective batch size and micro-batches the peak memory.
+        With several processes the shares are of the batches of all processes together.
+        """
+        batch_size = co_data[0].size(0) * self.world_size
+        chunks = [torch.chunk(t, hp.get('micro_batches', 1)) for t in (co_data[0], co_data[1], cl_data[0], cl_data[1])]
+        for xa, la, xb, lb in zip(*chunks):
+            yield (xa, la), (xb, lb), xa.size(0) / batch_size
 
     def gen_update(self, co_data, cl_data, hp, multigpus, it):
         self.gen_opt.zero_grad()
-        adverserial_loss, ad, xr, cr, sr, ac = self.model(co_data, cl_data, hp, 'gen_update')
+        # Each micro-batch returns its weighted share, the sums are the values of the whole batch
+        losses = [sum(losses) for losses in zip(*[
+            self.model(co, cl, hp, 'gen_update', it, fraction)
+            for co, cl, fraction in self.micro_batches(co_data, cl_data, hp)])]
+        if (self.world_size > 1):
+            all_reduce_gradients(self.model.gen.parameters())
+            losses = all_reduce_sum(losses)
+        adverserial_loss, ad, xr, cr, sr, ac = losses
         self.loss_gen_total = torch.mean(adverserial_loss)
         self.loss_gen_recon_x = torch.mean(xr)
         self.loss_gen_recon_c = torch.mean(cr)
         self.loss_gen_recon_s = torch.mean(sr)
         self.loss_gen_adv = torch.mean(ad)
         self.accuracy_gen_adv = torch.mean(ac)
-        self.gen_opt.step()
-        this_model = self.model.module if multigpus else self.model
-        update_average(this_model.gen_test, this_model.gen)
+        self.gen_scaler.step(self.gen_opt)
+        self.gen_scaler.update()
+        self.gen_average.update(it)
         return self.accuracy_gen_adv.item()
 
     def dis_update(self, co_data, cl_data, hp, it):
@@ -92,13 +126,20 @@ class Trainer(nn.Module):
         #print("--------PRINTING SUMMARY--------")
         #summary(self.model, [co_data, cl_data, hp, 'dis_update'])
         
-        adverserial_loss, loss_dis_fake_adv, l_reconst, reg, acc = self.model(co_data, cl_data, hp, 'dis_update')
+        losses = [sum(losses) for losses in zip(*[
+            self.model(co, cl, hp, 'dis_update', it, fraction)
+            for co, cl, fraction in self.micro_batches(co_data, cl_data, hp)])]
+        if (self.world_size > 1):
+            all_reduce_gradients(self.model.dis.parameters())
+            losses = all_reduce_sum(losses)
+        adverserial_loss, loss_dis_fake_adv, l_reconst, reg, acc = losses
         self.loss_dis_total = torch.mean(adverserial_loss)
         self.loss_dis_fake_adv = torch.mean(loss_dis_fake_adv)
         self.loss_dis_real_adv = torch.mean(l_reconst)
         self.loss_dis_reg = torch.mean(reg)
         self.accuracy_dis_adv = torch.mean(acc)
-        self.dis_opt.step()
+        self.dis_scaler.step(self.dis_opt)
+        self.dis_scaler.update()
         return self.accuracy_dis_adv.item()
 
     def test(self, co_data, cl_data, multigpus):
@@ -108,33 +149,37 @@ class Trainer(nn.Module):
     def resume(self, checkpoint_dir, hp, multigpus):
         this_model = self.model.module if multigpus else self.model
 
+        device = GlobalConstants.getDevice()
         last_model_name = get_model_list(checkpoint_dir, "gen")
-        state_dict = torch.load(last_model_name)
+        state_dict = torch.load(last_model_name, map_location=device)
         this_model.gen.load_state_dict(state_dict['gen'])
         this_model.gen_test.load_state_dict(state_dict['gen_test'])
         iterations = int(last_model_name[-11:-3])
 
         last_model_name = get_model_list(checkpoint_dir, "dis")
-        state_dict = torch.load(last_model_name)
+        state_dict = torch.load(last_model_name, map_location=device)
         this_model.dis.load_state_dict(state_dict['dis'])
 
-        state_dict = torch.load(os.path.join(checkpoint_dir, 'optimizer.pt'))
+        state_dict = torch.load(os.path.join(checkpoint_dir, 'optimizer.pt'), map_location=device)
         self.dis_opt.load_state_dict(state_dict['dis'])
         self.gen_opt.load_state_dict(state_dict['gen'])
+        # Checkpoints from before mixed precision have no scaler state
+        if 'gen_scaler' in state_dict:
+            self.gen_scaler.load_state_dict(state_dict['gen_scaler'])
+            self.dis_scaler.load_state_dict(state_dict['dis_scaler'])
 
         self.dis_scheduler = get_scheduler(self.dis_opt, hp, iterations)
         self.gen_scheduler = get_scheduler(self.gen_opt, hp, iterations)
 
-        if (GlobalConstants.usingApex):
-            state_dict = torch.load(os.path.join(checkpoint_dir, 'amp.pt'))
-            amp.load_state_dict(state_dict['amp'])
         print('Resume from iteration %d' % iterations)
         return iterations
 
     def load_ckpt(self, ckpt_name):
-        state_dict = torch.load(ckpt_name)
+        state_dict = torch.load(ckpt_name, map_location=GlobalConstants.getDevice())
         self.model.gen.load_state_dict(state_dict['gen'])
         self.model.gen_test.load_state_dict(state_dict['gen_test'])
+        # The average may be kept in a lower precision or on another device during training, not for inference
+        self.model.gen_test.to(GlobalConstants.getDevice(), torch.float32)
 
     def save(self, snapshot_dir, iterations, multigpus):
         this_model = self.model.module if multigpus else self.model
@@ -146,10 +191,9 @@ class Trainer(nn.Module):
                     'gen_test': this_model.gen_test.state_dict()}, gen_name)
         torch.save({'dis': this_model.dis.state_dict()}, dis_name)
         torch.save({'gen': self.gen_opt.state_dict(),
-                    'dis': self.dis_opt.state_dict()}, opt_name)
-        if (GlobalConstants.usingApex):
-            amp_name = os.path.join(snapshot_dir, "amp.pt")
-            torch.save({'amp': amp.state_dict()}, amp_name)
+                    'dis': self.dis_opt.state_dict(),
+                    'gen_scaler': self.gen_scaler.state_dict(),
+                    'dis_scaler': self.dis_scaler.state_dict()}, opt_name)
 
     def translate(self, co_data, cl_data):
         return self.model.translate(co_data, cl_data)
@@ -0,0 +1,188 @@
+"""
+Translates a folder or a file list of content images to one or more classes in batches.
+The content images are loaded and center cropped by DataLoader workers ahead of the generator, every batch goes
+through enc_content once and is decoded into every class with inference.translate_matrix, and a pool of threads
+saves the outputs in the background.
+Each class is translated with the mean class code of all images of its folder, from --class_bank if given.
+    <output_dir>/<class folder name>/<content path relative to --input>.png
+Outputs that already exist are skipped, so an interrupted run continues where it stopped. Every output is
+written under a temporary name first, a killed run never leaves a truncated image behind.
+
+USE FOLLOWING COMMAND TO EXECUTE:
+python translate_batch.py --config configs/funit_B022.yaml --ckpt pretrained/gen_00470000.pt --input content_images --class_image_folders images/n02138411 --output_dir translated
+"""
+import os
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch.utils.data import DataLoader
+from skimage.io import imsave
+
+from globalConstants import GlobalConstants
+from utils import get_config, get_test_transform, to_output_image
+from data import ImageList, default_filelist_reader
+from inference import load_gen_test, translate_matrix
+from class_bank import ClassCodeBank, IMAGE_EXTENSIONS, list_class_images, encode_class_images
+
+
+def list_content_images(input_path):
+    """
+    Returns the content images and the folder their output paths are relative to: the images below a
+    folder, recursively, or the paths listed in a text file, relative to their common folder.
+    """
+    if os.path.isdir(input_path):
+        paths = sorted(os.path.join(root, name) for root, dirs, names in os.walk(input_path) for name in names
+                       if name.lower().endswith(IMAGE_EXTENSIONS))
+        return paths, input_path
+    paths = [p for p in default_filelist_reader(input_path) if p != ""]
+    return paths, os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+
+
+def output_path(output_dir, class_folder, content_path, content_root):
+    relative = os.path.relpath(os.path.abspath(content_path), os.path.abspath(content_root))
+    return os.path.join(output_dir, os.path.basename(os.path.normpath(class_folder)),
+                        os.path.splitext(relative)[0] + '.png')
+
+
+class ImageWriter():
+    """
+    Saves translated images with a pool of threads. At most max_pending images wait to be saved,
+    save blocks until one of them is done, so a slow disk can't fill the memory.
+    """
+    def __init__(self, num_threads=4, max_pending=64):
+        self.pool = ThreadPoolExecutor(max_workers=num_threads)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+    def write(self, path, image):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            root, ext = os.path.splitext(path)
+            tmp_path = root + '.tmp' + ext
+            imsave(tmp_path, to_output_image(image), check_contrast=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.errors.append((path, e))
+        finally:
+            self.pending.release()
+
+    def save(self, path, image):
+        # image is a (C, H, W) tensor in [-1, 1], it is copied to the CPU before save returns
+        self.pending.acquire()
+        self.pool.submit(self.write, path, image.detach().cpu())
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        for path, e in self.errors:
+            print("Could not save %s: %s" % (path, e))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',
+                        type=str,
+                        default='configs/funit_B022.yaml')
+    parser.add_argument('--ckpt',
+                        type=str,
+                        default='pretrained/animal119_gen_00200000.pt')
+    parser.add_argument('--input',
+                        type=str,
+                        required=True,
+                        help="folder of content images or a text file with one image path per line")
+    parser.add_argument('--class_image_folders',
+                        type=str,
+                        nargs='+',
+                        default=['images/n02138411'])
+    parser.add_argument('--output_dir',
+                        type=str,
+                        default='translated')
+    parser.add_argument('--class_bank',
+                        type=str,
+                        default="",
+                        help="load the class codes from this class_bank.py folder and add missing ones")
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=8)
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=2,
+                        help="DataLoader processes that load the content images ahead of the generator")
+    parser.add_argument('--writers',
+                        type=int,
+                        default=4,
+                        help="threads that save the translated images")
+    parser.add_argument('--device',
+                        type=str,
+                        default="",
+                        help="device to run on (cpu, cuda, cuda:1, ...), overrides the config")
+    parser.add_argument('--fuse',
+                        action="store_true",
+                        help="rewrite the generator into fewer convolutions before translating")
+    parser.add_argument('--compile',
+                        action="store_true",
+                        help="torch.compile the generator, pays off when many images are translated")
+    opts = parser.parse_args()
+
+    config = get_config(opts.config)
+    GlobalConstants.setPrecision(config['precision'])
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+    GlobalConstants.setDevice(opts.device if opts.device != "" else config.get('device', 'auto'),
+                              config.get('num_threads'), config.get('num_interop_threads'))
+    GlobalConstants.setMemoryFormat(config.get('channels_last', False))
+    device = GlobalConstants.getDevice()
+    desired_size = config['desired_size']
+    transform = get_test_transform(desired_size)
+
+    gen = load_gen_test(config, opts.ckpt, device).to(memory_format=GlobalConstants.getMemoryFormat())
+    if opts.fuse:
+        gen.fuse_for_inference()
+    if opts.compile:
+        gen.compile_submodules(config.get('compile', {}).get('mode', 'default'))
+
+    content_paths, content_root = list_content_images(opts.input)
+    outputs = [[output_path(opts.output_dir, folder, p, content_root) for folder in opts.class_image_folders]
+               for p in content_paths]
+    todo = [i for i, paths in enumerate(outputs) if not all(os.path.exists(p) for p in paths)]
+    print('%d content images x %d classes, %d content images already translated'
+          % (len(content_paths), len(opts.class_image_folders), len(content_paths) - len(todo)))
+    if len(todo) == 0:
+        return
+
+    bank = ClassCodeBank(opts.class_bank, opts.ckpt, desired_size) if opts.class_bank != "" else None
+    class_codes = []
+    for folder in opts.class_image_folders:
+        if bank is not None:
+            class_codes.append(bank.class_code(gen, folder, transform)[0])
+        else:
+            class_codes.append(encode_class_images(gen, list_class_images(folder), transform, opts.batch_size))
+    class_codes = torch.cat(class_codes)
+
+    dataset = ImageList([content_paths[i] for i in todo], transform)
+    loader = DataLoader(dataset, opts.batch_size, shuffle=False, num_workers=opts.num_workers,
+                        pin_memory=(device.type == 'cuda'),
+                        prefetch_factor=(4 if opts.num_workers > 0 else None),
+                        persistent_workers=False)
+    writer = ImageWriter(opts.writers)
+    translated = 0
+    start = time.perf_counter()
+    with torch.no_grad():
+        for step, (images, indices) in enumerate(loader):
+            images = images.to(device, non_blocking=True, memory_format=GlobalConstants.getMemoryFormat())
+            indices = [todo[i] for i in indices.tolist()]
+            for row, translations in zip(indices, translate_matrix(gen, images, class_codes, opts.batch_size)):
+                for path, output_image in zip(outputs[row], translations):
+                    if not os.path.exists(path):
+                        writer.save(path, output_image)
+                        translated += 1
+            if (step + 1) % 10 == 0:
+                print('%d images, %.2f images/sec' % (translated, translated / (time.perf_counter() - start)))
+    writer.close()
+    elapsed = time.perf_counter() - start
+    print('Translated %d images in %.1f s, %.2f images/sec' % (translated, elapsed, translated / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Translates every content image into every class and saves the translation matrix as an image grid: the first
+row shows the first image of each class folder, the first column the content images, every other cell the
+translation of its row's content image into its column's class. --array additionally saves all translations
+as a uint8 numpy array of shape (contents, classes, height, width[, channels]).
+Each content image goes through enc_content only once, see inference.translate_matrix.
+
+USE FOLLOWING COMMAND TO EXECUTE:
+python translate_matrix.py --config configs/funit_B022.yaml --ckpt pretrained/gen_00470000.pt --input content_images --class_image_folders images/n02138411 images/n02138412 --output images/matrix.png --array images/matrix.npy
+"""
+import argparse
+
+import numpy as np
+import torch
+import torchvision.utils as vutils
+
+from globalConstants import GlobalConstants
+from utils import get_config, get_test_transform, to_output_image
+from data import default_loader_custom
+from inference import load_gen_test, translate_matrix
+from class_bank import ClassCodeBank, list_class_images, encode_class_images
+from translate_batch import list_content_images
+
+
+def save_grid(path, content_images, class_images, translations):
+    # content_images (N, C, H, W), class_images (K, C, H, W) and translations (N, K, C, H, W), all in [-1, 1]
+    num_contents, num_classes = translations.shape[:2]
+    header = torch.cat([-torch.ones_like(class_images[:1]), class_images])
+    rows = [torch.cat([content_images[n:n + 1], translations[n]]) for n in range(num_contents)]
+    # Input and output may have different numbers of channels, like __write_images in utils.py show all in RGB
+    grid = torch.cat([images.expand(-1, 3, -1, -1) for images in [header] + rows]).float()
+    grid = vutils.make_grid(grid, nrow=num_classes + 1, padding=2, normalize=True, value_range=(-1, 1))
+    vutils.save_image(grid, path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',
+                        type=str,
+                        default='configs/funit_B022.yaml')
+    parser.add_argument('--ckpt',
+                        type=str,
+                        default='pretrained/animal119_gen_00200000.pt')
+    parser.add_argument('--input',
+                        type=str,
+                        required=True,
+                        help="folder of content images or a text file with one image path per line")
+    parser.add_argument('--class_image_folders',
+                        type=str,
+                        nargs='+',
+                        default=['images/n02138411'])
+    parser.add_argument('--output',
+                        type=str,
+                        default='images/matrix.png')
+    parser.add_argument('--array',
+                        type=str,
+                        default="",
+                        help="also save the translations to this .npy file")
+    parser.add_argument('--class_bank',
+                        type=str,
+                        default="",
+                        help="load the class codes from this class_bank.py folder and add missing ones")
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=8,
+                        help="(content, class) pairs decoded at once")
+    parser.add_argument('--device',
+                        type=str,
+                        default="",
+                        help="device to run on (cpu, cuda, cuda:1, ...), overrides the config")
+    opts = parser.parse_args()
+
+    config = get_config(opts.config)
+    GlobalConstants.setPrecision(config['precision'])
+    GlobalConstants.setInputOutputChannels(config['gen']['input_nc'], config['gen']['output_nc'])
+    GlobalConstants.setDevice(opts.device if opts.device != "" else config.get('device', 'auto'),
+                              config.get('num_threads'), config.get('num_interop_threads'))
+    GlobalConstants.setMemoryFormat(config.get('channels_last', False))
+    desired_size = config['desired_size']
+    transform = get_test_transform(desired_size)
+    gen = load_gen_test(config, opts.ckpt, GlobalConstants.getDevice())
+    gen = gen.to(memory_format=GlobalConstants.getMemoryFormat())
+
+    bank = ClassCodeBank(opts.class_bank, opts.ckpt, desired_size) if opts.class_bank != "" else None
+    class_codes, class_images = [], []
+    for folder in opts.class_image_folders:
+        paths = list_class_images(folder)
+        if bank is not None:
+            class_codes.append(bank.class_code(gen, folder, transform)[0])
+        else:
+            class_codes.append(encode_class_images(gen, paths, transform, opts.batch_size))
+        class_images.append(transform(default_loader_custom(paths[0])))
+    content_paths = list_content_images(opts.input)[0]
+    content_images = torch.stack([transform(default_loader_custom(p)) for p in content_paths])
+
+    translations = translate_matrix(gen, content_images, torch.cat(class_codes), opts.batch_size)
+    save_grid(opts.output, content_images, torch.stack(class_images), translations)
+    print('Saved %d x %d translations to %s' % (len(content_paths), len(class_codes), opts.output))
+    if opts.array != "":
+        array = np.stack([np.stack([to_output_image(t) for t in row]) for row in translations])
+        np.save(opts.array, array)
+        print('Saved array of shape %s to %s' % (array.shape, opts.array))
+
+
+if __name__ == '__main__':
+    main()
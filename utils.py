@@ -7,16 +7,22 @@ import os
 import yaml
 import time
 
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 import torchvision.utils as vutils
 
-from data import ImageLabelFilelist, ImageLabelFilelistCustom
+from data import ImageLabelFilelist, ImageLabelFilelistCustom, get_class
 import customTransforms
 from glob import glob
 import torch.nn.functional as F
 from imgaug import augmenters as iaa
+from skimage.filters import threshold_otsu
+from skimage.io import imread
+import skimage.color as color
+from skimage.util import invert
 
 # Finds biggest 2^x such that 2^x < size
 def find_next_crop_size(size):
@@ -35,17 +41,77 @@ def resize_correctly(current_size, desired_size):
     return x
 
 
-def update_average(model_tgt, model_src, beta=0.999):
-    with torch.no_grad():
-        param_dict_src = dict(model_src.named_parameters())
-        for p_name, p_tgt in model_tgt.named_parameters():
-            p_src = param_dict_src[p_name]
-            assert(p_src is not p_tgt)
-            p_tgt.copy_(beta*p_tgt + (1. - beta)*p_src)
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_it(fn, device, iterations=20, warmup=3):
+    # Returns the mean wall time of fn in milliseconds
+    for i in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+class ModelAverage():
+    """
+    Exponential moving average of the parameters and buffers of model_src in model_tgt.
+    The tensors are paired by name once, every update is a single multi-tensor lerp.
+    With interval > 1 the average is only updated on every interval-th step, with beta raised
+    to the interval so that it averages over the same number of steps.
+    The average is kept in float32, in float16 or bfloat16 (1 - beta) * (src - tgt) falls below the
+    resolution of tgt and the average stalls. device moves model_tgt, e.g. to the CPU to save accelerator memory.
+    Integer buffers are copied.
+    """
+    def __init__(self, model_tgt, model_src, beta=0.999, interval=1, device=None):
+        self.beta = beta ** interval
+        self.interval = interval
+        model_tgt.to(device=device, dtype=torch.float32)
+        tensors_src = dict(model_src.named_parameters())
+        tensors_src.update(model_src.named_buffers())
+        tensors_tgt = dict(model_tgt.named_parameters())
+        tensors_tgt.update(model_tgt.named_buffers())
+        assert tensors_src.keys() == tensors_tgt.keys(), "model_tgt and model_src differ"
+        self.average_tgt, self.average_src, self.copy_tgt, self.copy_src = [], [], [], []
+        for name, t_tgt in tensors_tgt.items():
+            t_src = tensors_src[name]
+            assert(t_src is not t_tgt)
+            if t_tgt.is_floating_point():
+                self.average_tgt.append(t_tgt)
+                self.average_src.append(t_src)
+            else:
+                self.copy_tgt.append(t_tgt)
+                self.copy_src.append(t_src)
+        # Copies of model_src in the dtype and on the device of the average, allocated on the first update
+        # that needs them, e.g. when model_src is kept in low precision or on another device
+        self.staging = None
+
+    def update(self, it=0):
+        if it % self.interval != 0 or not self.average_tgt:
+            return
+        with torch.no_grad():
+            average_src = self.average_src
+            t_tgt = self.average_tgt[0]
+            if (t_tgt.dtype, t_tgt.device) != (average_src[0].dtype, average_src[0].device):
+                if self.staging is None:
+                    self.staging = [torch.empty_like(t) for t in self.average_tgt]
+                # Blocking, the lerp must not read a copy from the device that is still in flight
+                torch._foreach_copy_(self.staging, average_src)
+                average_src = self.staging
+            # tgt += (1 - beta) * (src - tgt) == beta * tgt + (1 - beta) * src
+            torch._foreach_lerp_(self.average_tgt, average_src, 1. - self.beta)
+            for t_tgt, t_src in zip(self.copy_tgt, self.copy_src):
+                t_tgt.copy_(t_src)
 
 
 def create_loader(root, path, rescale_size_a, rescale_size_b, batch_size, num_classes=None,
-    num_workers=4, desired_size=None, resize_shorter_side=None, shuffle=True, return_paths=False, drop_last=True):
+    num_workers=4, desired_size=None, resize_shorter_side=None, shuffle=True, return_paths=False, drop_last=True,
+    distributed=False, seed=0):
 
     crop_size = find_next_crop_size(rescale_size_a)
     cut = rescale_size_a - crop_size
@@ -60,14 +126,109 @@ def create_loader(root, path, rescale_size_a, rescale_size_b, batch_size, num_cl
         customTransforms.RescaleToOneOne()
     ])
     dataset = ImageLabelFilelistCustom(root=root, path=path, transform=transforms_, return_paths=return_paths, num_classes=num_classes)
+    # In a distributed run every process loads its own shard, set_epoch reshuffles the shards.
+    # Loaders of the same dataset need different seeds, or they yield the same images in the same order
+    sampler = DistributedSampler(dataset, shuffle=shuffle, drop_last=drop_last, seed=seed) if distributed else None
     loader = DataLoader(dataset,
                         batch_size,
-                        shuffle=shuffle,
+                        shuffle=(shuffle and sampler is None),
+                        sampler=sampler,
                         drop_last=drop_last,
                         num_workers=num_workers)
     return loader
 
 
+def get_test_transform(desired_size):
+    # Center crop used to translate single images, matches the random crop of create_loader.
+    # Without desired_size the whole image is kept, e.g. for inference.translate_tiled
+    crop = []
+    if desired_size is not None:
+        crop = [iaa.Sequential([
+            iaa.CropToFixedSize(width=desired_size, height=desired_size, position = 'center', seed = 0),
+        ]).augment_image]
+    return transforms.Compose(crop + [
+        customTransforms.ToTensor(),
+        customTransforms.RescaleToOneOne()
+    ])
+
+
+def to_output_image(output_image):
+    # Converts one translated image in [-1, 1] to a uint8 numpy image with channels last
+    image = output_image.detach().float().cpu().squeeze().numpy()
+    image = ((image + 1) * 0.5 * 255.0)
+    if (len(image.shape) == 3):
+        image = np.transpose(image, (1, 2, 0))
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def otsu_iou(fake, real):
+    # Overlap in percent of the Otsu foregrounds of two images, the accuracy measure of acc_test.py
+    fake = fake > threshold_otsu(fake)
+    real = real > threshold_otsu(real)
+    union = np.sum(np.logical_or(fake, real))
+    if (union == 0):
+        return 100.0
+    return np.sum(np.logical_and(fake, real)) / union * 100
+
+
+def prepare_evaluation_pic(pic, class_name):
+    # Grayscale, rescaled, center cropped to 256 and scaled to [0, 1] like the images otsu_iou compares in acc_test.py
+    if class_name == "malaria":
+        pic = color.rgb2grey(pic)
+        pic = invert(pic)
+    elif class_name == "Human_HT29_colon-cancer" or class_name == "dna":
+        #pic = color.rgb2grey(pic)
+        pass
+    elif class_name == "dp":
+        pic = color.rgba2rgb(pic)
+        pic = color.rgb2grey(pic)
+        
+    if (pic.dtype == 'uint16'):
+        #print("anything else than double!!")
+        if (pic.max()<32768):
+            pic = pic.astype('int16')
+        else:
+            pic = pic.astype('int32')
+    if (False):
+        pic = pic.astype('float')
+
+
+    #if (len(pic.shape)==2):
+        #pic = pic.reshape((pic.shape[0], pic.shape[1],1))
+        #pic = np.repeat(pic, 3, axis=-1)
+    if (pic.shape[0]==3):
+        #print("**************3 IS BACK: ",pic.shape)
+        pic = pic.transpose() #Not sure this is correct to get from (y,x,3) to (3,y,x)
+    
+    #==========RESHAPING=============
+    shorter_side = min(pic.shape[0], pic.shape[1])
+    if (class_name == "Hela"):
+        shorter_side = shorter_side//8
+    if (class_name == "mSar"):
+        shorter_side = shorter_side//6
+    if (class_name == "malaria"):
+        shorter_side = shorter_side//4
+    if (class_name == "Human_Hepatocyte_Murine_Fibroblast"):
+        shorter_side = int(shorter_side/2)
+    else:
+        #shorter_side = 256
+        pass
+    scale = iaa.Resize({"shorter-side":shorter_side, "longer-side":"keep-aspect-ratio"}).augment_image
+    pic = scale(pic)
+         
+    #===========CROP==================    
+    crop = iaa.CropToFixedSize(width=256, height=256, position = 'center', seed = 0).augment_image
+    pic  = crop(pic)
+    #==========TO [0,1]=============
+    pic = pic/pic.max()
+    
+    return pic
+
+
+def load_evaluation_pic(path):
+    return prepare_evaluation_pic(imread(path), get_class(path))
+
+
 def loader_from_list(
         root,
         file_list,
@@ -141,7 +302,7 @@ def get_evaluation_loaders(conf, shuffle_content=False):
             drop_last=False)
     return content_loader, class_loader
 
-def get_train_loaders_custom(conf):
+def get_train_loaders_custom(conf, distributed=False):
     batch_size = conf['batch_size']
     num_workers = conf['num_workers']
     root = "."
@@ -151,6 +312,7 @@ def get_train_loaders_custom(conf):
     rescale_size_a = (conf["size_a"]//scalar)
     rescale_size_b = (conf["size_b"]//scalar)
 
+    # Only the train loaders are sharded, the test loaders are for the images of the first process
     train_content_loader = create_loader(
         ".",
         dir_train,
@@ -160,7 +322,8 @@ def get_train_loaders_custom(conf):
         resize_shorter_side = conf["resize_shorter_side"],
         num_classes=conf['dis']['num_classes'],
         batch_size=batch_size,
-        num_workers=num_workers
+        num_workers=num_workers,
+        distributed=distributed
     )
     train_class_loader = create_loader(
         ".",
@@ -171,7 +334,9 @@ def get_train_loaders_custom(conf):
         resize_shorter_side = conf["resize_shorter_side"],
         num_classes=conf['dis']['num_classes'],
         batch_size=batch_size,
-        num_workers=num_workers
+        num_workers=num_workers,
+        distributed=distributed,
+        seed=1
     )
     test_content_loader = create_loader(
         ".",
@@ -293,8 +458,7 @@ def __write_images(im_outs, dis_img_n, file_name):
         im_outs[0] = F.pad(input=im_outs[0], pad=diff_tup, mode='constant', value=0)
         im_outs[3] = F.pad(input=im_outs[3], pad=diff_tup, mode='constant', value=0)
     for i in range(len(im_outs)):
-        if im_outs[i].dtype!=torch.float16:
-            im_outs[i] = im_outs[i].half()
+        im_outs[i] = im_outs[i].float()
     image_tensor = torch.cat([images[:dis_img_n] for images in im_outs], 0)
     image_grid = vutils.make_grid(image_tensor.data,
                                   nrow=dis_img_n, padding=0, normalize=True)